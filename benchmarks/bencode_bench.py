@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import time
+from hashlib import sha1
+
+import helpers
+from modules import bencode
+
+
+def legacy_decode(data):
+    # The recursive decoder that sliced the rest of the input per element.
+    def decode_list(data):
+        l = []
+        i = 0
+        while i < len(data):
+            byte = data[i:i+1]
+            sub = data[i+1:]
+            if byte == b'e':
+                return l, i
+            elif byte == b'i':
+                delimeter_pos = sub.find(b'e')
+                value, length = int(sub[:delimeter_pos]), delimeter_pos
+            elif byte == b'l':
+                value, length = decode_list(sub)
+            elif byte == b'd':
+                items, length = decode_list(sub)
+                value = dict(zip(items[::2], items[1::2]))
+            else:
+                delimeter_pos = data[i:].find(b':')
+                start = i + delimeter_pos + 1
+                value = data[start:start + int(data[i:i + delimeter_pos])]
+                length = start + len(value) - i - 2
+            l.append(value)
+            i += length + 2
+        return l, i
+
+    return decode_list(data)[0]
+
+
+def make_metainfo(size, files_num):
+    pieces = helpers.make_data(size // 20 * 20)
+    files = [{b'length': 2**20,
+              b'path': [b'dir%d' % (i // 100), b'file%d.bin' % i]}
+             for i in range(files_num)]
+    return bencode.encode({b'announce': b'http://127.0.0.1/announce',
+                           b'info': {b'files': files, b'name': b'bench',
+                                     b'piece length': 2**18,
+                                     b'pieces': pieces}})
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Decoding time of the legacy recursive decoder and the '
+                    'iterative decoder.')
+    parser.add_argument('--size', type=int, default=10,
+                        help='size of the pieces string in MB')
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=100000,
+                        help='nesting depth of the deep list test')
+    args = parser.parse_args()
+
+    data = make_metainfo(args.size * 10**6, args.files)
+    print('metainfo: {:.1f} MB, {} files'.format(len(data) / 10**6,
+                                                 args.files))
+    start = time.perf_counter()
+    legacy_meta = legacy_decode(data)[0]
+    print('legacy: {:.3f} s'.format(time.perf_counter() - start))
+    start = time.perf_counter()
+    meta, info = bencode.decode_metainfo(data)
+    elapsed = time.perf_counter() - start
+    assert meta == legacy_meta
+    assert sha1(info).digest() == sha1(bencode.encode(meta[b'info'])).digest()
+    print('iterative: {:.3f} s'.format(elapsed))
+
+    deep = b'l' * args.depth + b'e' * args.depth
+    try:
+        legacy_decode(deep)
+        print('legacy: decoded {} nested lists'.format(args.depth))
+    except RecursionError:
+        print('legacy: RecursionError on {} nested lists (limit {})'.format(
+            args.depth, sys.getrecursionlimit()))
+    start = time.perf_counter()
+    bencode.decode(deep)
+    print('iterative: {} nested lists in {:.3f} s'.format(
+        args.depth, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
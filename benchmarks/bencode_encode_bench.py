@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import tempfile
+import time
+
+import helpers
+from modules import bencode
+
+
+def legacy_encode(data):
+    # The encoder that concatenated bytes with += and kept key order.
+    if isinstance(data, int):
+        return b'i' + str(data).encode() + b'e'
+    if isinstance(data, bytes):
+        return str(len(data)).encode() + b':' + data
+    if isinstance(data, list):
+        encoded_data = b'l'
+        for e in data:
+            encoded_data += legacy_encode(e)
+        return encoded_data + b'e'
+    encoded_data = b'd'
+    for k, v in data.items():
+        encoded_data += legacy_encode(k) + legacy_encode(v)
+    return encoded_data + b'e'
+
+
+def make_metainfo(size, files_num):
+    files = [{b'path': [b'dir%d' % (i // 100), b'file%d.bin' % i],
+              b'length': 2**20}
+             for i in range(files_num)]
+    return {b'info': {b'name': b'bench', b'files': files,
+                      b'pieces': helpers.make_data(size // 20 * 20),
+                      b'piece length': 2**18},
+            b'announce': b'http://127.0.0.1/announce'}
+
+
+def measure(name, encode, repeat=3):
+    start = time.perf_counter()
+    for i in range(repeat):
+        encode()
+    print('{}: {:.3f} s'.format(name, (time.perf_counter() - start) / repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Encoding time of the legacy += encoder and the '
+                    'buffer encoder.')
+    parser.add_argument('--size', type=int, default=10,
+                        help='size of the pieces string in MB')
+    parser.add_argument('--files', type=int, default=20000)
+    args = parser.parse_args()
+
+    meta = make_metainfo(args.size * 10**6, args.files)
+    print('metainfo: {:.1f} MB, {} files'.format(
+        len(bencode.encode(meta)) / 10**6, args.files))
+    measure('legacy', lambda: legacy_encode(meta))
+    measure('buffer', lambda: bencode.encode(meta))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'meta.torrent')
+
+        def dump():
+            with open(path, 'wb') as f:
+                bencode.dump(meta, f)
+
+        measure('dump to file', dump)
+        with open(path, 'rb') as f:
+            assert f.read() == bencode.encode(meta)
+
+
+if __name__ == '__main__':
+    main()
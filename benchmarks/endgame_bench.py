@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import multiprocessing
+import tempfile
+import time
+
+import helpers
+from modules.torrent import Torrent
+from modules.pwp.connection import Connection
+
+FIRST_PORT = 57992
+PIECE_LENGTH = 2**18
+
+
+async def download(torrent, ports):
+    loop = asyncio.get_running_loop()
+    torrent.set_files_status(None)
+    torrent.active = True
+    start = time.time()
+    for port in ports:
+        conn = Connection(torrent)
+        torrent.connections[port] = conn
+        conn.task = loop.create_task(conn.initiate('127.0.0.1', port))
+    completed = 0
+    while completed < torrent.files.piece_num:
+        await asyncio.sleep(0.02)
+        completed += len(torrent.picker.pop_completed())
+    elapsed = time.time() - start
+    for conn in torrent.connections.values():
+        conn.close()
+        conn.task.cancel()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time to completion with and without endgame mode in a '
+                    'loopback swarm with one slow seeder.')
+    parser.add_argument('--size', type=int, default=16,
+                        help='torrent size in MiB')
+    parser.add_argument('--fast', type=int, default=2,
+                        help='number of fast seeders')
+    parser.add_argument('--slow-latency', type=float, default=10,
+                        help='seconds the slow seeder waits before a block')
+    args = parser.parse_args()
+
+    data = helpers.make_data(args.size * 2**20)
+    info = helpers.make_info('bench', data, PIECE_LENGTH)
+    latencies = [0.01] * args.fast + [args.slow_latency]
+    ports = list(range(FIRST_PORT, FIRST_PORT + len(latencies)))
+    ctx = multiprocessing.get_context('spawn')
+    seeders = []
+    for port, latency in zip(ports, latencies):
+        ready = ctx.Event()
+        seeder = ctx.Process(target=helpers.run_mock_seeder,
+                             args=(port, data, PIECE_LENGTH, latency, ready))
+        seeder.daemon = True
+        seeder.start()
+        ready.wait()
+        seeders.append(seeder)
+
+    print('endgame | seconds to completion')
+    for endgame in (False, True):
+        with tempfile.TemporaryDirectory() as tmp:
+            name = helpers.write_torrent(tmp + '/torrents', 'bench', info)
+            torrent = Torrent(name, tmp + '/torrents', tmp + '/downloads')
+            torrent.picker.endgame = endgame
+            elapsed = asyncio.run(download(torrent, ports))
+            torrent.files.close_files()
+        print('{:7} | {:.2f}'.format(str(endgame), elapsed))
+    for seeder in seeders:
+        seeder.terminate()
+
+
+if __name__ == '__main__':
+    main()
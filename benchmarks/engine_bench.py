@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import multiprocessing
+import select
+import socket
+import tempfile
+import threading
+import time
+
+import helpers
+from modules.torrent import Torrent
+from modules.pwp import messages
+from modules.pwp.connection import Connection
+
+MOCK_PORT = 57990
+MESSAGE_TIMEOUT = 5
+
+
+def measure(connected, window, result):
+    start = time.time()
+    while connected() < result['peers'] and time.time() - start < 60:
+        time.sleep(0.05)
+    result['connect_time'] = round(time.time() - start, 2)
+    result['connected'] = connected()
+    cpu_start = time.process_time()
+    time.sleep(window)
+    result['cpu_percent'] = round(
+        100 * (time.process_time() - cpu_start) / window, 1)
+    result['max_rss_mb'] = helpers.get_max_rss_mb()
+    result['threads'] = threading.active_count()
+
+
+def run_threaded(peers, window, queue):
+    # Thread-per-peer model the client used before the asyncio engine.
+    def peer_loop(handshake, stop):
+        try:
+            sock = socket.create_connection(('127.0.0.1', MOCK_PORT))
+        except OSError:
+            return
+        sock.setblocking(0)
+        sock.sendall(handshake)
+        greeted = False
+        while not stop.is_set():
+            rs, ws, es = select.select([sock], [], [], MESSAGE_TIMEOUT)
+            if sock in rs:
+                try:
+                    data = sock.recv(4096)
+                except OSError:
+                    break
+                if not data:
+                    break
+                if not greeted:
+                    greeted = True
+                    with lock:
+                        greeted_num[0] += 1
+                messages.get_messages(data)
+        sock.close()
+
+    helpers.raise_files_limit()
+    lock = threading.Lock()
+    greeted_num = [0]
+    stop = threading.Event()
+    handshake = messages.build_handshake(b'\x01' * 20, b'-VT1001-000000000000')
+    for i in range(peers):
+        t = threading.Thread(target=peer_loop, args=(handshake, stop))
+        t.daemon = True
+        t.start()
+    result = {'model': 'threads', 'peers': peers}
+    measure(lambda: greeted_num[0], window, result)
+    stop.set()
+    queue.put(result)
+
+
+def run_async(peers, window, queue):
+    async def main(torrent):
+        loop = asyncio.get_running_loop()
+        conns = []
+        for i in range(peers):
+            conn = Connection(torrent)
+            conn.info_hash = b'\x01' * 20
+            conn.task = loop.create_task(conn.initiate('127.0.0.1',
+                                                       MOCK_PORT))
+            conns.append(conn)
+        result = {'model': 'asyncio', 'peers': peers}
+        await loop.run_in_executor(
+            None, measure,
+            lambda: len([c for c in conns if c.peer_id]), window, result)
+        for conn in conns:
+            conn.task.cancel()
+            conn.close()
+        return result
+
+    helpers.raise_files_limit()
+    with tempfile.TemporaryDirectory() as tmp:
+        info = helpers.make_info('bench', helpers.make_data(2**16), 2**14)
+        name = helpers.write_torrent(tmp + '/torrents', 'bench', info)
+        torrent = Torrent(name, tmp + '/torrents', tmp + '/downloads')
+        queue.put(asyncio.run(main(torrent)))
+        torrent.files.close_files()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the asyncio peer engine with the '
+                    'thread-per-connection model against local mock peers.')
+    parser.add_argument('--peers', type=int, nargs='+',
+                        default=[100, 500, 1000])
+    parser.add_argument('--window', type=float, default=10,
+                        help='seconds of steady state to measure')
+    parser.add_argument('--message-interval', type=float, default=1,
+                        help='seconds between messages from each mock peer')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    ready = ctx.Event()
+    server = ctx.Process(target=helpers.run_mock_peers,
+                         args=(MOCK_PORT, args.message_interval, ready))
+    server.daemon = True
+    server.start()
+    ready.wait()
+
+    print('model   | peers | connected | connect s | cpu % | '
+          'max rss MB | threads')
+    for peers in args.peers:
+        for target in (run_threaded, run_async):
+            queue = ctx.Queue()
+            p = ctx.Process(target=target, args=(peers, args.window, queue))
+            p.start()
+            r = queue.get()
+            p.join()
+            print('{model:7} | {peers:5} | {connected:9} | '
+                  '{connect_time:9} | {cpu_percent:5} | {max_rss_mb:10} | '
+                  '{threads}'.format(**r))
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import helpers
+from modules.pwp import messages
+
+
+def legacy_get_messages(bytes_):
+    # Recursive parser used by Connection before the Framer.
+    if not bytes_:
+        return []
+    result = []
+    handshake_length = messages.get_handshake_length()
+    if len(bytes_) >= handshake_length:
+        handshake = messages.get_handshake(bytes_[:handshake_length])
+        if handshake:
+            result.append(handshake)
+            result.extend(legacy_get_messages(bytes_[handshake_length:]))
+            return result
+    length = messages.LEN_LEN + messages.get_message_length(bytes_)
+    message = messages.get_message(bytes_[:length])
+    if message:
+        result.append(message)
+        result.extend(legacy_get_messages(bytes_[length:]))
+        return result
+    return [{'type': 'not_used', 'data': bytes_}]
+
+
+def parse_legacy(chunks):
+    parsed = []
+    for chunk in chunks:
+        not_used_data = b''
+        while parsed and parsed[-1]['type'] == 'not_used':
+            not_used_data = parsed.pop()['data'] + not_used_data
+        parsed.extend(legacy_get_messages(not_used_data + chunk))
+    return len(parsed)
+
+
+def parse_framer(chunks):
+    framer = messages.Framer(handshake=False)
+    parsed = 0
+    for chunk in chunks:
+        framer.feed(chunk)
+        for message in framer:
+            parsed += 1
+    return parsed
+
+
+def get_stream(blocks):
+    block = helpers.make_data(2**14)
+    parts = []
+    for i in range(blocks):
+        parts.append(messages.build_piece(i // 16, i % 16 * 2**14, block))
+        parts.append(messages.build_have(i))
+    return b''.join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='MB/s parsed by the legacy recursive parser and by '
+                    'the incremental Framer.')
+    parser.add_argument('--blocks', type=int, default=4096)
+    parser.add_argument('--chunks', type=int, nargs='+',
+                        default=[4096, 65536, 2**20])
+    args = parser.parse_args()
+
+    stream = get_stream(args.blocks)
+    print('chunk bytes | parser | MB/s')
+    for chunk_size in args.chunks:
+        chunks = [stream[i:i + chunk_size]
+                  for i in range(0, len(stream), chunk_size)]
+        for name, parse in (('legacy', parse_legacy),
+                            ('framer', parse_framer)):
+            start = time.perf_counter()
+            try:
+                parse(chunks)
+            except RecursionError:
+                print('{:11} | {:6} | recursion limit'.format(chunk_size,
+                                                               name))
+                continue
+            elapsed = time.perf_counter() - start
+            print('{:11} | {:6} | {:.1f}'.format(
+                chunk_size, name, len(stream) / elapsed / 10**6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import asyncio
+import os
+import resource
+import sys
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.path.pardir)
+sys.path.append(root_dir)
+# Torrents are built the same way as in the tests.
+sys.path.append(os.path.join(root_dir, 'tests'))
+from modules.pwp import messages
+from fixtures import make_data, make_info, make_multi_info, write_torrent
+
+
+def raise_files_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def get_max_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                 1)
+
+
+async def serve_mock_peers(port, message_interval, ready=None):
+    async def handle(reader, writer):
+        try:
+            handshake = await reader.readexactly(
+                messages.get_handshake_length())
+            writer.write(handshake[:-20] + b'-MOCK00-000000000000')
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.read(4096),
+                                                  message_interval)
+                except asyncio.TimeoutError:
+                    writer.write(messages.build_have(0))
+                    continue
+                if not data:
+                    break
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', port,
+                                        backlog=4096)
+    if ready is not None:
+        ready.set()
+    async with server:
+        await server.serve_forever()
+
+
+def run_mock_peers(port, message_interval, ready):
+    raise_files_limit()
+    asyncio.run(serve_mock_peers(port, message_interval, ready))
+
+
+async def serve_mock_seeder(port, data, piece_length, latency, ready=None):
+    async def handle(reader, writer):
+        def send_block(request):
+            index, begin = request['index'], request['begin']
+            start = index * piece_length + begin
+            writer.write(messages.build_piece(
+                index, begin, data[start:start + request['length']]))
+
+        loop = asyncio.get_running_loop()
+        framer = messages.Framer(handshake=False)
+        try:
+            handshake = await reader.readexactly(
+                messages.get_handshake_length())
+            writer.write(handshake[:-20] + b'-MOCK00-000000000000')
+            pieces_num = (len(data) + piece_length - 1) // piece_length
+            writer.write(messages.build_bitfield(
+                b'\xff' * ((pieces_num + 7) // 8)))
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                framer.feed(chunk)
+                for m in framer:
+                    if m['type'] == 'interested':
+                        writer.write(messages.build_unchoke())
+                    elif m['type'] == 'request':
+                        loop.call_later(latency, send_block, m)
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', port)
+    if ready is not None:
+        ready.set()
+    async with server:
+        await server.serve_forever()
+
+
+def run_mock_seeder(port, data, piece_length, latency, ready):
+    asyncio.run(serve_mock_seeder(port, data, piece_length, latency, ready))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from modules.bitfield import Bitfield
+from modules.files import Files
+
+
+def make_info(pieces_num, piece_length, file_length):
+    size = pieces_num * piece_length
+    info = {b'name': b'bench', b'piece length': piece_length,
+            b'pieces': b'\x00' * 20 * pieces_num}
+    if not file_length:
+        info[b'length'] = size
+        return info
+    info[b'files'] = [{b'length': min(file_length, size - offset),
+                       b'path': [b'%d' % i]}
+                      for i, offset in enumerate(range(0, size,
+                                                       file_length))]
+    return info
+
+
+def measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size / 2**20, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Memory of piece metadata and peer have-sets.')
+    parser.add_argument('--pieces', type=int, default=200000)
+    parser.add_argument('--piece-length', type=int, default=2**14)
+    parser.add_argument('--file-length', type=int, default=0,
+                        help='split the torrent into files of this length')
+    parser.add_argument('--peers', type=int, default=50)
+    args = parser.parse_args()
+
+    info = make_info(args.pieces, args.piece_length, args.file_length)
+    with tempfile.TemporaryDirectory() as tmp:
+        files, size, elapsed = measure(lambda: Files(info, tmp))
+        print('files: {} pieces in {} files, {:.1f} MiB, opened in '
+              '{:.2f} s'.format(args.pieces, len(files.files), size,
+                                elapsed))
+        files.have.update(range(0, args.pieces, 2))
+        start = time.perf_counter()
+        for i in range(100):
+            files.get_bitfield()
+        print('files: {:.3f} ms per bitfield message'.format(
+            (time.perf_counter() - start) * 10))
+        files.close_files()
+
+    rnd = random.Random(0)
+    payloads = [rnd.randbytes((args.pieces + 7) // 8)
+                for i in range(args.peers)]
+    for name, build in (('set', lambda payload: set(
+                             Bitfield(args.pieces, payload))),
+                        ('bitfield', lambda payload: Bitfield(args.pieces,
+                                                              payload))):
+        has_pieces, size, elapsed = measure(
+            lambda: [build(payload) for payload in payloads])
+        print('{}: {:.2f} MiB per peer'.format(name, size / args.peers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from modules.meter import TrafficMeter
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Cost of metering a block on the peer, torrent and '
+                    'client rate meters.')
+    parser.add_argument('--calls', type=int, default=10**6)
+    parser.add_argument('--peers', type=int, default=50)
+    args = parser.parse_args()
+
+    client = TrafficMeter()
+    torrent = TrafficMeter(client)
+    peers = [TrafficMeter(torrent) for i in range(args.peers)]
+    start = time.perf_counter()
+    for i in range(args.calls):
+        peers[i % args.peers].download.add(2**14)
+    elapsed = time.perf_counter() - start
+    print('add: {:.2f} us per block'.format(elapsed / args.calls * 10**6))
+    start = time.perf_counter()
+    for i in range(args.calls):
+        peers[i % args.peers].download.get_rate()
+    elapsed = time.perf_counter() - start
+    print('get_rate: {:.2f} us per call'.format(
+        elapsed / args.calls * 10**6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+import argparse
+import tempfile
+import time
+
+import helpers
+from modules.files import BLOCK_SIZE, STORAGES
+
+
+def make_info(size, piece_length, file_length):
+    # Hashes are never checked here, so a multi-GB torrent needs no data.
+    pieces_num = -(-size // piece_length)
+    info = {b'name': b'bench', b'piece length': piece_length,
+            b'pieces': b'\x00' * 20 * pieces_num}
+    if not file_length:
+        info[b'length'] = size
+        return info
+    lengths = [file_length] * (size // file_length)
+    if size % file_length:
+        lengths.append(size % file_length)
+    info[b'files'] = [{b'length': length, b'path': [b'%d' % i]}
+                      for i, length in enumerate(lengths)]
+    return info
+
+
+def run(storage, info, pool):
+    with tempfile.TemporaryDirectory() as tmp:
+        files = STORAGES[storage](info, tmp)
+        total = files.total_length
+        start = time.perf_counter()
+        for index in range(files.piece_num):
+            length = files.get_piece_length(index)
+            files.write_piece(index, pool[index % len(pool)][:length])
+        files.sync()
+        write_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for index in range(files.piece_num):
+            for begin, length in files.get_blocks(index):
+                files.read_block(index, begin, length)
+        block_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for index in range(files.piece_num):
+            files.read_block(index, 0, files.get_piece_length(index))
+        piece_time = time.perf_counter() - start
+        files.close_files()
+    print('{}: write {:.0f} MB/s, block reads {:.0f} MB/s, '
+          'piece reads {:.0f} MB/s'.format(
+              storage, total / write_time / 10**6,
+              total / block_time / 10**6, total / piece_time / 10**6))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write and read throughput of the file and mmap '
+                    'storage backends.')
+    parser.add_argument('--size', type=int, default=2048,
+                        help='torrent size in MiB')
+    parser.add_argument('--piece-length', type=int, default=2**20)
+    parser.add_argument('--file-length', type=int, default=0,
+                        help='split the torrent into files of this length')
+    args = parser.parse_args()
+
+    info = make_info(args.size * 2**20, args.piece_length, args.file_length)
+    pool = [bytearray(helpers.make_data(args.piece_length, seed))
+            for seed in range(16)]
+    print('{} MiB, {} KiB pieces, {} KiB blocks'.format(
+        args.size, args.piece_length // 1024, BLOCK_SIZE // 1024))
+    for storage in ('file', 'mmap'):
+        run(storage, info, pool)
+
+
+if __name__ == '__main__':
+    main()
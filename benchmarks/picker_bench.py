@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from modules.bitfield import Bitfield
+from modules.picker import PiecePicker
+
+
+def legacy_pick(have, requested, peers, count):
+    # Selection loop of the old Torrent.distribute_requests.
+    picked = []
+    for index in range(len(have)):
+        if not have[index] and index not in requested:
+            random.shuffle(peers)
+            for peer in peers:
+                if index in peer:
+                    requested.add(index)
+                    picked.append(index)
+                    break
+        if len(picked) == count:
+            break
+    return picked
+
+
+def make_peers(pieces, peers_num, rnd):
+    peers = []
+    for i in range(peers_num):
+        density = rnd.random()
+        peers.append({index for index in range(pieces)
+                      if rnd.random() < density})
+    return peers
+
+
+def make_bitfield(pieces, indices):
+    bitfield = Bitfield(pieces)
+    bitfield.update(indices)
+    return bitfield
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Piece selection cost of the legacy in-order scan and '
+                    'the rarest-first picker.')
+    parser.add_argument('--pieces', type=int, default=100000)
+    parser.add_argument('--peers', type=int, default=500)
+    parser.add_argument('--done', type=float, default=0.5,
+                        help='share of pieces we already have')
+    parser.add_argument('--picks', type=int, default=64,
+                        help='pieces picked per scheduling pass')
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    start = time.perf_counter()
+    peers = make_peers(args.pieces, args.peers, rnd)
+    print('generated {} peers in {:.1f} s'.format(
+        args.peers, time.perf_counter() - start))
+    have = [rnd.random() < args.done for i in range(args.pieces)]
+
+    picker = PiecePicker(SimpleNamespace(piece_num=args.pieces))
+    start = time.perf_counter()
+    for index in range(args.pieces):
+        picker.set_wanted(index, not have[index])
+    for peer in peers:
+        picker.add_peer_pieces(peer)
+    print('picker: index built in {:.2f} s'.format(
+        time.perf_counter() - start))
+
+    start = time.perf_counter()
+    for i in range(10000):
+        index = rnd.randrange(args.pieces)
+        picker.change_availability(index, 1)
+        picker.change_availability(index, -1)
+    print('picker: {:.1f} us per have update'.format(
+        (time.perf_counter() - start) / 20000 * 10**6))
+
+    def mean_availability(picked):
+        return sum(picker.availability[i] for i in picked) / len(picked)
+
+    start = time.perf_counter()
+    picked = legacy_pick(have, set(), list(peers), args.picks)
+    legacy_time = time.perf_counter() - start
+    print('legacy: {} picks in {:.1f} ms, mean availability {:.1f}'.format(
+        len(picked), legacy_time * 1000, mean_availability(picked)))
+
+    bitfields = [make_bitfield(args.pieces, peer) for peer in peers]
+    start = time.perf_counter()
+    picked = []
+    while len(picked) < args.picks:
+        index = picker.pick(bitfields[len(picked) % len(bitfields)])
+        if index is not None:
+            picked.append(index)
+    picker_time = time.perf_counter() - start
+    print('picker: {} picks in {:.1f} ms, mean availability {:.1f}'.format(
+        len(picked), picker_time * 1000, mean_availability(picked)))
+
+    # Peers with little or nothing we want must not cost a scan of every
+    # wanted piece.
+    wanted = [index for index in range(args.pieces) if not have[index]]
+    for interesting in (0, 10):
+        peer = make_bitfield(
+            args.pieces, [index for index in range(args.pieces)
+                          if have[index]] + wanted[:interesting])
+        start = time.perf_counter()
+        for i in range(100):
+            picker.pick(peer)
+        print('picker: {:.2f} ms per pick for a peer with {} wanted '
+              'pieces'.format((time.perf_counter() - start) * 10,
+                              interesting))
+
+
+if __name__ == '__main__':
+    main()
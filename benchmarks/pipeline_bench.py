@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import multiprocessing
+import tempfile
+import time
+
+import helpers
+from modules.torrent import Torrent
+from modules.pwp.connection import Connection
+
+SEEDER_PORT = 57991
+PIECE_LENGTH = 2**18
+
+
+async def download(torrent, pipeline_size, adaptive):
+    pieces_num = torrent.files.piece_num
+    for index in range(pieces_num):
+        torrent.picker.set_wanted(index, True)
+    torrent.active = True
+    conn = Connection(torrent, pipeline_size=pipeline_size,
+                      adaptive_pipeline=adaptive)
+    start = time.time()
+    task = asyncio.get_running_loop().create_task(
+        conn.initiate('127.0.0.1', SEEDER_PORT))
+    completed = 0
+    while completed < pieces_num and not conn.broken:
+        await asyncio.sleep(0.01)
+        completed += len(torrent.picker.pop_completed())
+    elapsed = time.time() - start
+    conn.close()
+    task.cancel()
+    return elapsed, conn.pipeline_size
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Download throughput from a loopback seeder for '
+                    'different request pipeline settings.')
+    parser.add_argument('--size', type=int, default=32,
+                        help='torrent size in MiB')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the seeder waits before each block')
+    args = parser.parse_args()
+
+    data = helpers.make_data(args.size * 2**20)
+    info = helpers.make_info('bench', data, PIECE_LENGTH)
+    ctx = multiprocessing.get_context('spawn')
+    ready = ctx.Event()
+    seeder = ctx.Process(target=helpers.run_mock_seeder,
+                         args=(SEEDER_PORT, data, PIECE_LENGTH,
+                               args.latency, ready))
+    seeder.daemon = True
+    seeder.start()
+    ready.wait()
+
+    print('pipeline | adaptive | seconds | MB/s | final size')
+    with tempfile.TemporaryDirectory() as tmp:
+        name = helpers.write_torrent(tmp + '/torrents', 'bench', info)
+        torrent = Torrent(name, tmp + '/torrents', tmp + '/downloads')
+        for size, adaptive in ((1, False), (4, False), (16, False),
+                               (64, False), (16, True)):
+            elapsed, final = asyncio.run(download(torrent, size, adaptive))
+            print('{:8} | {:8} | {:7.2f} | {:4.1f} | {}'.format(
+                size, str(adaptive), elapsed,
+                args.size * 2**20 / elapsed / 10**6, final))
+        torrent.files.close_files()
+    seeder.terminate()
+
+
+if __name__ == '__main__':
+    main()
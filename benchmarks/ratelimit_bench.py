@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from modules.pwp.connection import READ_SIZE
+from modules.ratelimit import TokenBucket
+
+
+def measure_overhead(calls):
+    for name, rates in (('unlimited', (0, 0, 0)),
+                        ('limited', (10**12, 10**12, 10**12))):
+        total = TokenBucket(rates[0])
+        torrent = TokenBucket(rates[1], total)
+        peer = TokenBucket(rates[2], torrent)
+        start = time.perf_counter()
+        for i in range(calls):
+            peer.consume(READ_SIZE)
+        elapsed = time.perf_counter() - start
+        print('{:9} chain: {:.2f} us per read'.format(
+            name, elapsed / calls * 10**6))
+
+
+async def transfer(limit, peers, duration):
+    # Peers stream to us over loopback; every read goes through a peer,
+    # torrent and global bucket, as in Connection.recieve_messages.
+    async def send(reader, writer):
+        chunk = b'\x00' * READ_SIZE
+        try:
+            while True:
+                writer.write(chunk)
+                await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def receive(bucket):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        while time.perf_counter() < deadline:
+            data = await reader.read(READ_SIZE)
+            received[0] += len(data)
+            delay = bucket.consume(len(data))
+            if delay:
+                await asyncio.sleep(delay)
+        writer.close()
+
+    server = await asyncio.start_server(send, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    total = TokenBucket(limit)
+    torrent = TokenBucket(parent=total)
+    received = [0]
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*[receive(TokenBucket(parent=torrent))
+                           for i in range(peers)])
+    elapsed = time.perf_counter() - start
+    server.close()
+    # Let the senders see the closed sockets before the loop goes away.
+    await asyncio.sleep(0.1)
+    return received[0] / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Cost of the token bucket chain per read and the '
+                    'throughput it lets through on loopback.')
+    parser.add_argument('--calls', type=int, default=10**6)
+    parser.add_argument('--peers', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--limits', type=float, nargs='+',
+                        default=[0, 100, 10],
+                        help='global download limits in MB/s, 0 is none')
+    args = parser.parse_args()
+
+    measure_overhead(args.calls)
+    print('limit MB/s | received MB/s')
+    for limit in args.limits:
+        rate = asyncio.run(transfer(int(limit * 2**20), args.peers,
+                                    args.duration))
+        # Buckets start full, so short runs also count one BURST_TIME
+        # worth of data on top of the limit.
+        print('{:>10} | {:.1f}'.format(limit or 'none', rate / 2**20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import tempfile
+import time
+from hashlib import sha1
+
+import helpers
+from modules.files import Files
+from modules.verifier import recheck
+
+
+def make_torrent(root_dir, size, piece_length):
+    # The data repeats a small pool of pieces, so multi-GB torrents are
+    # written quickly and still carry real hashes.
+    pool = [helpers.make_data(piece_length, seed) for seed in range(16)]
+    pieces_num = size // piece_length
+    info = {b'name': b'bench', b'length': pieces_num * piece_length,
+            b'piece length': piece_length,
+            b'pieces': b''.join(sha1(pool[i % len(pool)]).digest()
+                                for i in range(pieces_num))}
+    files = Files(info, root_dir)
+    for index in range(pieces_num):
+        files.write_piece(index, pool[index % len(pool)])
+    files.close_files()
+    return info
+
+
+def drop_caches(cold):
+    if not cold:
+        return
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3')
+
+
+def legacy_recheck(files):
+    # One piece at a time in the calling thread.
+    valid = []
+    for index in range(files.piece_num):
+        data = files.read_block(index, 0, files.get_piece_length(index))
+        valid.append(files.hash_is_correct(index, sha1(data).digest()))
+    return valid
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Full recheck throughput of a piece-by-piece scan and '
+                    'the parallel recheck.')
+    parser.add_argument('--size', type=int, default=2048,
+                        help='torrent size in MiB')
+    parser.add_argument('--piece-length', type=int, default=2**20)
+    parser.add_argument('--cold', action='store_true',
+                        help='drop the page cache before every run '
+                             '(needs root)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        info = make_torrent(tmp, args.size * 2**20, args.piece_length)
+        print('wrote {} MiB in {:.1f} s'.format(
+            args.size, time.perf_counter() - start))
+        runs = [('legacy', legacy_recheck)] + [
+            ('{} workers'.format(workers),
+             lambda files, workers=workers: recheck(files, workers))
+            for workers in (1, 2, 4)]
+        for name, check in runs:
+            files = Files(info, tmp)
+            drop_caches(args.cold)
+            start = time.perf_counter()
+            valid = check(files)
+            elapsed = time.perf_counter() - start
+            files.close_files()
+            assert all(valid)
+            print('{}: {:.0f} MB/s'.format(
+                name, len(valid) * args.piece_length / elapsed / 10**6))
+
+
+if __name__ == '__main__':
+    main()
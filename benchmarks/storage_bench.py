@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import tempfile
+import time
+
+import helpers
+from modules.files import Files
+
+
+def legacy_write(files, pieces):
+    # Write path of the old Files: 'w+b' file objects, seek + write + flush
+    # for every segment of every piece, fsync when the files are closed.
+    handles = {}
+    for file in files.files:
+        handles[id(file)] = open('{}/{}'.format(files.root_dir,
+                                                file['path']), 'w+b')
+    for index, data in pieces:
+        written = 0
+        for file, pos, length in files.get_piece_spans(index):
+            handle = handles[id(file)]
+            handle.seek(pos)
+            handle.write(data[written:written + length])
+            handle.flush()
+            written += length
+    for handle in handles.values():
+        os.fsync(handle.fileno())
+        handle.close()
+
+
+def storage_write(files, pieces):
+    for index, data in pieces:
+        files.write_piece(index, data)
+    files.close_files()
+
+
+def run(name, info, data, piece_length, preallocate):
+    pieces = [(i, bytearray(data[i * piece_length:(i + 1) * piece_length]))
+              for i in range(len(info[b'pieces']) // 20)]
+    results = []
+    for label, write in (('legacy', legacy_write),
+                         ('pwrite', storage_write)):
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            files = Files(info, tmp, preallocate)
+            write(files, pieces)
+            elapsed = time.perf_counter() - start
+            if write is legacy_write:
+                files.close_files()
+        results.append(elapsed)
+        print('{}: {}: {:.0f} MB/s'.format(
+            name, label, len(data) / elapsed / 10**6))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Piece write throughput of the legacy seek/write/flush '
+                    'path and the pwrite storage.')
+    parser.add_argument('--size', type=int, default=128,
+                        help='torrent size in MiB')
+    parser.add_argument('--piece-length', type=int, default=2**18)
+    parser.add_argument('--small-file', type=int, default=2**15,
+                        help='file length of the many-file torrent')
+    parser.add_argument('--preallocate', default='sparse',
+                        choices=('sparse', 'full', 'none'))
+    args = parser.parse_args()
+    preallocate = None if args.preallocate == 'none' else args.preallocate
+
+    data = helpers.make_data(args.size * 2**20)
+    info = helpers.make_info('single', data, args.piece_length)
+    run('single file', info, data, args.piece_length, preallocate)
+    lengths = [args.small_file] * (len(data) // args.small_file)
+    info = helpers.make_multi_info('multi', data, args.piece_length, lengths)
+    run('{} files'.format(len(lengths)), info, data, args.piece_length,
+        preallocate)
+
+
+if __name__ == '__main__':
+    main()
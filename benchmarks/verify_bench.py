@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import tempfile
+import time
+from hashlib import sha1
+
+import helpers
+from modules.files import Files
+from modules.verifier import Verifier
+
+
+async def measure_stalls(stalls, interval=0.001):
+    # Longest gap between ticks: how long peers would wait on the loop.
+    last = time.perf_counter()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.perf_counter()
+        stalls.append(now - last - interval)
+        last = now
+
+
+async def inline(files, pieces, workers):
+    # Hashing and writing in the loop, as the old collect_pieces did.
+    for index, data in pieces:
+        if files.hash_is_correct(index, sha1(data).digest()):
+            files.write_piece(index, data)
+        await asyncio.sleep(0)
+
+
+async def pipelined(files, pieces, workers):
+    verifier = Verifier(files, lambda *args: None, workers)
+    verifier.start()
+    for index, data in pieces:
+        await verifier.put(index, data, set())
+    await verifier.join()
+    await verifier.stop()
+
+
+async def run(verify, info, pieces, workers):
+    with tempfile.TemporaryDirectory() as tmp:
+        files = Files(info, tmp)
+        stalls = []
+        ticker = asyncio.get_running_loop().create_task(
+            measure_stalls(stalls))
+        await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        await verify(files, pieces, workers)
+        files.sync()
+        elapsed = time.perf_counter() - start
+        ticker.cancel()
+        files.close_files()
+    return elapsed, max(stalls)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Piece verification throughput inline in the event '
+                    'loop and in the verification pipeline.')
+    parser.add_argument('--size', type=int, default=128,
+                        help='torrent size in MiB')
+    parser.add_argument('--piece-length', type=int, default=2**20)
+    args = parser.parse_args()
+
+    data = helpers.make_data(args.size * 2**20)
+    info = helpers.make_info('bench', data, args.piece_length)
+    pieces = [(i, bytearray(data[i * args.piece_length:
+                                 (i + 1) * args.piece_length]))
+              for i in range(len(data) // args.piece_length)]
+    runs = [('inline', inline, 1)] + [
+        ('{} workers'.format(workers), pipelined, workers)
+        for workers in (1, 2, 4)]
+    for name, verify, workers in runs:
+        elapsed, stall = asyncio.run(run(verify, info, pieces, workers))
+        print('{}: {:.0f} MB/s, longest loop stall {:.1f} ms'.format(
+            name, len(data) / elapsed / 10**6, stall * 1000))
+
+
+if __name__ == '__main__':
+    main()
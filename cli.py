@@ -20,6 +20,22 @@ def main():
             break
         elif command == 'help':
             print_message(get_help_output())
+        elif command.startswith('limit'):
+            try:
+                client.set_rate_limit(*parse_limit_command(command))
+            except IndexError:
+                print_message('Error: There is no torrent with '
+                              'corresponding index.')
+            except Exception:
+                print_message('Error: Unsupported command format.')
+        elif command.startswith('recheck'):
+            try:
+                client.recheck_torrent(int(command.split()[1]))
+            except IndexError:
+                print_message('Error: There is no torrent with '
+                              'corresponding index.')
+            except Exception:
+                print_message('Error: Unsupported command format.')
         else:
             try:
                 client.change_torrent_status(*parse_command(command))
@@ -39,10 +55,22 @@ def parse_command(command):
     return torrent_num, files_nums
 
 
+def parse_limit_command(command):
+    parts = command.split()
+    if len(parts) not in (3, 4) or parts[1] not in ('up', 'down'):
+        raise ValueError('Unsupported limit command.')
+    rate = int(float(parts[2]) * 1024)
+    if rate < 0:
+        raise ValueError('Rate limit must not be negative.')
+    number = int(parts[3]) if len(parts) == 4 else None
+    return parts[1], rate, number
+
+
 def print_torrents_info(client):
     while client.running:
         with lock:
             print("\033[H\033[J")
+            print(get_rates_output(client.get_rates()))
             print(get_torrents_info_output(client.get_torrents_info()))
         time.sleep(1)
 
@@ -51,25 +79,40 @@ def get_torrents_info_output(torrents_info):
     def get_status(skip):
         return 'skip' if skip else 'download'
 
-    output = (' # | name | active | peers | speed | downloaded | '
-              'uploaded | size | completed\n\n')
+    output = (' # | name | active | peers | seeders/leechers | '
+              'down/up speed | downloaded | uploaded | size | '
+              'completed\n\n')
     line = ('\n {number} | {name} | {active} | {peers} | '
-            '{speed} KB/s | {downloaded} MB | {uploaded} MB | '
-            '{length} MB | {completed}\n')
+            '{seeders}/{leechers} | {speed}/{upload_speed} KB/s | '
+            '{downloaded} MB | {uploaded} MB | {length} MB | '
+            '{completed}\n')
+    checking = ('\tchecking {progress:.0%} at {checking_speed} MB/s\n')
     for info in torrents_info:
         output += line.format(**info)
+        if info['checking'] is not None:
+            output += checking.format(progress=info['checking'], **info)
         for index, file in enumerate(info['files']):
             output += '\t{}. {} | {}\n'.format(index + 1, file['path'],
                                                get_status(file['skip']))
     return output + '\n\nPress Enter to get in input mode'
 
 
+def get_rates_output(rates):
+    return 'Total: down {} KB/s | up {} KB/s | overhead {} KB/s\n'.format(
+        *[round(rates[key] / 2**10, 1) for key in ('down', 'up', 'overhead')])
+
+
 def get_help_output():
     output = ('\n' + '_'*40 +
               '\n\nTo start or stop downloading enter a torrent number. '
               'If you don\'t want to download all files in a package, '
               'use the following syntax: \n\n"<torrent number> '
               '<files numbers separated by comma>"\n\n'
+              'To verify data that is already on disk use command '
+              '"recheck <torrent number>".\n\n'
+              'To limit upload or download speed in KB/s use command '
+              '"limit <up|down> <speed> [torrent number]"; speed 0 '
+              'removes the limit.\n\n'
               'To close the client use command "exit". In this case '
               'all data will be saved correctly.\n\n' + '_'*40 + '\n')
     return output
@@ -4,98 +4,155 @@ LIST_DELIMETER = b'l'
 DICT_DELIMETER = b'd'
 STR_DELIMETER = b':'
 
+FLUSH_SIZE = 2**16
+
 
 def decode(data):
-    return decode_list(data)[0]
+    return decode_values(data)[0]
+
+
+def decode_metainfo(data):
+    values, span = decode_values(data, b'info')
+    if not values or not isinstance(values[0], dict) or span is None:
+        raise ValueError('Metainfo must be a dictionary with info.')
+    return values[0], bytes(memoryview(data)[span[0]:span[1]])
+
+
+def decode_values(data, span_key=None):
+    # Containers under construction live on an explicit stack, so nesting
+    # depth is not limited by recursion and every element is read in place
+    # by offset instead of slicing the rest of the input.
+    view = memoryview(data)
+    if not isinstance(data, (bytes, bytearray)):
+        data = view.tobytes()
+    values = []
+    stack = []
+    span_start = None
+    span = None
+    i = 0
 
+    def add(value, end):
+        nonlocal span
+        if not stack:
+            values.append(value)
+            return
+        container, key = stack[-1]
+        if isinstance(container, list):
+            container.append(value)
+        elif key is None:
+            if not isinstance(value, bytes):
+                raise ValueError('Dictionary keys must be strings.')
+            stack[-1][1] = value
+        else:
+            container[key] = value
+            stack[-1][1] = None
+            if len(stack) == 1 and key == span_key:
+                span = span_start, end
+
+    def close():
+        container, key = stack.pop()
+        if key is not None:
+            raise ValueError('Dictionary must consist of pairs.')
+        return container
 
-def decode_list(data):
-    l = []
-    i = 0
     while i < len(data):
-        byte = data[i:i+1]
-        sub = data[i+1:]
+        byte = data[i:i + 1]
+        if (span_key is not None and len(stack) == 1 and
+                stack[0][1] == span_key):
+            span_start = i
         if byte == ENDING_DELIMETER:
-            return l, i
+            if not stack:
+                break
+            i += 1
+            add(close(), i)
         elif byte == INT_DELIMETER:
-            value, length = decode_integer(sub)
+            end = data.find(ENDING_DELIMETER, i)
+            if end == -1:
+                raise ValueError('Unterminated integer '
+                                 'at {} position.'.format(i))
+            value = int(data[i + 1:end])
+            i = end + 1
+            add(value, i)
         elif byte == LIST_DELIMETER:
-            value, length = decode_list(sub)
+            stack.append([[], None])
+            i += 1
         elif byte == DICT_DELIMETER:
-            value, length = decode_dict(sub)
-        elif byte.decode().isnumeric():
-            value, length = decode_string(data[i:])
+            stack.append([{}, None])
+            i += 1
+        elif byte.isdigit():
+            colon = data.find(STR_DELIMETER, i)
+            if colon == -1:
+                raise ValueError('Unterminated string length '
+                                 'at {} position.'.format(i))
+            start = colon + 1
+            end = start + int(data[i:colon])
+            if end > len(data):
+                raise ValueError('String at {} position is longer than '
+                                 'the data.'.format(i))
+            i = end
+            add(view[start:end].tobytes(), i)
         else:
             raise ValueError('Unsupported syntax detected '
                              'at {} position.'.format(i))
-        l.append(value)
-        i += length + 2
-    return l, i
+    # Unterminated containers at the end of the data are accepted, as they
+    # always were.
+    while stack:
+        add(close(), len(data))
+    return values, span
 
 
-def decode_integer(data):
-    delimeter_pos = data.find(ENDING_DELIMETER)
-    return int(data[:delimeter_pos]), delimeter_pos
+def encode(data):
+    buffer = bytearray()
+    encode_into(data, buffer)
+    return bytes(buffer)
 
 
-def decode_dict(data):
-    d = {}
-    l, length = decode_list(data)
-    if len(l) % 2 != 0:
-        raise ValueError('Dictionary must consist of pairs.')
-    for i in range(0, len(l), 2):
-        key = l[i]
-        if not isinstance(key, bytes):
-            raise ValueError('Dictionary keys must be strings.')
-        d[l[i]] = l[i+1]
-    return d, length
+def dump(data, file, flush_size=FLUSH_SIZE):
+    # Streams the encoding to a file or socket writer. The buffer is
+    # handed over whenever it grows past flush_size, and long strings go to
+    # the writer directly instead of being copied into the buffer.
+    buffer = bytearray()
 
+    def write(string):
+        if buffer:
+            file.write(bytes(buffer))
+            buffer.clear()
+        if string is not None:
+            file.write(string)
 
-def decode_string(data):
-    delimeter_pos = data.find(STR_DELIMETER)
-    bytes_to_read = int(data[:delimeter_pos])
-    start = delimeter_pos + 1
-    length = start + bytes_to_read
-    decoded_data = data[start:length]
-    return decoded_data, length - 2
+    encode_into(data, buffer, write, flush_size)
+    write(None)
 
 
-def encode(data):
+def encode_into(data, buffer, write=None, flush_size=FLUSH_SIZE):
     if isinstance(data, int):
-        encoded_data = encode_int(data)
-    elif isinstance(data, bytes):
-        encoded_data = encode_string(data)
+        buffer += INT_DELIMETER
+        buffer += int_to_bytes(data)
+        buffer += ENDING_DELIMETER
+    elif isinstance(data, (bytes, bytearray, memoryview)):
+        buffer += int_to_bytes(len(data))
+        buffer += STR_DELIMETER
+        if write is not None and len(data) >= flush_size:
+            write(data)
+        else:
+            buffer += data
     elif isinstance(data, list):
-        encoded_data = encode_list(data)
+        buffer += LIST_DELIMETER
+        for e in data:
+            encode_into(e, buffer, write, flush_size)
+        buffer += ENDING_DELIMETER
     elif isinstance(data, dict):
-        encoded_data = encode_dict(data)
+        buffer += DICT_DELIMETER
+        for k in sorted(data):
+            if not isinstance(k, bytes):
+                raise TypeError('Dict keys must be byte strings.')
+            encode_into(k, buffer)
+            encode_into(data[k], buffer, write, flush_size)
+        buffer += ENDING_DELIMETER
     else:
         raise TypeError('Unsupported data type.')
-    return encoded_data
-
-
-def encode_int(int_):
-    return INT_DELIMETER + int_to_bytes(int_) + ENDING_DELIMETER
-
-
-def encode_string(string):
-    return int_to_bytes(len(string)) + STR_DELIMETER + string
-
-
-def encode_list(list_):
-    encoded_data = LIST_DELIMETER
-    for e in list_:
-        encoded_data += encode(e)
-    return encoded_data + ENDING_DELIMETER
-
-
-def encode_dict(dict_):
-    encoded_data = DICT_DELIMETER
-    for k, v in dict_.items():
-        if not isinstance(k, bytes):
-            raise TypeError('Dict keys must be byte strings.')
-        encoded_data += encode(k) + encode(v)
-    return encoded_data + ENDING_DELIMETER
+    if write is not None and len(buffer) >= flush_size:
+        write(None)
 
 
 def int_to_bytes(int_):
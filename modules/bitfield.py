@@ -0,0 +1,74 @@
+import re
+
+NONZERO_BYTE = re.compile(b'[^\x00]')
+
+
+class Bitfield:
+    __slots__ = ('length', 'data')
+
+    def __init__(self, length, data=b''):
+        self.length = length
+        size = (length + 7) // 8
+        self.data = bytearray(data[:size])
+        self.data.extend(bytes(size - len(self.data)))
+        # Spare bits after the last piece must stay clear, or counting and
+        # iteration would report pieces that do not exist.
+        if length % 8:
+            self.data[-1] &= 0xff << (8 - length % 8) & 0xff
+
+    def __contains__(self, index):
+        return (0 <= index < self.length and
+                self.data[index >> 3] & 0x80 >> (index & 7) != 0)
+
+    def add(self, index):
+        self.data[index >> 3] |= 0x80 >> (index & 7)
+
+    def discard(self, index):
+        self.data[index >> 3] &= ~(0x80 >> (index & 7)) & 0xff
+
+    def update(self, indices):
+        if isinstance(indices, Bitfield):
+            self.data = bytearray((self.to_int() | indices.to_int()).to_bytes(
+                len(self.data), byteorder='big'))
+            return
+        for index in indices:
+            self.add(index)
+
+    @classmethod
+    def from_int(cls, length, value):
+        return cls(length, value.to_bytes((length + 7) // 8, byteorder='big'))
+
+    def difference(self, other):
+        # Pieces set here and not in other, e.g. the interesting pieces of a
+        # peer are difference(our have-set).
+        return Bitfield.from_int(self.length,
+                                 self.to_int() & ~other.to_int())
+
+    def count(self):
+        return self.to_int().bit_count()
+
+    def all(self):
+        return self.count() == self.length
+
+    def to_int(self):
+        return int.from_bytes(self.data, byteorder='big')
+
+    def to_bytes(self):
+        return bytes(self.data)
+
+    def copy(self):
+        return Bitfield(self.length, self.data)
+
+    def __iter__(self):
+        # Empty bytes are skipped by the regex engine, so a sparse field
+        # costs a scan in C rather than a Python loop over every byte.
+        data = self.data
+        for match in NONZERO_BYTE.finditer(data):
+            i = match.start()
+            byte = data[i]
+            for bit in range(8):
+                if byte & 0x80 >> bit:
+                    yield i * 8 + bit
+
+    def __bool__(self):
+        return any(self.data)
@@ -0,0 +1,80 @@
+import random
+import time
+
+CHOKE_INTERVAL = 10
+UPLOAD_SLOTS = 4
+OPTIMISTIC_ROUNDS = 3
+NEW_PEER_TIME = 60
+NEW_PEER_WEIGHT = 3
+
+
+class Choker:
+    def __init__(self, slots=UPLOAD_SLOTS):
+        self.slots = slots
+        self.optimistic = None
+        self.rounds = 0
+        self.choked = 0
+        self.counters = {}
+
+    def update(self, conns, seeding):
+        if time.time() - self.choked >= CHOKE_INTERVAL:
+            self.choke(conns, seeding)
+        else:
+            self.fill_slots(conns)
+
+    def choke(self, conns, seeding):
+        # Peers are ranked by what they gave us since the last round: the
+        # download rate while leeching, our upload rate to them when
+        # seeding, so seeds spread data to those who take it fastest.
+        self.choked = time.time()
+        conns = [conn for conn in conns if not conn.broken and conn.peer_id]
+        transferred = {conn: self.get_transferred(conn, seeding)
+                       for conn in conns}
+        self.counters = {conn: (conn.downloaded, conn.uploaded)
+                         for conn in conns}
+        interested = [conn for conn in conns if conn.interested]
+        interested.sort(key=lambda conn: transferred[conn], reverse=True)
+        regular = set(interested[:self.slots])
+        if (self.rounds % OPTIMISTIC_ROUNDS == 0 or
+                self.optimistic not in interested or
+                self.optimistic in regular):
+            self.optimistic = self.pick_optimistic(
+                [conn for conn in interested if conn not in regular])
+        self.rounds += 1
+        unchoked = regular | {self.optimistic} - {None}
+        for conn in conns:
+            if conn in unchoked:
+                if conn.am_choking:
+                    conn.send_unchoke()
+            elif not conn.am_choking:
+                conn.send_choke()
+
+    def fill_slots(self, conns):
+        # Between rounds, free slots go to peers that just became
+        # interested without choking anyone.
+        unchoked = [conn for conn in conns if not conn.broken and
+                    not conn.am_choking and conn.interested]
+        free = self.slots + 1 - len(unchoked)
+        for conn in conns:
+            if free <= 0:
+                break
+            if (not conn.broken and conn.peer_id and conn.interested and
+                    conn.am_choking):
+                conn.send_unchoke()
+                free -= 1
+
+    def get_transferred(self, conn, seeding):
+        downloaded, uploaded = self.counters.get(conn, (0, 0))
+        if seeding:
+            return conn.uploaded - uploaded
+        return conn.downloaded - downloaded
+
+    def pick_optimistic(self, candidates):
+        # Newly connected peers have nothing to reciprocate with yet, so
+        # they get a better chance at the optimistic slot.
+        if not candidates:
+            return None
+        now = time.time()
+        weights = [NEW_PEER_WEIGHT if now - conn.connected < NEW_PEER_TIME
+                   else 1 for conn in candidates]
+        return random.choices(candidates, weights)[0]
@@ -1,31 +1,107 @@
+import asyncio
 import os
-from threading import Thread, Lock
+from threading import Thread
 
-from modules.torrent import Torrent
+from modules.dht import DHTNode, NODES_FILE
+from modules.meter import TrafficMeter
+from modules.peers import GLOBAL_MAX_PEERS, PeerLimit
+from modules.ratelimit import TokenBucket
+from modules.torrent import Torrent, PORT, STORAGE
+from modules.tracker import Scraper
+from modules.pwp import messages
+from modules.pwp.connection import HANDSHAKE_TIMEOUT
 
 DOWNLOAD_DIR = 'downloads'
 TORRENT_DIR = 'torrents'
+SCRAPE_INTERVAL = 60
 
 
 class Client:
-    def __init__(self):
+    def __init__(self, torrent_dir=TORRENT_DIR, download_dir=DOWNLOAD_DIR,
+                 port=PORT, storages=None, dht=True,
+                 max_peers=GLOBAL_MAX_PEERS):
+        self.torrent_dir = torrent_dir
+        self.download_dir = download_dir
+        self.port = port
+        self.storages = storages or {}
+        self.upload_bucket = TokenBucket()
+        self.download_bucket = TokenBucket()
+        self.peer_limit = PeerLimit(max_peers)
+        self.meter = TrafficMeter()
+        self.dht = None
+        if dht:
+            self.dht = DHTNode(port, download_dir + '/' + NODES_FILE)
         self.torrents = self.get_torrents()
+        self.scraper = Scraper()
         self.running = True
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = Thread(target=self.loop.run_forever)
+        self.loop_thread.daemon = True
+        self.loop_thread.start()
+        self.server = self.run(self.listen()).result()
+        self.run(self.scrape_torrents())
+        if self.dht is not None:
+            self.run(self.dht.start()).result()
+            self.run(self.dht.run())
+
+    async def listen(self):
+        return await asyncio.start_server(self.accept_connection,
+                                          port=self.port)
+
+    async def accept_connection(self, reader, writer):
+        try:
+            data = await asyncio.wait_for(
+                reader.readexactly(messages.get_handshake_length()),
+                HANDSHAKE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError):
+            writer.close()
+            return
+        handshake = messages.get_handshake(data)
+        torrent = self.get_torrent(handshake)
+        if torrent is None:
+            writer.close()
+            return
+        try:
+            await torrent.accept_connection(reader, writer, handshake)
+        except asyncio.CancelledError:
+            # The stream server callback fails on cancelled handlers.
+            pass
+
+    async def scrape_torrents(self):
+        while True:
+            await self.scraper.scrape(
+                [(torrent.announcer.trackers.get_tracker(), torrent.info_hash)
+                 for torrent in self.torrents])
+            await asyncio.sleep(SCRAPE_INTERVAL)
+
+    def get_torrent(self, handshake):
+        if handshake is None:
+            return None
+        for torrent in self.torrents:
+            if torrent.info_hash == handshake['info_hash'] and torrent.active:
+                return torrent
+        return None
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
 
     def get_torrents(self):
         torrents = []
-        os.makedirs(TORRENT_DIR, exist_ok=True)
-        for entry in os.listdir(TORRENT_DIR):
+        os.makedirs(self.torrent_dir, exist_ok=True)
+        for entry in os.listdir(self.torrent_dir):
             if entry.endswith('.torrent'):
-                torrents.append(Torrent(entry, TORRENT_DIR, DOWNLOAD_DIR))
+                torrents.append(Torrent(entry, self.torrent_dir,
+                                        self.download_dir, self.port,
+                                        self.storages.get(entry, STORAGE),
+                                        self.dht, self.upload_bucket,
+                                        self.download_bucket,
+                                        peer_limit=self.peer_limit,
+                                        meter=self.meter))
         return torrents
 
     def change_torrent_status(self, number, files_nums=None):
         def start_torrent(index, files_indices):
-            t = Thread(target=self.torrents[index].start,
-                       args=(files_indices,))
-            t.daemon = True
-            t.start()
+            self.run(self.torrents[index].start(files_indices))
 
         index = number - 1
         if self.torrents[index].active:
@@ -37,11 +113,43 @@ class Client:
                 files_indices = None
             start_torrent(index, files_indices)
 
+    def recheck_torrent(self, number):
+        self.run(self.torrents[number - 1].recheck())
+
+    def set_rate_limit(self, direction, rate, number=None):
+        owner = self if number is None else self.torrents[number - 1]
+        bucket = {'up': owner.upload_bucket,
+                  'down': owner.download_bucket}[direction]
+        # Buckets are used by the loop thread only.
+        self.loop.call_soon_threadsafe(bucket.set_rate, rate)
+
+    def get_rate_limits(self):
+        return {'up': self.upload_bucket.rate,
+                'down': self.download_bucket.rate}
+
+    def get_rates(self):
+        return {'up': self.meter.upload.get_rate(),
+                'down': self.meter.download.get_rate(),
+                'overhead': self.meter.overhead.get_rate()}
+
     def exit(self):
+        async def stop():
+            self.server.close()
+            tasks = [task for task in asyncio.all_tasks()
+                     if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for torrent in self.torrents:
+                torrent.active = False
+                await torrent.save_state()
+            if self.dht is not None:
+                self.dht.stop()
+
         self.running = False
-        for torrent in self.torrents:
-            torrent.active = False
-            torrent.save_state()
+        self.run(stop()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
 
     def get_torrents_info(self):
         def convert_bytes(bytes_, power):
@@ -53,16 +161,34 @@ class Client:
         def to_mb(bytes_):
             return convert_bytes(bytes_, 20)
 
+        def get_swarm(torrent):
+            stats = self.scraper.get(torrent.info_hash)
+            if stats:
+                return stats['complete'], stats['incomplete']
+            tracker = torrent.announcer.trackers.get_tracker()
+            if tracker is None:
+                return 0, 0
+            return tracker.complete, tracker.incomplete
+
         torrents_info = []
         for index, torrent in enumerate(self.torrents):
+            seeders, leechers = get_swarm(torrent)
             torrents_info.append({'number': index + 1,
                                   'name': torrent.name,
                                   'active': torrent.active,
                                   'completed': torrent.completed,
                                   'length': to_mb(torrent.files.total_length),
                                   'peers': torrent.get_num_of_active_peers(),
+                                  'seeders': seeders,
+                                  'leechers': leechers,
                                   'uploaded': to_mb(torrent.uploaded),
                                   'downloaded': to_mb(torrent.downloaded),
-                                  'speed': to_kb(torrent.speed),
+                                  'speed': to_kb(
+                                      torrent.meter.download.get_rate()),
+                                  'upload_speed': to_kb(
+                                      torrent.meter.upload.get_rate()),
+                                  'checking': torrent.checking,
+                                  'checking_speed': to_mb(
+                                      torrent.checking_speed),
                                   'files': torrent.files.files})
         return torrents_info
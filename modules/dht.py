@@ -0,0 +1,413 @@
+import asyncio
+import heapq
+import os
+import random
+import socket
+import time
+from hashlib import sha1
+
+from modules import bencode
+
+
+K = 8
+ALPHA = 3
+ID_LENGTH = 20
+NODE_LENGTH = 26
+QUERY_TIMEOUT = 5
+MAX_FAILS = 2
+NODE_TIMEOUT = 15 * 60
+REFRESH_INTERVAL = 15 * 60
+TOKEN_INTERVAL = 5 * 60
+PEER_TTL = 30 * 60
+MAX_VALUES = 100
+NODES_FILE = 'dht.dat'
+BOOTSTRAP_NODES = [('router.bittorrent.com', 6881),
+                   ('dht.transmissionbt.com', 6881),
+                   ('router.utorrent.com', 6881)]
+
+ERROR_GENERIC = 201
+ERROR_PROTOCOL = 203
+ERROR_METHOD = 204
+
+
+class KRPCError(Exception):
+    pass
+
+
+def get_distance(a, b):
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+
+def make_node(node_id, address, seen=0):
+    return {'id': node_id, 'address': address, 'seen': seen, 'fails': 0}
+
+
+def encode_address(address):
+    return socket.inet_aton(address[0]) + address[1].to_bytes(2, 'big')
+
+
+def decode_address(data):
+    return socket.inet_ntoa(data[:4]), int.from_bytes(data[4:6], 'big')
+
+
+def encode_nodes(nodes):
+    return b''.join(node['id'] + encode_address(node['address'])
+                    for node in nodes)
+
+
+def decode_nodes(data):
+    if not isinstance(data, bytes):
+        return []
+    return [make_node(data[i:i + ID_LENGTH],
+                      decode_address(data[i + ID_LENGTH:i + NODE_LENGTH]))
+            for i in range(0, len(data) - len(data) % NODE_LENGTH,
+                           NODE_LENGTH)]
+
+
+def decode_peers(values):
+    if not isinstance(values, list):
+        return []
+    return [decode_address(value) for value in values
+            if isinstance(value, bytes) and len(value) == 6]
+
+
+class RoutingTable:
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.buckets = [{'low': 0, 'high': 2**(8 * ID_LENGTH), 'nodes': []}]
+
+    def get_bucket(self, node_id):
+        value = int.from_bytes(node_id, 'big')
+        for bucket in self.buckets:
+            if bucket['low'] <= value < bucket['high']:
+                return bucket
+
+    def get_nodes(self):
+        return [node for bucket in self.buckets for node in bucket['nodes']]
+
+    def get(self, node_id):
+        for node in self.get_bucket(node_id)['nodes']:
+            if node['id'] == node_id:
+                return node
+        return None
+
+    def add(self, node):
+        if node['id'] == self.node_id or len(node['id']) != ID_LENGTH:
+            return False
+        bucket = self.get_bucket(node['id'])
+        for known in bucket['nodes']:
+            if known['id'] == node['id']:
+                known.update(address=node['address'],
+                             seen=max(known['seen'], node['seen']), fails=0)
+                return True
+        if len(bucket['nodes']) < K:
+            bucket['nodes'].append(node)
+            return True
+        if bucket is self.get_bucket(self.node_id):
+            self.split(bucket)
+            return self.add(node)
+        # Far buckets are not split; a node only takes the place of one
+        # that has not been heard from for a while.
+        oldest = min(bucket['nodes'], key=lambda known: known['seen'])
+        if time.time() - oldest['seen'] > NODE_TIMEOUT:
+            bucket['nodes'].remove(oldest)
+            bucket['nodes'].append(node)
+            return True
+        return False
+
+    def split(self, bucket):
+        middle = (bucket['low'] + bucket['high']) // 2
+        low = {'low': bucket['low'], 'high': middle, 'nodes': []}
+        high = {'low': middle, 'high': bucket['high'], 'nodes': []}
+        for node in bucket['nodes']:
+            if int.from_bytes(node['id'], 'big') < middle:
+                low['nodes'].append(node)
+            else:
+                high['nodes'].append(node)
+        index = self.buckets.index(bucket)
+        self.buckets[index:index + 1] = [low, high]
+
+    def fail(self, node_id):
+        node = self.get(node_id)
+        if node is None:
+            return
+        node['fails'] += 1
+        if node['fails'] >= MAX_FAILS:
+            self.get_bucket(node_id)['nodes'].remove(node)
+
+    def closest(self, target, count=K):
+        return heapq.nsmallest(count, self.get_nodes(),
+                               key=lambda node: get_distance(node['id'],
+                                                             target))
+
+
+class DHTNode(asyncio.DatagramProtocol):
+    def __init__(self, port, path=None, bootstrap=BOOTSTRAP_NODES,
+                 timeout=QUERY_TIMEOUT):
+        self.port = port
+        self.path = path
+        self.bootstrap_nodes = bootstrap
+        self.timeout = timeout
+        self.node_id, nodes = self.load_nodes()
+        self.table = RoutingTable(self.node_id)
+        for node in nodes:
+            self.table.add(node)
+        self.transport = None
+        self.transactions = {}
+        self.transaction_id = random.getrandbits(16)
+        self.peers = {}
+        self.secrets = [os.urandom(20), os.urandom(20)]
+        self.secret_rotated = time.time()
+
+    async def start(self, host='0.0.0.0'):
+        loop = asyncio.get_running_loop()
+        self.transport, protocol = await loop.create_datagram_endpoint(
+            lambda: self, local_addr=(host, self.port))
+        self.port = self.transport.get_extra_info('sockname')[1]
+
+    def stop(self):
+        if self.transport is None:
+            return
+        self.save_nodes()
+        self.transport.close()
+        self.transport = None
+        for future, address in self.transactions.values():
+            future.cancel()
+
+    async def run(self):
+        while True:
+            await self.bootstrap()
+            self.expire_peers()
+            self.save_nodes()
+            await asyncio.sleep(REFRESH_INTERVAL)
+
+    async def bootstrap(self):
+        # Routers are only asked when the table knows too few nodes to
+        # find the rest by itself.
+        if len(self.table.get_nodes()) < K:
+            loop = asyncio.get_running_loop()
+            for host, port in self.bootstrap_nodes:
+                try:
+                    infos = await loop.getaddrinfo(host, port,
+                                                   family=socket.AF_INET,
+                                                   type=socket.SOCK_DGRAM)
+                    await self.query(infos[0][4], 'find_node',
+                                     {b'target': self.node_id})
+                except (OSError, KRPCError, asyncio.TimeoutError):
+                    continue
+        await self.lookup(self.node_id, 'find_node')
+        await self.lookup(os.urandom(ID_LENGTH), 'find_node')
+
+    async def get_peers(self, info_hash, announce_port=None):
+        peers, closest = await self.lookup(info_hash, 'get_peers')
+        if announce_port is not None:
+            await asyncio.gather(*[
+                self.query(node['address'], 'announce_peer',
+                           {b'info_hash': info_hash, b'port': announce_port,
+                            b'token': token})
+                for node, token in closest if token],
+                return_exceptions=True)
+        return [{'ip': ip, 'port': port} for ip, port in peers]
+
+    async def lookup(self, target, method):
+        # The closest known nodes are queried ALPHA at a time, and the
+        # nodes they return are queried in turn until the K closest have
+        # all been asked.
+        def distance(node):
+            return get_distance(node['id'], target)
+
+        key = b'target' if method == 'find_node' else b'info_hash'
+        candidates = {node['id']: node for node in self.table.closest(target)}
+        queried = set()
+        responded = []
+        peers = set()
+        while True:
+            closest = heapq.nsmallest(K, candidates.values(), key=distance)
+            pending = [node for node in closest
+                       if node['id'] not in queried][:ALPHA]
+            if not pending:
+                break
+            queried.update(node['id'] for node in pending)
+            results = await asyncio.gather(*[
+                self.query(node['address'], method, {key: target})
+                for node in pending], return_exceptions=True)
+            for node, result in zip(pending, results):
+                if isinstance(result, BaseException):
+                    del candidates[node['id']]
+                    self.table.fail(node['id'])
+                    continue
+                token = result.get(b'token')
+                responded.append((node, token if isinstance(token, bytes)
+                                  else None))
+                for found in decode_nodes(result.get(b'nodes')):
+                    if found['id'] != self.node_id:
+                        candidates.setdefault(found['id'], found)
+                peers.update(decode_peers(result.get(b'values')))
+        responded.sort(key=lambda response: distance(response[0]))
+        return peers, responded[:K]
+
+    async def query(self, address, method, args):
+        if self.transport is None:
+            raise KRPCError(ERROR_GENERIC, 'Node is not running.')
+        self.transaction_id = (self.transaction_id + 1) % 2**16
+        transaction_id = self.transaction_id.to_bytes(2, 'big')
+        future = asyncio.get_running_loop().create_future()
+        self.transactions[transaction_id] = (future, address)
+        args = dict(args)
+        args[b'id'] = self.node_id
+        self.send(address, {b't': transaction_id, b'y': b'q',
+                            b'q': method.encode(), b'a': args})
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self.transactions.pop(transaction_id, None)
+
+    def send(self, address, message):
+        if self.transport is not None:
+            self.transport.sendto(bencode.encode(message), address)
+
+    def datagram_received(self, data, address):
+        try:
+            message = bencode.decode(data)[0]
+            kind = message[b'y']
+        except (ValueError, KeyError, TypeError, IndexError):
+            return
+        if kind == b'q':
+            self.handle_query(message, address)
+        elif kind in (b'r', b'e'):
+            self.handle_response(message, address)
+
+    def handle_response(self, message, address):
+        transaction_id = message.get(b't')
+        if not isinstance(transaction_id, bytes):
+            return
+        future, expected = self.transactions.get(transaction_id,
+                                                 (None, None))
+        if future is None or future.done() or expected != address:
+            return
+        if message[b'y'] == b'e':
+            error = message.get(b'e', [])
+            if not isinstance(error, list):
+                error = [ERROR_PROTOCOL, 'Invalid error.']
+            future.set_exception(KRPCError(*error))
+            return
+        response = message.get(b'r')
+        if (not isinstance(response, dict) or
+                not self.is_id(response.get(b'id'))):
+            future.set_exception(KRPCError(ERROR_PROTOCOL,
+                                           'Invalid response.'))
+            return
+        self.table.add(make_node(response[b'id'], address, time.time()))
+        future.set_result(response)
+
+    def handle_query(self, message, address):
+        handlers = {b'ping': self.handle_ping,
+                    b'find_node': self.handle_find_node,
+                    b'get_peers': self.handle_get_peers,
+                    b'announce_peer': self.handle_announce_peer}
+        # Only bytes can be looked up; anything else from the network is
+        # answered with a protocol error.
+        transaction_id = message.get(b't', b'')
+        method = message.get(b'q')
+        args = message.get(b'a')
+        try:
+            if not isinstance(transaction_id, bytes):
+                transaction_id = b''
+                raise KRPCError(ERROR_PROTOCOL, 'Invalid query.')
+            if not isinstance(method, bytes):
+                raise KRPCError(ERROR_PROTOCOL, 'Invalid query.')
+            if not isinstance(args, dict) or not self.is_id(args.get(b'id')):
+                raise KRPCError(ERROR_PROTOCOL, 'Invalid arguments.')
+            handler = handlers.get(method)
+            if handler is None:
+                raise KRPCError(ERROR_METHOD, 'Method Unknown')
+            response = handler(args, address)
+        except KRPCError as e:
+            self.send(address, {b't': transaction_id, b'y': b'e',
+                                b'e': [e.args[0], e.args[1].encode()]})
+            return
+        self.table.add(make_node(args[b'id'], address, time.time()))
+        response[b'id'] = self.node_id
+        self.send(address, {b't': transaction_id, b'y': b'r',
+                            b'r': response})
+
+    def handle_ping(self, args, address):
+        return {}
+
+    def handle_find_node(self, args, address):
+        target = args.get(b'target')
+        if not self.is_id(target):
+            raise KRPCError(ERROR_PROTOCOL, 'Invalid target.')
+        return {b'nodes': encode_nodes(self.table.closest(target))}
+
+    def handle_get_peers(self, args, address):
+        info_hash = args.get(b'info_hash')
+        if not self.is_id(info_hash):
+            raise KRPCError(ERROR_PROTOCOL, 'Invalid info_hash.')
+        response = {b'token': self.get_tokens(address[0])[0]}
+        now = time.time()
+        values = [encode_address(peer) for peer, expires
+                  in self.peers.get(info_hash, {}).items() if expires > now]
+        if values:
+            response[b'values'] = random.sample(values,
+                                                min(len(values), MAX_VALUES))
+        else:
+            response[b'nodes'] = encode_nodes(self.table.closest(info_hash))
+        return response
+
+    def handle_announce_peer(self, args, address):
+        info_hash = args.get(b'info_hash')
+        port = args.get(b'port')
+        if args.get(b'implied_port') == 1:
+            port = address[1]
+        if (not self.is_id(info_hash) or not isinstance(port, int) or
+                not 0 < port < 2**16):
+            raise KRPCError(ERROR_PROTOCOL, 'Invalid arguments.')
+        if args.get(b'token') not in self.get_tokens(address[0]):
+            raise KRPCError(ERROR_PROTOCOL, 'Bad token')
+        self.peers.setdefault(info_hash, {})[(address[0], port)] = (
+            time.time() + PEER_TTL)
+        return {}
+
+    def get_tokens(self, ip):
+        # Tokens of the previous secret stay valid, so a token lives
+        # between one and two TOKEN_INTERVALs.
+        if time.time() - self.secret_rotated >= TOKEN_INTERVAL:
+            self.secrets = [os.urandom(20), self.secrets[0]]
+            self.secret_rotated = time.time()
+        return [sha1(secret + ip.encode()).digest()
+                for secret in self.secrets]
+
+    def is_id(self, value):
+        return isinstance(value, bytes) and len(value) == ID_LENGTH
+
+    def expire_peers(self):
+        now = time.time()
+        for info_hash in list(self.peers):
+            peers = {peer: expires for peer, expires
+                     in self.peers[info_hash].items() if expires > now}
+            if peers:
+                self.peers[info_hash] = peers
+            else:
+                del self.peers[info_hash]
+
+    def load_nodes(self):
+        try:
+            with open(self.path, 'rb') as f:
+                state = bencode.decode(f.read())[0]
+            node_id = state[b'id']
+            nodes = decode_nodes(state[b'nodes'])
+        except (TypeError, IOError, ValueError, IndexError, KeyError):
+            return os.urandom(ID_LENGTH), []
+        if not self.is_id(node_id):
+            return os.urandom(ID_LENGTH), []
+        return node_id, nodes
+
+    def save_nodes(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'wb') as f:
+            bencode.dump({b'id': self.node_id,
+                          b'nodes': encode_nodes(self.table.get_nodes())}, f)
+        os.replace(self.path + '.tmp', self.path)
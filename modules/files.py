@@ -1,54 +1,140 @@
+import mmap
 import os
 import pickle
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from hashlib import sha1
+
+from modules import bencode
+from modules.bitfield import Bitfield
 
 
 BLOCK_SIZE = 16384
+PREALLOCATE = 'sparse'
+SYNC_INTERVAL = 30
+SYNC_BYTES = 2**26
+RESUME_FILE = 'resume.dat'
+LEGACY_BITFIELD_FILE = 'bitfield.pickle'
 
 
 class Files:
-    def __init__(self, info, root_dir):
+    def __init__(self, info, root_dir, preallocate=PREALLOCATE,
+                 info_hash=None):
         self.info = info
         self.root_dir = root_dir
+        self.preallocate = preallocate
+        self.lock = threading.RLock()
+        self.resume_lock = threading.Lock()
+        self.unsynced = set()
+        self.unsynced_bytes = 0
+        self.synced = time.time()
+        self.unverified = set()
+        self.partial = {}
+        # Torrents pass the hash of the info dict as it is in the file;
+        # re-encoding it would change the hash of unsorted keys.
+        self.info_hash = info_hash or sha1(bencode.encode(info)).digest()
         self.mode = self.get_mode()
-        self.hashes = self.get_hashes()
-        self.piece_num = len(self.hashes)
+        self.hashes = self.info[b'pieces']
+        self.piece_num = len(self.hashes) // 20
         self.files = self.get_files(root_dir)
+        self.offsets = self.get_offsets()
         self.total_length = self.get_total_length()
         self.piece_length = self.info[b'piece length']
-        self.pieces = self.get_pieces()
-        self.pieces_belonging = self.get_pieces_belonging()
+        self.have = Bitfield(self.piece_num)
+        self.restore_resume()
 
     def get_mode(self):
         return 'multiple' if b'files' in self.info else 'single'
 
-    def get_hashes(self):
-        str_ = self.info[b'pieces']
-        return [str_[i:i+20] for i in range(0, len(str_), 20)]
-
     def get_bitfield(self):
-        bitfield = self.get_binary_bitfield()
-        while len(bitfield) % 8 != 0:
-            bitfield += '0'
-        return int(bitfield, 2).to_bytes(len(bitfield) // 8, byteorder='big')
+        return self.have.to_bytes()
 
-    def save_bitfield(self):
-        with open(self.root_dir + '/bitfield.pickle', 'wb') as f:
-            pickle.dump(self.get_binary_bitfield(), f)
+    def save_resume(self, partial=()):
+        # Saves may come from several threads and share the temporary file.
+        with self.resume_lock:
+            self.write_resume(partial)
 
-    def get_binary_bitfield(self):
-        return ''.join(['1' if piece['have'] else '0'
-                       for piece in self.pieces])
+    def write_resume(self, partial):
+        # Blocks of unfinished pieces are only in memory, so they are
+        # written out as well and recorded in per-piece bitmaps.
+        bitmaps = []
+        for index, data, received in partial:
+            view = memoryview(data)
+            blocks = self.get_blocks(index)
+            for i in received:
+                begin, length = blocks[i]
+                self.write_block(index, begin, view[begin:begin + length])
+            bitmaps.append([index, received.to_bytes()])
+        self.sync()
+        with self.lock:
+            unverified = Bitfield(self.piece_num)
+            unverified.update(self.unverified)
+            resume = {b'files': [list(self.get_stat(file['fd']))
+                                 for file in self.files],
+                      b'info_hash': self.info_hash,
+                      b'partial': bitmaps,
+                      b'pieces': self.get_bitfield(),
+                      b'unverified': unverified.to_bytes()}
+        path = self.get_resume_path()
+        with open(path + '.tmp', 'wb') as f:
+            bencode.dump(resume, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
 
-    def restore_bitfield(self):
+    def restore_resume(self):
         try:
-            raw_bitfiled = self.read_bitfield()
-        except IOError:
-            return [False] * self.piece_num
-        return [i == '1' for i in raw_bitfiled]
+            with open(self.get_resume_path(), 'rb') as f:
+                resume = bencode.decode(f.read())[0]
+            have = Bitfield(self.piece_num, resume[b'pieces'])
+            unverified = Bitfield(self.piece_num, resume[b'unverified'])
+            stats = [tuple(stat) for stat in resume[b'files']]
+        except (IOError, ValueError, IndexError, KeyError, TypeError):
+            self.restore_legacy_bitfield()
+            return
+        if (resume[b'info_hash'] != self.info_hash or
+                len(stats) != len(self.files)):
+            return
+        # Pieces of files changed since the resume data was written are
+        # hashed again before they are trusted.
+        changed = {id(file) for file, stat in zip(self.files, stats)
+                   if file['stat'] != stat}
+        self.have = have
+        self.unverified = set(unverified)
+        if changed:
+            for index in list(have):
+                if self.piece_in_files(index, changed):
+                    self.have.discard(index)
+                    self.unverified.add(index)
+        for index, bitmap in resume[b'partial']:
+            if (0 <= index < self.piece_num and
+                    index not in self.have and
+                    index not in self.unverified and
+                    not self.piece_in_files(index, changed)):
+                self.partial[index] = Bitfield(len(self.get_blocks(index)),
+                                               bitmap)
+
+    def restore_legacy_bitfield(self):
+        try:
+            with open(self.root_dir + '/' + LEGACY_BITFIELD_FILE, 'rb') as f:
+                bitfield = pickle.load(f)
+        except (IOError, pickle.UnpicklingError, EOFError):
+            return
+        self.unverified = {i for i, bit in enumerate(bitfield[:self.piece_num])
+                           if bit == '1'}
+
+    def get_resume_path(self):
+        return self.root_dir + '/' + RESUME_FILE
+
+    def get_stat(self, fd):
+        stat = os.fstat(fd)
+        return stat.st_size, stat.st_mtime_ns
 
-    def read_bitfield(self):
-        with open(self.root_dir + '/bitfield.pickle', 'rb') as f:
-            return pickle.load(f)
+    def piece_in_files(self, index, file_ids):
+        return any(id(file) in file_ids
+                   for file, pos, length in self.get_piece_spans(index))
 
     def download_files(self):
         for file in self.files:
@@ -59,8 +145,12 @@ class Files:
 
     def get_files(self, root_dir):
         def get_file(path, length):
-            return {'file': open('{}/{}'.format(root_dir, path), 'wb'),
-                    'path': path, 'length': length, 'skip': True}
+            fd = os.open('{}/{}'.format(root_dir, path),
+                         os.O_RDWR | os.O_CREAT, 0o644)
+            stat = self.get_stat(fd)
+            self.allocate(fd, length)
+            return {'fd': fd, 'path': path, 'length': length, 'skip': True,
+                    'stat': stat}
 
         def create_dir(name):
             os.makedirs('{}/{}'.format(root_dir, name), exist_ok=True)
@@ -81,100 +171,201 @@ class Files:
             files.append(get_file(get_path(path), file_info[b'length']))
         return files
 
+    def allocate(self, fd, length):
+        if not self.preallocate or os.fstat(fd).st_size >= length:
+            return
+        if self.preallocate == 'full' and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, length)
+                return
+            except OSError:
+                pass
+        os.ftruncate(fd, length)
+
+    def get_offsets(self):
+        offsets = array('q')
+        offset = 0
+        for file in self.files:
+            offsets.append(offset)
+            offset += file['length']
+        return offsets
+
     def get_total_length(self):
         if self.mode == 'multiple':
             return sum(file['length'] for file in self.files)
         return self.files[0]['length']
 
-    def get_pieces(self):
-        def get_blocks(piece_length):
-            blocks = []
-            for i in range(piece_length // BLOCK_SIZE):
-                blocks.append({'length': BLOCK_SIZE,
-                               'begin': BLOCK_SIZE * i})
-            left = piece_length % BLOCK_SIZE
-            if left:
-                blocks.append({'length': left,
-                               'begin': BLOCK_SIZE * len(blocks)})
-            return blocks
-
-        pieces = []
-        bitfield = self.restore_bitfield()
-        for i, h in enumerate(self.hashes):
-            if i == len(self.hashes) - 1:
-                blocks = get_blocks(self.get_last_piece_length())
-            else:
-                blocks = get_blocks(self.piece_length)
-            pieces.append({'hash': h, 'have': bitfield[i],
-                           'requested': None, 'blocks': blocks})
-        return pieces
-
     def get_last_piece_length(self):
         return self.total_length - (self.piece_num - 1) * self.piece_length
 
-    def get_pieces_belonging(self):
-        def get_info(index, left):
-            start_pos = 0
-            file_num = 0
-            while True:
-                next_start_pos = start_pos + self.files[file_num]['length']
-                if index < next_start_pos:
-                    break
-                start_pos = next_start_pos
-                file_num += 1
-            file_info = self.files[file_num]
-            begin = index - start_pos
-            length = min(next_start_pos - index, left)
-            return file_info, begin, length
-
-        pieces_belonging = []
-        index = 0
-        for piece in self.pieces:
-            piece_belonging = []
-            left = self.get_piece_length(piece)
-            while left > 0:
-                file_info, begin, length = get_info(index, left)
-                index += length
-                left -= length
-                piece_belonging.append({'file_info': file_info,
-                                        'begin': begin,
-                                        'length': length})
-            pieces_belonging.append(piece_belonging)
-        return pieces_belonging
+    def get_blocks(self, index):
+        length = self.get_piece_length(index)
+        return [(begin, min(BLOCK_SIZE, length - begin))
+                for begin in range(0, length, BLOCK_SIZE)]
+
+    def get_spans(self, offset, length):
+        # Piece layouts are not stored: the files holding a byte range are
+        # found by bisecting the file offsets.
+        spans = []
+        end = offset + length
+        i = bisect_right(self.offsets, offset) - 1
+        while offset < end:
+            file = self.files[i]
+            file_end = self.offsets[i] + file['length']
+            if offset < file_end:
+                span = min(end, file_end) - offset
+                spans.append((file, offset - self.offsets[i], span))
+                offset += span
+            i += 1
+        return spans
+
+    def get_piece_spans(self, index, begin=0, length=None):
+        if length is None:
+            length = self.get_piece_length(index) - begin
+        return self.get_spans(index * self.piece_length + begin, length)
 
     def piece_skip(self, index):
-        for piece_belonging in self.pieces_belonging[index]:
-            if piece_belonging['file_info']['skip']:
-                return True
-        return False
+        return any(file['skip']
+                   for file, pos, length in self.get_piece_spans(index))
 
-    def get_piece_length(self, piece):
-        return sum(block['length'] for block in piece['blocks'])
+    def get_piece_length(self, index):
+        if index == self.piece_num - 1:
+            return self.get_last_piece_length()
+        return self.piece_length
 
     def get_downloaded(self):
-        return sum(self.get_piece_length(piece) for piece in self.pieces
-                   if piece['have'])
+        downloaded = self.have.count() * self.piece_length
+        if self.piece_num - 1 in self.have:
+            downloaded += self.get_last_piece_length() - self.piece_length
+        return downloaded
 
     def write_piece(self, piece_index, data):
-        piece = self.pieces[piece_index]
-        if piece['have']:
-            return
+        # Only the caller that adds the piece to have may count it, as the
+        # background check may have found it on disk meanwhile.
+        if piece_index in self.have:
+            return False
+        self.write_block(piece_index, 0, data)
+        with self.lock:
+            if piece_index in self.have:
+                return False
+            self.have.add(piece_index)
+            self.unverified.discard(piece_index)
+        return True
+
+    def write_block(self, piece_index, begin, data):
+        view = memoryview(data)
+        fds = set()
         written = 0
-        for f in self.pieces_belonging[piece_index]:
-            self.write_data(f['file_info']['file'], f['begin'],
-                            data[written:written + f['length']])
-            written += f['length']
-        piece['have'] = True
+        for file, pos, length in self.get_piece_spans(piece_index, begin,
+                                                      len(view)):
+            self.write_data(file['fd'], pos, view[written:written + length])
+            fds.add(file['fd'])
+            written += length
+        # Pieces may be written from several verification threads.
+        with self.lock:
+            self.unsynced.update(fds)
+            self.unsynced_bytes += len(view)
+            if (self.unsynced_bytes >= SYNC_BYTES or
+                    time.time() - self.synced >= SYNC_INTERVAL):
+                self.sync()
+
+    def read_block(self, piece_index, begin, length):
+        return self.read_spans(self.get_piece_spans(piece_index, begin,
+                                                    length))
+
+    def read_pieces(self, first, count):
+        # Consecutive pieces are contiguous in the files, so a run of them
+        # is one large read per file.
+        length = (self.get_piece_length(first + count - 1) +
+                  (count - 1) * self.piece_length)
+        return self.read_spans(self.get_spans(first * self.piece_length,
+                                              length))
+
+    def read_spans(self, spans):
+        parts = [self.read_data(file['fd'], pos, length)
+                 for file, pos, length in spans]
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def set_pieces(self, valid):
+        with self.lock:
+            self.have = Bitfield(self.piece_num)
+            self.have.update(index for index, have in enumerate(valid)
+                             if have)
+            self.unverified.clear()
+            self.partial = {}
 
     def hash_is_correct(self, piece_index, hash_):
-        return self.hashes[piece_index] == hash_
+        return self.hashes[piece_index * 20:piece_index * 20 + 20] == hash_
+
+    def check_piece(self, piece_index):
+        data = self.read_block(piece_index, 0,
+                               self.get_piece_length(piece_index))
+        valid = self.hash_is_correct(piece_index, sha1(data).digest())
+        with self.lock:
+            self.unverified.discard(piece_index)
+            if piece_index in self.have:
+                return False
+            if valid:
+                self.have.add(piece_index)
+        return valid
 
-    def write_data(self, file, pos, data):
-        file.seek(pos)
-        file.write(data)
-        file.flush()
+    def write_data(self, fd, pos, data):
+        while data:
+            written = os.pwrite(fd, data, pos)
+            data = data[written:]
+            pos += written
+
+    def read_data(self, fd, pos, length):
+        return os.pread(fd, length, pos)
+
+    def sync(self):
+        with self.lock:
+            for fd in self.unsynced:
+                os.fsync(fd)
+            self.clear_unsynced()
+
+    def clear_unsynced(self):
+        self.unsynced.clear()
+        self.unsynced_bytes = 0
+        self.synced = time.time()
 
     def close_files(self):
+        self.sync()
         for file in self.files:
-            os.fsync(file['file'].fileno())
-            file['file'].close()
+            os.close(file['fd'])
+
+
+class MmapFiles(Files):
+    def __init__(self, info, root_dir, preallocate=PREALLOCATE,
+                 info_hash=None):
+        self.maps = {}
+        # A mapping can not reach past the end of the file, so files are
+        # always at least sparse allocated.
+        super().__init__(info, root_dir, preallocate or 'sparse', info_hash)
+
+    def allocate(self, fd, length):
+        super().allocate(fd, length)
+        if length:
+            self.maps[fd] = mmap.mmap(fd, length)
+
+    def write_data(self, fd, pos, data):
+        self.maps[fd][pos:pos + len(data)] = data
+
+    def read_data(self, fd, pos, length):
+        return memoryview(self.maps[fd])[pos:pos + length]
+
+    def sync(self):
+        with self.lock:
+            for fd in self.unsynced:
+                self.maps[fd].flush()
+            self.clear_unsynced()
+
+    def close_files(self):
+        super().close_files()
+        for map_ in self.maps.values():
+            map_.close()
+
+
+STORAGES = {'file': Files, 'mmap': MmapFiles}
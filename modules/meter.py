@@ -0,0 +1,65 @@
+import math
+import time
+
+RATE_TICK = 1
+RATE_PERIOD = 5
+ALPHA = 1 - math.exp(-RATE_TICK / RATE_PERIOD)
+
+
+class RateMeter:
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.total = 0
+        self.pending = 0
+        self.average = 0
+        self.weight = 0
+        self.tick = time.monotonic()
+        self.added = self.tick
+
+    def add(self, amount):
+        # Bytes are summed up the chain of meters and folded into the
+        # average at most once per tick, so this is cheap enough for every
+        # block.
+        now = time.monotonic()
+        meter = self
+        while meter is not None:
+            if now - meter.tick >= RATE_TICK:
+                meter.average, meter.weight, ticks = meter.get_average(now)
+                meter.pending = 0
+                meter.tick += ticks * RATE_TICK
+            meter.pending += amount
+            meter.total += amount
+            meter.added = now
+            meter = meter.parent
+
+    def get_average(self, now):
+        ticks = int((now - self.tick) / RATE_TICK)
+        if ticks <= 0:
+            return self.average, self.weight, 0
+        # Bytes since the last fold are spread evenly over the ticks up to
+        # the last addition; the idle ticks after it only decay the
+        # average.
+        busy = int((self.added - self.tick) / RATE_TICK) + 1
+        busy = min(ticks, max(1, busy))
+        sample = self.pending / (busy * RATE_TICK)
+        average = sample + (self.average - sample) * (1 - ALPHA) ** busy
+        average *= (1 - ALPHA) ** (ticks - busy)
+        weight = 1 - (1 - self.weight) * (1 - ALPHA) ** ticks
+        return average, weight, ticks
+
+    def get_rate(self):
+        # Reading leaves the meter as it is, so the UI thread may read
+        # meters that the event loop writes to. A young average is scaled
+        # by the weight of the ticks seen so far, so the rate is right from
+        # the first tick instead of ramping up.
+        average, weight, ticks = self.get_average(time.monotonic())
+        if not weight:
+            return 0
+        return average / weight
+
+
+class TrafficMeter:
+    def __init__(self, parent=None):
+        self.download = RateMeter(parent and parent.download)
+        self.upload = RateMeter(parent and parent.upload)
+        self.overhead = RateMeter(parent and parent.overhead)
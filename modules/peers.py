@@ -0,0 +1,175 @@
+import asyncio
+import time
+
+from modules.pwp.connection import MAX_HASHFAILS, Connection
+
+MAX_PEERS = 50
+GLOBAL_MAX_PEERS = 200
+MAX_CONNECTING = 8
+MAX_KNOWN_PEERS = 2000
+RECONNECT_DELAY = 30
+MAX_RECONNECT_DELAY = 30 * 60
+MAX_FAILURES = 5
+BAN_HASHFAILS = 2 * MAX_HASHFAILS
+BAN_TIME = 60 * 60
+
+
+class PeerLimit:
+    # Connection slots shared by all torrents; 0 means no limit.
+    def __init__(self, max_peers=GLOBAL_MAX_PEERS):
+        self.max_peers = max_peers
+        self.connected = 0
+
+    def has_room(self):
+        return not self.max_peers or self.connected < self.max_peers
+
+
+class PeerManager:
+    def __init__(self, torrent, max_peers=MAX_PEERS, limit=None):
+        self.torrent = torrent
+        self.max_peers = max_peers
+        self.limit = limit or PeerLimit(0)
+        self.peers = {}
+        self.hashfails = {}
+        self.penalties = {}
+        self.banned = {}
+
+    def add(self, ip, port):
+        address = (ip, port)
+        if (not port or address in self.peers or
+                len(self.peers) >= MAX_KNOWN_PEERS):
+            return
+        self.peers[address] = {'address': address, 'failures': 0,
+                               'retry': 0, 'transferred': 0, 'time': 0}
+
+    def update(self):
+        self.cleanup()
+        self.drop_duplicates()
+        self.connect()
+
+    def connect(self):
+        # Known peers are dialed best first, a few at a time, so a long
+        # peer list never turns into a burst of half-open connections.
+        conns = self.torrent.connections.values()
+        connecting = len([conn for conn in conns
+                          if not conn.peer_id and not conn.broken])
+        connected = set(self.torrent.connections)
+        connected.update(conn.address for conn in conns)
+        now = time.time()
+        candidates = [peer for address, peer in self.peers.items()
+                      if address not in connected and peer['retry'] <= now
+                      and not self.is_banned(address[0])]
+        candidates.sort(key=self.get_score, reverse=True)
+        for peer in candidates:
+            if connecting >= MAX_CONNECTING or not self.has_room():
+                break
+            self.open_connection(peer['address'])
+            connecting += 1
+
+    def open_connection(self, address):
+        conn = Connection(self.torrent)
+        self.add_connection(address, conn)
+        conn.task = asyncio.get_running_loop().create_task(
+            conn.initiate(*address))
+
+    def add_connection(self, key, conn):
+        self.torrent.connections[key] = conn
+        self.limit.connected += 1
+
+    def can_accept(self, ip):
+        return self.has_room() and not self.is_banned(ip)
+
+    def has_room(self):
+        return (len(self.torrent.connections) < self.max_peers and
+                self.limit.has_room())
+
+    def cleanup(self):
+        # Connections are kept until their task ends, so a closing socket
+        # still holds its slot.
+        for key, conn in list(self.torrent.connections.items()):
+            if conn.broken and (conn.task is None or conn.task.done()):
+                del self.torrent.connections[key]
+                self.limit.connected -= 1
+                self.update_peer(conn)
+
+    def update_peer(self, conn):
+        now = time.time()
+        if not conn.address or not conn.address[1]:
+            return
+        self.add(*conn.address)
+        peer = self.peers.get(conn.address)
+        if peer is None:
+            return
+        if not conn.peer_id:
+            # Unreachable peers are retried with exponential backoff and
+            # forgotten after a few attempts.
+            peer['failures'] += 1
+            if peer['failures'] > MAX_FAILURES:
+                del self.peers[conn.address]
+                return
+            peer['retry'] = now + min(
+                MAX_RECONNECT_DELAY,
+                RECONNECT_DELAY * 2**(peer['failures'] - 1))
+        else:
+            peer['failures'] = 0
+            peer['retry'] = now + RECONNECT_DELAY
+            peer['transferred'] += conn.downloaded + conn.uploaded
+            peer['time'] += now - conn.connected
+
+    def drop_duplicates(self):
+        # A peer we dialed may also have dialed us; the newer connection
+        # is dropped.
+        seen = set()
+        for conn in self.torrent.connections.values():
+            if conn.broken or not conn.peer_id:
+                continue
+            if conn.peer_id in seen:
+                conn.broken = True
+            seen.add(conn.peer_id)
+
+    def get_score(self, peer):
+        if not peer['time']:
+            return 0
+        rate = peer['transferred'] / peer['time']
+        return rate / 2**self.penalties.get(peer['address'][0], 0)
+
+    def add_hashfail(self, conn, senders=1):
+        # Only a peer that sent the whole piece is known to be bad; when
+        # several peers sent blocks of it, each just scores lower by its
+        # share.
+        ip = conn.address[0]
+        self.penalties[ip] = self.penalties.get(ip, 0) + 1 / senders
+        if senders > 1:
+            return
+        conn.add_hashfail()
+        self.hashfails[ip] = self.hashfails.get(ip, 0) + 1
+        if self.hashfails[ip] >= BAN_HASHFAILS:
+            self.ban(ip)
+
+    def ban(self, ip):
+        # Peers that keep sending bad data after a reconnect are refused
+        # for a while, on every port.
+        self.banned[ip] = time.time() + BAN_TIME
+        self.hashfails.pop(ip, None)
+        for conn in self.torrent.connections.values():
+            if conn.address and conn.address[0] == ip:
+                conn.broken = True
+
+    def is_banned(self, ip):
+        until = self.banned.get(ip)
+        if until is None:
+            return False
+        if until <= time.time():
+            del self.banned[ip]
+            return False
+        return True
+
+    async def close(self):
+        tasks = []
+        for conn in self.torrent.connections.values():
+            conn.broken = True
+            if conn.task and conn.task is not asyncio.current_task():
+                conn.task.cancel()
+                tasks.append(conn.task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.cleanup()
@@ -0,0 +1,261 @@
+import itertools
+import random
+
+from modules.bitfield import Bitfield
+from modules.files import BLOCK_SIZE
+
+RECEIVED = True
+PICK_PROBES = 64
+
+
+class PieceDownload:
+    def __init__(self, index, length):
+        self.index = index
+        self.length = length
+        self.states = [None] * -(-length // BLOCK_SIZE)
+        self.unrequested = len(self.states)
+        self.received = 0
+        self.data = bytearray(length)
+        self.peers = set()
+
+    def assign(self, conn, count, skip=()):
+        assigned = []
+        for i, state in enumerate(self.states):
+            if len(assigned) == count or not self.unrequested:
+                break
+            if state is None and (self.index, i * BLOCK_SIZE) not in skip:
+                self.states[i] = {conn}
+                self.unrequested -= 1
+                assigned.append(self.get_block(i))
+        return assigned
+
+    def assign_duplicates(self, conn, count, skip=()):
+        assigned = []
+        for i, state in enumerate(self.states):
+            if len(assigned) == count:
+                break
+            if (isinstance(state, set) and conn not in state and
+                    (self.index, i * BLOCK_SIZE) not in skip):
+                state.add(conn)
+                assigned.append(self.get_block(i))
+        return assigned
+
+    def get_block(self, i):
+        begin = i * BLOCK_SIZE
+        return self.index, begin, min(BLOCK_SIZE, self.length - begin)
+
+    def release(self, conn, begin):
+        state = self.states[begin // BLOCK_SIZE]
+        if isinstance(state, set) and conn in state:
+            state.remove(conn)
+            if not state:
+                self.states[begin // BLOCK_SIZE] = None
+                self.unrequested += 1
+
+    def add_block(self, conn, begin, block):
+        i, offset = divmod(begin, BLOCK_SIZE)
+        if (offset or i >= len(self.states) or
+                self.states[i] is RECEIVED or
+                len(block) != self.get_block(i)[2]):
+            return None
+        requesters = self.states[i]
+        if requesters is None:
+            self.unrequested -= 1
+            requesters = set()
+        self.states[i] = RECEIVED
+        self.received += 1
+        self.data[begin:begin + len(block)] = block
+        self.peers.add(conn)
+        return requesters
+
+    def is_complete(self):
+        return self.received == len(self.states)
+
+
+class PiecePicker:
+    def __init__(self, files, endgame=True):
+        self.files = files
+        self.endgame = endgame
+        self.availability = [0] * files.piece_num
+        self.buckets = {}
+        self.positions = {}
+        self.wanted = Bitfield(files.piece_num)
+        self.downloading = {}
+        self.completed = []
+
+    def set_wanted(self, index, wanted):
+        if not wanted:
+            self.discard(index)
+        elif index not in self.positions and index not in self.downloading:
+            self.add_to_bucket(index)
+            self.wanted.add(index)
+
+    def is_wanted(self, index):
+        return index in self.positions or index in self.downloading
+
+    def complete(self, index):
+        self.discard(index)
+
+    def discard(self, index):
+        if index in self.positions:
+            self.remove_from_bucket(index)
+            self.wanted.discard(index)
+        self.downloading.pop(index, None)
+
+    def add_peer_pieces(self, indices):
+        for index in indices:
+            if index in self.positions:
+                self.change_availability(index, 1)
+            else:
+                self.availability[index] += 1
+
+    def remove_peer_pieces(self, indices):
+        for index in indices:
+            if index in self.positions:
+                self.change_availability(index, -1)
+            else:
+                self.availability[index] -= 1
+
+    def change_availability(self, index, delta):
+        wanted = index in self.positions
+        if wanted:
+            self.remove_from_bucket(index)
+        self.availability[index] += delta
+        if wanted:
+            self.add_to_bucket(index)
+
+    def add_to_bucket(self, index):
+        bucket = self.buckets.setdefault(self.availability[index], [])
+        self.positions[index] = len(bucket)
+        bucket.append(index)
+
+    def remove_from_bucket(self, index):
+        availability = self.availability[index]
+        bucket = self.buckets[availability]
+        pos = self.positions.pop(index)
+        last = bucket.pop()
+        if last != index:
+            bucket[pos] = last
+            self.positions[last] = pos
+        if not bucket:
+            del self.buckets[availability]
+
+    def pick(self, has_pieces):
+        # Most peers have one of the rarest pieces near the start of the
+        # scan. For the others the candidates come from the intersection of
+        # the bitfields, so a peer with few wanted pieces never costs a scan
+        # of every wanted piece.
+        scan = self.scan()
+        for index in itertools.islice(scan, PICK_PROBES):
+            if index in has_pieces:
+                return index
+        candidates = has_pieces.to_int() & self.wanted.to_int()
+        if not candidates:
+            return None
+        count = candidates.bit_count()
+        if count * count < len(self.positions):
+            return self.pick_rarest(
+                Bitfield.from_int(self.wanted.length, candidates))
+        for index in scan:
+            if index in has_pieces:
+                return index
+        return None
+
+    def scan(self):
+        for availability in sorted(self.buckets):
+            if availability == 0:
+                continue
+            bucket = self.buckets[availability]
+            # Start at a random position, so peers asking at the same time
+            # get different pieces of equal rarity.
+            offset = random.randrange(len(bucket))
+            for i in range(len(bucket)):
+                yield bucket[(offset + i) % len(bucket)]
+
+    def pick_rarest(self, candidates):
+        rarest = []
+        least = None
+        for index in candidates:
+            availability = self.availability[index]
+            if availability == 0:
+                continue
+            if least is None or availability < least:
+                least = availability
+                rarest = [index]
+            elif availability == least:
+                rarest.append(index)
+        return random.choice(rarest) if rarest else None
+
+    def pick_blocks(self, conn, has_pieces, count, skip=()):
+        blocks = []
+        # Blocks of pieces that are already being downloaded go first, so
+        # partial pieces get finished, by several peers if needed.
+        for index, piece in self.downloading.items():
+            if len(blocks) == count:
+                return blocks
+            if piece.unrequested and index in has_pieces:
+                blocks.extend(piece.assign(conn, count - len(blocks), skip))
+        while len(blocks) < count:
+            index = self.pick(has_pieces)
+            if index is None:
+                break
+            piece = self.start_piece(index)
+            blocks.extend(piece.assign(conn, count - len(blocks)))
+        if len(blocks) < count and self.in_endgame():
+            # Every remaining block is in flight: ask this peer as well and
+            # cancel the other requests when the first copy arrives.
+            for index, piece in self.downloading.items():
+                if len(blocks) == count:
+                    break
+                if index in has_pieces:
+                    blocks.extend(piece.assign_duplicates(
+                        conn, count - len(blocks), skip))
+        return blocks
+
+    def in_endgame(self):
+        if not self.endgame or not self.downloading:
+            return False
+        for availability in self.buckets:
+            if availability > 0:
+                return False
+        return not any(piece.unrequested
+                       for piece in self.downloading.values())
+
+    def start_piece(self, index):
+        self.remove_from_bucket(index)
+        self.wanted.discard(index)
+        self.downloading[index] = PieceDownload(
+            index, self.files.get_piece_length(index))
+        return self.downloading[index]
+
+    def resume_piece(self, index, data, received):
+        if index not in self.positions:
+            return
+        piece = self.start_piece(index)
+        piece.data[:] = data
+        for i in received:
+            piece.states[i] = RECEIVED
+            piece.unrequested -= 1
+            piece.received += 1
+        if piece.is_complete():
+            del self.downloading[index]
+            self.completed.append((index, piece.data, piece.peers))
+
+    def release_blocks(self, conn, blocks):
+        for index, begin in blocks:
+            if index in self.downloading:
+                self.downloading[index].release(conn, begin)
+
+    def add_block(self, conn, index, begin, block):
+        piece = self.downloading.get(index)
+        if piece is None:
+            return None
+        requesters = piece.add_block(conn, begin, block)
+        if requesters is not None and piece.is_complete():
+            del self.downloading[index]
+            self.completed.append((index, piece.data, piece.peers))
+        return requesters
+
+    def pop_completed(self):
+        completed, self.completed = self.completed, []
+        return completed
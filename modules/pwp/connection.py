@@ -1,97 +1,230 @@
-import socket
-import select
-from collections import deque
+import asyncio
+import math
 import time
+from collections import deque
 
+from modules import bencode
+from modules.bitfield import Bitfield
+from modules.meter import TrafficMeter
 from modules.pwp import messages
+from modules.ratelimit import TokenBucket
 
 
+CONNECT_TIMEOUT = 10
 HANDSHAKE_TIMEOUT = 5
 MESSAGE_TIMEOUT = 5
 MAX_IDLES = 24
+READ_SIZE = 65536
+PIPELINE_SIZE = 16
+MIN_PIPELINE_SIZE = 2
+MAX_PIPELINE_SIZE = 64
+BLOCK_TIMEOUT = 30
+PIPELINE_INTERVAL = 1
+MAX_REQUEST_LENGTH = 2**17
+MAX_HASHFAILS = 2
+PEX_INTERVAL = 60
+PEX_MIN_INTERVAL = 45
+PEX_MAX_PEERS = 50
+PEER_UPLOAD_RATE = 0
+PEER_DOWNLOAD_RATE = 0
 
 
 class Connection:
-    def __init__(self, client_id, info_hash, files, lock):
-        self.lock = lock
-        self.client_id = client_id
-        self.info_hash = info_hash
-        self.client_files = files
+    def __init__(self, torrent, pipeline_size=PIPELINE_SIZE,
+                 adaptive_pipeline=True):
+        self.torrent = torrent
+        self.client_id = torrent.id
+        self.info_hash = torrent.info_hash
+        self.client_files = torrent.files
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.upload_task = None
         self.peer_id = None
         self.broken = False
         self.am_choking = True
         self.am_interested = False
         self.choking = True
         self.interested = False
+        self.framer = messages.Framer()
         self.messages = deque()
         self.requests = deque()
-        self.pieces = {}
-        self.completed_pieces = {}
-        self.has_pieces = set()
+        self.in_flight = {}
+        self.expired = {}
+        self.pipeline_size = pipeline_size
+        self.adaptive_pipeline = adaptive_pipeline
+        self.rtt = None
+        self.pipeline_updated = time.time()
+        self.meter = TrafficMeter(torrent.meter)
+        self.peer_requests = deque()
+        self.peer_requests_added = asyncio.Event()
+        self.uploaded = 0
+        self.downloaded = 0
+        self.upload_bucket = TokenBucket(PEER_UPLOAD_RATE,
+                                         torrent.upload_bucket)
+        self.download_bucket = TokenBucket(PEER_DOWNLOAD_RATE,
+                                           torrent.download_bucket)
+        self.connected = time.time()
+        self.has_pieces = Bitfield(torrent.files.piece_num)
         self.idles = 0
-
-    def initiate(self, ip, port):
+        self.hashfails = 0
+        self.address = None
+        self.supports_extensions = False
+        self.extensions = {}
+        self.pex_peers = set()
+        self.pex_sent = 0
+        self.pex_received = 0
+
+    async def initiate(self, ip, port):
+        self.address = (ip, port)
         try:
-            self.sock = socket.create_connection((ip, port))
-        except (TimeoutError, ConnectionError, OSError):
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(ip, port), CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
             self.broken = True
             return
-        self.sock.setblocking(0)
-        self.give_handshake()
-        self.recieve_messages(HANDSHAKE_TIMEOUT)
-        self.handle_handshake()
-        if not self.broken:
-            self.send_bitfield()
-            self.loop()
-
-    def accept(self, sock):
-        self.sock = sock
-        self.recieve_messages(HANDSHAKE_TIMEOUT)
-        self.handle_handshake()
-        if not self.broken:
+        try:
             self.give_handshake()
-            self.send_bitfield()
-            self.loop()
-
-    def request_piece(self, piece_index):
-        for block in self.client_files.pieces[piece_index]['blocks']:
-            self.requests.append({'index': piece_index,
-                                  'begin': block['begin'],
-                                  'length': block['length']})
-
-    def loop(self):
+            await self.recieve_messages(HANDSHAKE_TIMEOUT)
+            self.handle_handshake()
+            if not self.broken:
+                self.send_bitfield()
+                self.send_extended_handshake()
+                await self.loop()
+        finally:
+            self.close()
+
+    async def accept(self, reader, writer, handshake):
+        self.reader, self.writer = reader, writer
+        # The listening port of an incoming peer is only known once it
+        # sends its extended handshake.
+        self.address = (writer.get_extra_info('peername')[0], None)
+        self.framer = messages.Framer(handshake=False)
+        self.messages.append(handshake)
+        try:
+            self.handle_handshake()
+            if not self.broken:
+                self.give_handshake()
+                self.send_bitfield()
+                self.send_extended_handshake()
+                await self.loop()
+        finally:
+            self.close()
+
+    def cancel_request(self, index, begin, length):
+        request = {'index': index, 'begin': begin, 'length': length}
+        if request in self.requests:
+            self.requests.remove(request)
+        if self.in_flight.pop((index, begin), None):
+            self.send_cancel(request)
+
+    async def loop(self):
+        self.upload_task = asyncio.get_running_loop().create_task(
+            self.serve_requests())
         while True:
             if self.idles > MAX_IDLES or self.broken:
                 self.broken = True
                 break
             self.handle_messages()
-            self.collect_completed_pieces()
-            if self.requests and not self.am_interested:
-                self.send_interested()
-            if self.interested and not self.am_choking:
-                self.send_unchoke()
-            if self.requests and not self.choking:
-                self.send_request(self.requests.popleft())
-            self.recieve_messages(MESSAGE_TIMEOUT)
-
-    def recieve_messages(self, timeout):
-        rs, ws, es = select.select([self.sock], [], [], timeout)
-        if self.sock in rs:
-            try:
-                data = self.sock.recv(4096)
-            except:
-                self.broken = True
-                return
-            for m in messages.get_messages(self.get_not_used_data() + data):
-                self.messages.append(m)
-        else:
-            self.idles += 1
+            self.drop_expired_requests()
+            self.fill_pipeline()
+            self.send_pex()
+            await self.recieve_messages(MESSAGE_TIMEOUT)
 
-    def get_not_used_data(self):
-        not_used_data = b''
-        while self.messages and self.messages[-1]['type'] == 'not_used':
-            not_used_data = self.messages.pop()['data'] + not_used_data
-        return not_used_data
+    def fill_pipeline(self):
+        if self.choking or not self.torrent.active:
+            return
+        room = self.pipeline_size - len(self.in_flight) - len(self.requests)
+        if room > 0:
+            for index, begin, length in self.torrent.picker.pick_blocks(
+                    self, self.has_pieces, room, self.expired):
+                self.requests.append({'index': index, 'begin': begin,
+                                      'length': length})
+        while self.requests and len(self.in_flight) < self.pipeline_size:
+            request = self.requests.popleft()
+            self.in_flight[(request['index'], request['begin'])] = {
+                'request': request, 'time': time.time()}
+            self.send_request(request)
+
+    async def serve_requests(self):
+        while not self.broken:
+            await self.peer_requests_added.wait()
+            self.peer_requests_added.clear()
+            while self.peer_requests and not self.am_choking:
+                request = self.peer_requests.popleft()
+                block = self.client_files.read_block(request['index'],
+                                                     request['begin'],
+                                                     request['length'])
+                self.send_piece(request, block)
+                self.uploaded += len(block)
+                self.meter.upload.add(len(block))
+                self.torrent.uploaded += len(block)
+                try:
+                    await self.writer.drain()
+                except OSError:
+                    self.broken = True
+                    return
+                delay = self.upload_bucket.consume(len(block))
+                if delay:
+                    await asyncio.sleep(delay)
+
+    def drop_expired_requests(self):
+        now = time.time()
+        expired = [key for key, sent in self.in_flight.items()
+                   if now - sent['time'] > BLOCK_TIMEOUT]
+        for key in expired:
+            del self.in_flight[key]
+            self.expired[key] = now
+        self.torrent.picker.release_blocks(self, expired)
+        # Blocks that timed out here are left to other peers for a while,
+        # so a stalled peer does not take them straight back.
+        if self.expired:
+            self.expired = {key: time_ for key, time_ in self.expired.items()
+                            if now - time_ <= BLOCK_TIMEOUT}
+        if expired and self.adaptive_pipeline:
+            self.pipeline_size = max(MIN_PIPELINE_SIZE,
+                                     self.pipeline_size // 2)
+
+    def update_pipeline_size(self, sent_time, length):
+        now = time.time()
+        rtt = now - sent_time
+        if self.rtt is None or rtt < self.rtt:
+            self.rtt = rtt
+        if (self.adaptive_pipeline and
+                now - self.pipeline_updated >= PIPELINE_INTERVAL):
+            self.pipeline_updated = now
+            # Keep twice the bandwidth-delay product in flight, so the
+            # pipeline grows until the peer's upload rate is the limit.
+            rate = self.meter.download.get_rate()
+            size = math.ceil(2 * rate * self.rtt / length)
+            self.pipeline_size = min(MAX_PIPELINE_SIZE,
+                                     max(MIN_PIPELINE_SIZE, size))
+
+    async def recieve_messages(self, timeout):
+        try:
+            data = await asyncio.wait_for(self.reader.read(READ_SIZE),
+                                          timeout)
+        except asyncio.TimeoutError:
+            self.idles += 1
+            return
+        except OSError:
+            self.broken = True
+            return
+        if not data:
+            self.broken = True
+            return
+        # Not reading while the limit is exceeded leaves the data in the
+        # socket buffers, and TCP slows the peer down.
+        delay = self.download_bucket.consume(len(data))
+        if delay:
+            await asyncio.sleep(delay)
+        self.framer.feed(data)
+        try:
+            self.messages.extend(self.framer)
+        except ValueError:
+            self.broken = True
+        self.meter.overhead.add(self.framer.overhead)
+        self.framer.overhead = 0
 
     def handle_handshake(self):
         def is_valid_handshake(message):
@@ -99,15 +232,18 @@ class Connection:
                     message['info_hash'] == self.info_hash)
         if self.messages:
             handshake = self.messages.popleft()
-            if is_valid_handshake(handshake):
+            if (is_valid_handshake(handshake) and
+                    handshake['peer_id'] != self.client_id.encode()):
                 self.peer_id = handshake['peer_id']
+                self.supports_extensions = messages.supports_extensions(
+                    handshake['reserved'])
             else:
                 self.broken = True
         else:
             self.broken = True
 
     def handle_messages(self):
-        while self.messages and self.messages[0]['type'] != 'not_used':
+        while self.messages:
             self.handle_message(self.messages.popleft())
 
     def handle_message(self, message):
@@ -118,7 +254,11 @@ class Connection:
                                'not_interested': self.handle_not_interested}
         payload_handlers = {'have': self.handle_have,
                             'bitfield': self.handle_bitfield,
-                            'piece': self.handle_piece}
+                            'piece': self.handle_piece,
+                            'request': self.handle_request,
+                            'cancel': self.handle_cancel,
+                            'reject': self.handle_reject,
+                            'extended': self.handle_extended}
         type_ = message['type']
         if type_ in no_payload_handlers:
             no_payload_handlers[type_]()
@@ -130,9 +270,13 @@ class Connection:
 
     def handle_choke(self):
         self.choking = True
+        # The peer discards every request it has not served yet, so the
+        # blocks go back to the picker for other peers.
+        self.release_requests()
 
     def handle_unchoke(self):
         self.choking = False
+        self.fill_pipeline()
 
     def handle_interested(self):
         self.interested = True
@@ -141,44 +285,155 @@ class Connection:
         self.interested = False
 
     def handle_have(self, message):
-        self.has_pieces.add(message['piece_index'])
+        index = message['piece_index']
+        if (index < self.client_files.piece_num and
+                index not in self.has_pieces):
+            self.add_pieces([index])
 
     def handle_bitfield(self, message):
-        self.has_pieces.update(message['pieces_indices'])
+        bitfield = Bitfield(self.client_files.piece_num, message['bitfield'])
+        self.add_pieces(bitfield.difference(self.has_pieces))
+
+    def add_pieces(self, new_pieces):
+        self.has_pieces.update(new_pieces)
+        self.torrent.picker.add_peer_pieces(new_pieces)
+        self.update_interest(new_pieces)
+        self.fill_pipeline()
+
+    def update_interest(self, indices):
+        if not self.am_interested and any(
+                self.torrent.picker.is_wanted(index) for index in indices):
+            self.send_interested()
 
     def handle_piece(self, message):
-        if message['index'] not in self.pieces:
-            self.pieces[message['index']] = []
-        self.pieces[message['index']].append({'begin': message['begin'],
-                                              'data': message['block']})
+        sent = self.in_flight.pop((message['index'], message['begin']), None)
+        self.downloaded += len(message['block'])
+        self.meter.download.add(len(message['block']))
+        if sent:
+            self.update_pipeline_size(sent['time'], len(message['block']))
+        requesters = self.torrent.picker.add_block(
+            self, message['index'], message['begin'], message['block'])
+        for conn in requesters or ():
+            if conn is not self:
+                conn.cancel_request(message['index'], message['begin'],
+                                    len(message['block']))
+
+    def handle_request(self, message):
+        def is_valid_request():
+            index = message['index']
+            return (index in self.client_files.have and
+                    0 < message['length'] <= MAX_REQUEST_LENGTH and
+                    message['begin'] + message['length'] <=
+                    self.client_files.get_piece_length(index))
+
+        if self.am_choking or not is_valid_request():
+            return
+        self.peer_requests.append({'index': message['index'],
+                                   'begin': message['begin'],
+                                   'length': message['length']})
+        self.peer_requests_added.set()
+
+    def handle_cancel(self, message):
+        request = {'index': message['index'],
+                   'begin': message['begin'],
+                   'length': message['length']}
+        if request in self.peer_requests:
+            self.peer_requests.remove(request)
+
+    def handle_reject(self, message):
+        key = (message['index'], message['begin'])
+        if self.in_flight.pop(key, None):
+            self.torrent.picker.release_blocks(self, [key])
+
+    def handle_extended(self, message):
+        try:
+            data = bencode.decode(message['data'])[0]
+        except (ValueError, IndexError):
+            return
+        if not isinstance(data, dict):
+            return
+        if message['extended_id'] == messages.EXTENDED_HANDSHAKE_ID:
+            self.handle_extended_handshake(data)
+        elif message['extended_id'] == messages.UT_PEX_ID:
+            self.handle_pex(data)
+
+    def handle_extended_handshake(self, data):
+        extensions = data.get(b'm', {})
+        if isinstance(extensions, dict):
+            # Each handshake may add, change or, with id 0, disable
+            # extensions.
+            for name, extended_id in extensions.items():
+                if not isinstance(extended_id, int):
+                    continue
+                if extended_id:
+                    self.extensions[name] = extended_id
+                else:
+                    self.extensions.pop(name, None)
+        port = data.get(b'p')
+        if (isinstance(port, int) and 0 < port < 2**16 and
+                self.address and self.address[1] is None):
+            self.address = (self.address[0], port)
+
+    def handle_pex(self, data):
+        # Peers may not send PEX messages more than once a minute; extra
+        # ones are dropped instead of flooding the connection list.
+        now = time.time()
+        if now - self.pex_received < PEX_MIN_INTERVAL:
+            return
+        self.pex_received = now
+        peers = messages.decode_peers(data.get(b'added'))[:PEX_MAX_PEERS]
+        self.torrent.add_peers([{'ip': ip, 'port': port}
+                                for ip, port in peers if port])
+
+    def add_hashfail(self):
+        # The peer sent data for a piece that failed verification; one bad
+        # piece may be bad luck, more mean the peer is broken or malicious.
+        self.hashfails += 1
+        if self.hashfails >= MAX_HASHFAILS:
+            self.broken = True
+
+    def release_requests(self):
+        blocks = list(self.in_flight) + [(request['index'], request['begin'])
+                                         for request in self.requests]
+        self.torrent.picker.release_blocks(self, blocks)
+        self.in_flight.clear()
+        self.requests.clear()
 
     def give_handshake(self):
-        message = messages.build_handshake(self.info_hash,
-                                           self.client_id.encode())
+        message = messages.build_handshake(
+            self.info_hash, self.client_id.encode(),
+            messages.get_extension_reserved_bytes())
         self.send_message(message)
 
-    def collect_completed_pieces(self):
-        def get_piece_data(blocks):
-            return b''.join([block['data']
-                             for block in sorted(blocks,
-                                                 key=lambda x:x['begin'])])
-
-        completed = []
-        for index, blocks in self.pieces.items():
-            client_blocks = self.client_files.pieces[index]['blocks']
-            if len(blocks) == len(client_blocks):
-                with self.lock:
-                    self.completed_pieces[index] = get_piece_data(blocks)
-                    self.send_have(index)
-                completed.append(index)
-        for index in completed:
-            del self.pieces[index]
+    def send_extended_handshake(self):
+        if self.supports_extensions:
+            self.send_message(messages.build_extended_handshake(
+                self.torrent.port))
+
+    def send_pex(self):
+        # Only changes since the last message are sent: connected peers
+        # that are new to this peer and ones that went away.
+        if (b'ut_pex' not in self.extensions or
+                time.time() - self.pex_sent < PEX_INTERVAL):
+            return
+        peers = self.torrent.get_peer_addresses()
+        peers.discard(self.address)
+        added = list(peers - self.pex_peers)[:PEX_MAX_PEERS]
+        dropped = list(self.pex_peers - peers)[:PEX_MAX_PEERS]
+        self.pex_sent = time.time()
+        if not added and not dropped:
+            return
+        self.pex_peers.update(added)
+        self.pex_peers.difference_update(dropped)
+        self.send_message(messages.build_pex(self.extensions[b'ut_pex'],
+                                             added, dropped))
 
     def send_keep_alive(self):
         self.send_message(messages.build_keep_alive())
 
     def send_choke(self):
         self.am_choking = True
+        self.peer_requests.clear()
         self.send_message(messages.build_choke())
 
     def send_unchoke(self):
@@ -203,8 +458,32 @@ class Connection:
                                                  request['begin'],
                                                  request['length']))
 
+    def send_cancel(self, request):
+        self.send_message(messages.build_cancel(request['index'],
+                                                request['begin'],
+                                                request['length']))
+
+    def send_piece(self, request, block):
+        self.send_message(messages.build_piece(request['index'],
+                                               request['begin'], block),
+                          len(block))
+
     def send_have(self, index):
         self.send_message(messages.build_have(index))
 
-    def send_message(self, message):
-        self.sock.sendall(message)
+    def send_message(self, message, payload=0):
+        if self.writer.is_closing():
+            self.broken = True
+            return
+        self.writer.write(message)
+        self.meter.overhead.add(len(message) - payload)
+
+    def close(self):
+        self.broken = True
+        self.release_requests()
+        self.torrent.picker.remove_peer_pieces(self.has_pieces)
+        self.has_pieces = Bitfield(self.client_files.piece_num)
+        if self.upload_task:
+            self.upload_task.cancel()
+        if self.writer:
+            self.writer.close()
@@ -1,5 +1,12 @@
+import socket
+
+from modules import bencode
+
+
 PROTOCOL_NAME = b'BitTorrent protocol'
 RESERVED = 8
+EXTENSION_BYTE = 5
+EXTENSION_BIT = 0x10
 
 CHOKE_ID = 0
 UNCHOKE_ID = 1
@@ -11,7 +18,14 @@ REQUEST_ID = 6
 PIECE_ID = 7
 CANCEL_ID = 8
 PORT_ID = 9
+REJECT_ID = 16
 EXTENDED_ID = 20
+PAYLOAD_IDS = (HAVE_ID, BITFIELD_ID, REQUEST_ID, PIECE_ID, CANCEL_ID,
+               PORT_ID, REJECT_ID, EXTENDED_ID)
+
+EXTENDED_HANDSHAKE_ID = 0
+UT_PEX_ID = 1
+EXTENSIONS = {b'ut_pex': UT_PEX_ID}
 
 LEN_LEN = 4
 LEN_ID = 1
@@ -20,6 +34,8 @@ LEN_INDEX = 4
 LEN_BEGIN = 4
 LEN_BLOCK_LEN = 4
 
+MAX_MESSAGE_LENGTH = 2**21
+
 
 def int_to_bytes(int_, length):
     return int_.to_bytes(length, byteorder='big')
@@ -37,10 +53,21 @@ def get_reserved_bytes(length):
     return b'\x00' * length
 
 
-def build_handshake(info_hash, peer_id):
+def get_extension_reserved_bytes():
+    reserved = bytearray(get_reserved_bytes(RESERVED))
+    reserved[EXTENSION_BYTE] |= EXTENSION_BIT
+    return bytes(reserved)
+
+
+def supports_extensions(reserved):
+    return bool(reserved[EXTENSION_BYTE] & EXTENSION_BIT)
+
+
+def build_handshake(info_hash, peer_id, reserved=None):
+    if reserved is None:
+        reserved = get_reserved_bytes(RESERVED)
     return (get_protocol_name_length(PROTOCOL_NAME) +
-            PROTOCOL_NAME + get_reserved_bytes(RESERVED) +
-            info_hash + peer_id)
+            PROTOCOL_NAME + reserved + info_hash + peer_id)
 
 
 def build_message(length, message_id=None, payload=b''):
@@ -105,29 +132,122 @@ def build_cancel(index, begin, length):
     return build_message(len(payload) + LEN_ID, CANCEL_ID, payload)
 
 
+def build_reject(index, begin, length):
+    payload = get_request_payload(index, begin, length)
+    return build_message(len(payload) + LEN_ID, REJECT_ID, payload)
+
+
 def build_port(port):
     payload = int_to_bytes(port, 2)
     return build_message(len(payload) + LEN_ID, PORT_ID, payload)
 
 
-def get_messages(bytes_):
-    if not bytes_:
+def build_extended(extended_id, data):
+    payload = int_to_bytes(extended_id, 1) + bencode.encode(data)
+    return build_message(len(payload) + LEN_ID, EXTENDED_ID, payload)
+
+
+def build_extended_handshake(port):
+    return build_extended(EXTENDED_HANDSHAKE_ID,
+                          {b'm': EXTENSIONS, b'p': port})
+
+
+def build_pex(extended_id, added, dropped):
+    return build_extended(extended_id,
+                          {b'added': encode_peers(added),
+                           b'added.f': get_reserved_bytes(len(added)),
+                           b'dropped': encode_peers(dropped)})
+
+
+def encode_peers(peers):
+    return b''.join(socket.inet_aton(ip) + int_to_bytes(port, 2)
+                    for ip, port in peers)
+
+
+def decode_peers(data):
+    if not isinstance(data, bytes):
         return []
-    messages = []
-    handshake_length = get_handshake_length()
-    if len(bytes_) >= handshake_length:
-        handshake = get_handshake(bytes_[:handshake_length])
-        if handshake:
-            messages.append(handshake)
-            messages.extend(get_messages(bytes_[handshake_length:]))
-            return messages
-    length = LEN_LEN + get_message_length(bytes_)
-    message = get_message(bytes_[:length])
-    if message:
-        messages.append(message)
-        messages.extend(get_messages(bytes_[length:]))
-        return messages
-    return [{'type': 'not_used', 'data': bytes_}]
+    return [(socket.inet_ntoa(data[i:i + 4]),
+             int_from_bytes(data[i + 4:i + 6]))
+            for i in range(0, len(data) - len(data) % 6, 6)]
+
+
+def get_messages(bytes_):
+    framer = Framer(is_handshake(bytes_))
+    framer.feed(bytes_)
+    messages = list(framer)
+    not_used_data = framer.get_not_used_data()
+    if not_used_data:
+        messages.append({'type': 'not_used', 'data': not_used_data})
+    return messages
+
+
+class Framer:
+    def __init__(self, handshake=True):
+        self.handshake = handshake
+        self.buffer = b''
+        self.view = memoryview(self.buffer)
+        self.pos = 0
+        self.overhead = 0
+
+    def feed(self, data):
+        if self.pos < len(self.buffer):
+            # Blocks handed out earlier are views into the old buffer, so
+            # the unparsed tail goes to a new one instead of being resized.
+            buffer = bytearray(self.view[self.pos:])
+            buffer += data
+            self.buffer = buffer
+        else:
+            self.buffer = data
+        self.view = memoryview(self.buffer)
+        self.pos = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                raise StopIteration
+            # Everything on the wire but block data is protocol overhead.
+            self.overhead += len(frame)
+            if self.handshake:
+                self.handshake = False
+                message = get_handshake(bytes(frame))
+                if message is None:
+                    raise ValueError('Invalid handshake.')
+                return message
+            message = get_frame_message(frame)
+            if message is not None:
+                if message['type'] == 'piece':
+                    self.overhead -= len(message['block'])
+                return message
+
+    def next_frame(self):
+        available = len(self.buffer) - self.pos
+        if self.handshake:
+            length = get_handshake_length()
+        elif available >= LEN_LEN:
+            length = LEN_LEN + get_message_length(
+                self.view[self.pos:self.pos + LEN_LEN])
+            if length > MAX_MESSAGE_LENGTH:
+                raise ValueError('Message is too long.')
+        else:
+            return None
+        if available < length:
+            return None
+        frame = self.view[self.pos:self.pos + length]
+        self.pos += length
+        return frame
+
+    def get_not_used_data(self):
+        return bytes(self.view[self.pos:])
+
+
+def is_handshake(bytes_):
+    prefix = get_protocol_name_length(PROTOCOL_NAME) + PROTOCOL_NAME
+    return bytes_[:len(prefix)] == prefix
 
 
 def get_handshake_length():
@@ -142,13 +262,21 @@ def get_handshake(handshake):
     peer_id_start = info_hash_start + 20
     info_hash = handshake[info_hash_start:peer_id_start]
     peer_id = handshake[peer_id_start:]
-    return {'type': 'handshake', 'info_hash': info_hash, 'peer_id': peer_id}
+    return {'type': 'handshake', 'reserved': handshake[20:info_hash_start],
+            'info_hash': info_hash, 'peer_id': peer_id}
 
 
 def get_message_length(bytes_):
     return int_from_bytes(bytes_[:LEN_LEN])
 
 
+def get_frame_message(frame):
+    try:
+        return get_message(frame)
+    except ValueError:
+        return None
+
+
 def get_message(bytes_):
     try:
         raw_msg = parse_message(bytes_)
@@ -157,6 +285,10 @@ def get_message(bytes_):
     if raw_msg['length'] == 0:
         return {'type': 'keep-alive'}
     if raw_msg['length'] == LEN_ID:
+        # A message that carries fields is dropped when it comes without
+        # them, so its handler can rely on them.
+        if raw_msg['id'] in PAYLOAD_IDS:
+            return None
         return {'type': get_message_type(raw_msg['id'])}
     return get_message_parser(raw_msg['id'])(raw_msg)
 
@@ -187,6 +319,7 @@ def get_message_type(message_id):
              PIECE_ID: 'piece',
              CANCEL_ID: 'cancel',
              PORT_ID: 'port',
+             REJECT_ID: 'reject',
              EXTENDED_ID: 'extended'}
     if message_id in types:
         return types[message_id]
@@ -200,6 +333,7 @@ def get_message_parser(message_id):
                PIECE_ID: parse_piece,
                CANCEL_ID: parse_cancel,
                PORT_ID: parse_port,
+               REJECT_ID: parse_reject,
                EXTENDED_ID: parse_extended}
     if message_id in parsers:
         return parsers[message_id]
@@ -212,12 +346,8 @@ def parse_have(raw_msg):
 
 
 def parse_bitfield(raw_msg):
-    def get_pieces_indices():
-        bit_str = bin(int.from_bytes(raw_msg['payload'], byteorder='big'))
-        return [i for i, bit in enumerate(bit_str) if bit == '1']
-
     return {'type': get_message_type(BITFIELD_ID),
-            'pieces_indices': get_pieces_indices()}
+            'bitfield': bytes(raw_msg['payload'])}
 
 
 def parse_request(raw_msg):
@@ -228,6 +358,10 @@ def parse_cancel(raw_msg):
     return get_request_format(raw_msg, CANCEL_ID)
 
 
+def parse_reject(raw_msg):
+    return get_request_format(raw_msg, REJECT_ID)
+
+
 def get_request_format(raw_msg, message_id):
     return {'type': get_message_type(message_id),
             'index': get_index(raw_msg),
@@ -263,4 +397,5 @@ def parse_port(raw_msg):
 
 def parse_extended(raw_msg):
     return {'type': 'extended',
-            'data': raw_msg['payload']}
+            'extended_id': raw_msg['payload'][0],
+            'data': raw_msg['payload'][1:]}
@@ -0,0 +1,37 @@
+import time
+
+BURST_TIME = 1
+
+
+class TokenBucket:
+    def __init__(self, rate=0, parent=None):
+        self.parent = parent
+        self.rate = rate
+        self.tokens = rate * BURST_TIME
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate):
+        self.refill(time.monotonic())
+        self.rate = rate
+        self.tokens = min(self.tokens, rate * BURST_TIME)
+
+    def consume(self, amount):
+        # Buckets go into debt instead of making the caller wait for
+        # tokens, so a whole read or write is paid for at once and the
+        # caller sleeps off the largest debt along the chain of buckets.
+        delay = 0
+        now = time.monotonic()
+        bucket = self
+        while bucket is not None:
+            if bucket.rate:
+                bucket.refill(now)
+                bucket.tokens -= amount
+                if bucket.tokens < 0:
+                    delay = max(delay, -bucket.tokens / bucket.rate)
+            bucket = bucket.parent
+        return delay
+
+    def refill(self, now):
+        self.tokens = min(self.rate * BURST_TIME,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
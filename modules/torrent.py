@@ -1,70 +1,116 @@
+import asyncio
 import random
 import string
 import time
-from urllib import parse
 from hashlib import sha1
-from threading import Thread, Lock
 
 from modules import bencode
-from modules.files import Files
-from modules.tracker import Tracker
+from modules.bitfield import Bitfield
+from modules.choker import Choker
+from modules.files import STORAGES
+from modules.meter import TrafficMeter
+from modules.peers import MAX_PEERS, PeerManager
+from modules.picker import PiecePicker, RECEIVED
+from modules.ratelimit import TokenBucket
+from modules.tracker import Announcer, TrackerTiers
+from modules.verifier import Verifier, recheck
 from modules.pwp.connection import Connection
 
 
 ID_PREFIX = 'VT1001'
 PORT = 57893
+STORAGE = 'file'
 
-REQUEST_TIMEOUT = 90
 LOOP_TIME = 2
+RESUME_INTERVAL = 60
 
 
 class Torrent:
-    def __init__(self, filename, torrent_dir, download_dir):
+    def __init__(self, filename, torrent_dir, download_dir, port=PORT,
+                 storage=STORAGE, dht=None, upload_limit=None,
+                 download_limit=None, max_peers=MAX_PEERS,
+                 peer_limit=None, meter=None):
         self.id = self.generate_id()
-        tracker_url, info = self.parse_meta(torrent_dir + '/' + filename)
+        self.port = port
+        tiers, info, raw_info = self.parse_meta(torrent_dir + '/' + filename)
         self.info = info
+        self.raw_info = raw_info
         self.info_hash = self.get_info_hash()
         self.name = filename[:-8]
-        self.files = Files(info, download_dir + '/' + self.name)
-        self.tracker = Tracker(tracker_url)
+        self.files = STORAGES[storage](info,
+                                       download_dir + '/' + self.name,
+                                       info_hash=self.info_hash)
+        self.picker = PiecePicker(self.files)
+        self.verifier = Verifier(self.files, self.on_verified)
+        self.choker = Choker()
+        self.upload_bucket = TokenBucket(parent=upload_limit)
+        self.download_bucket = TokenBucket(parent=download_limit)
+        self.meter = TrafficMeter(meter)
+        self.announcer = Announcer(TrackerTiers(tiers),
+                                   self.get_announce_params, dht)
         self.uploaded = 0
         self.downloaded = self.files.get_downloaded()
-        self.speed = 0
-        self.started = False
+        self.checking = None
+        self.checking_speed = 0
         self.active = False
         self.completed = False
         self.connections = {}
-        self.connections_updated = None
-        self.lock = Lock()
+        self.peer_manager = PeerManager(self, max_peers, peer_limit)
+        self.resume_saved = time.time()
 
     def generate_id(self):
         unique_part = ''.join(random.choices(string.digits, k=12))
         return '-{}-{}'.format(ID_PREFIX, unique_part)
 
     def parse_meta(self, filename):
-        raw_meta = bencode.decode(open(filename, 'rb').read())[0]
-        return raw_meta[b'announce'].decode(), raw_meta[b'info']
+        with open(filename, 'rb') as f:
+            raw_meta, raw_info = bencode.decode_metainfo(f.read())
+        return self.get_tiers(raw_meta), raw_meta[b'info'], raw_info
+
+    def get_tiers(self, raw_meta):
+        if b'announce-list' in raw_meta:
+            return [[url.decode() for url in tier]
+                    for tier in raw_meta[b'announce-list']]
+        return [[raw_meta[b'announce'].decode()]]
 
     def get_info_hash(self):
-        return sha1(bencode.encode(self.info)).digest()
+        # The info dict is hashed as it is in the file; re-encoding it would
+        # change the hash of torrents with unsorted keys.
+        return sha1(self.raw_info).digest()
 
     def get_num_of_active_peers(self):
-        return len([c for c in self.connections.values()
+        return len([c for c in list(self.connections.values())
                     if not c.broken])
 
-    def start(self, files_indices):
+    async def start(self, files_indices):
         self.set_files_status(files_indices)
-        self.update_connections()
-        self.started = True
+        self.completed = self.downloaded == self.files.total_length
         self.active = True
-        while self.downloaded < self.files.total_length and self.active:
-            self.update_connections()
-            self.distribute_requests()
-            self.collect_pieces()
-            time.sleep(LOOP_TIME)
-        self.speed = 0
-        if self.downloaded == self.files.total_length:
-            self.completed = True
+        self.announcer.start()
+        self.verifier.start()
+        self.resume_pieces()
+        check_task = asyncio.get_running_loop().create_task(
+            self.check_pieces())
+        try:
+            while self.active:
+                self.update_connections()
+                self.choker.update(list(self.connections.values()),
+                                   self.completed)
+                self.distribute_requests()
+                await self.collect_pieces()
+                if (not self.completed and
+                        self.downloaded == self.files.total_length):
+                    self.completed = True
+                    self.announcer.complete()
+                if time.time() - self.resume_saved >= RESUME_INTERVAL:
+                    await self.save_resume()
+                await asyncio.sleep(LOOP_TIME)
+            await self.verifier.join()
+        finally:
+            check_task.cancel()
+            await self.verifier.stop()
+            await self.announcer.stop()
+            await self.peer_manager.close()
 
     def set_files_status(self, files_indices):
         if not files_indices:
@@ -74,92 +120,149 @@ class Torrent:
                 if index < 0 or index >= len(self.files.files):
                     continue
                 self.files.download_file(index)
+        for index in range(self.files.piece_num):
+            self.picker.set_wanted(index, self.is_wanted(index))
+        for conn in self.connections.values():
+            if not conn.broken and conn.peer_id:
+                conn.update_interest(
+                    conn.has_pieces.difference(self.files.have))
+
+    def is_wanted(self, index):
+        # Pieces waiting for the background check are only downloaded once
+        # the check has failed.
+        return (index not in self.files.have and
+                index not in self.files.unverified and
+                not self.files.piece_skip(index))
+
+    async def save_state(self):
+        await self.save_resume()
+        await asyncio.get_running_loop().run_in_executor(
+            self.verifier.executor, self.files.close_files)
+
+    async def save_resume(self):
+        def get_received(piece):
+            received = Bitfield(len(piece.states))
+            received.update(i for i, state in enumerate(piece.states)
+                            if state is RECEIVED)
+            return received
 
-    def save_state(self):
-        with self.lock:
-            self.files.close_files()
-        self.files.save_bitfield()
+        # Partial pieces are copied here, since peers keep adding blocks
+        # while the resume data is written and synced in the verifier's
+        # threads.
+        partial = [(index, bytes(piece.data), get_received(piece))
+                   for index, piece in self.picker.downloading.items()
+                   if piece.received]
+        self.resume_saved = time.time()
+        await asyncio.get_running_loop().run_in_executor(
+            self.verifier.executor, self.files.save_resume, partial)
+
+    def resume_pieces(self):
+        for index, received in self.files.partial.items():
+            data = self.files.read_block(index, 0,
+                                         self.files.get_piece_length(index))
+            self.picker.resume_piece(index, data, received)
+        self.files.partial = {}
+
+    async def recheck(self):
+        def update_checking(checked, elapsed):
+            self.checking = checked / self.files.total_length
+            if elapsed:
+                self.checking_speed = checked / elapsed
+
+        if self.checking is not None:
+            return
+        self.checking = 0
+        loop = asyncio.get_running_loop()
+        try:
+            valid = await loop.run_in_executor(
+                None, lambda: recheck(self.files, progress=update_checking))
+        finally:
+            self.checking = None
+            self.checking_speed = 0
+        had = self.files.have.copy()
+        self.files.set_pieces(valid)
+        for index in range(self.files.piece_num):
+            self.picker.set_wanted(index, self.is_wanted(index))
+        for index in self.files.have.difference(had):
+            self.send_have(index)
+        self.downloaded = self.files.get_downloaded()
+        self.completed = self.downloaded == self.files.total_length
+        await self.save_resume()
+
+    async def check_pieces(self):
+        # Pieces from files that changed since the last resume save are
+        # hashed in the background while the download goes on.
+        for index in sorted(self.files.unverified):
+            if await self.verifier.check(index):
+                self.downloaded += self.files.get_piece_length(index)
+                self.send_have(index)
+            else:
+                self.picker.set_wanted(index, self.is_wanted(index))
 
     def get_download_info(self):
-        return '{} of {} KB on {} kbps'.format(self.downloaded,
-                                               self.files.total_length,
-                                               self.speed/1000)
+        return '{} of {} KB on {} kbps'.format(
+            self.downloaded, self.files.total_length,
+            self.meter.download.get_rate() / 1000)
 
     def update_connections(self):
-        if (self.connections_updated and
-            time.time() - self.connections_updated <
-                self.tracker.interval):
+        # Peers are announced for in the background and only picked up
+        # here, so the loop never waits for a tracker.
+        while not self.announcer.peers.empty():
+            peer = self.announcer.peers.get_nowait()
+            self.peer_manager.add(peer['ip'], peer['port'])
+        self.peer_manager.update()
+
+    def add_peers(self, peers):
+        for peer in peers:
+            self.announcer.peers.put_nowait(peer)
+
+    def get_peer_addresses(self):
+        return {conn.address for conn in self.connections.values()
+                if not conn.broken and conn.peer_id and conn.address and
+                conn.address[1]}
+
+    async def accept_connection(self, reader, writer, handshake):
+        # Incoming peers are keyed by their source address, since their
+        # listening port is not known yet.
+        peername = writer.get_extra_info('peername')[:2]
+        if not self.peer_manager.can_accept(peername[0]):
+            writer.close()
             return
-        for peer in self.request_peers():
-            if peer['ip'] in self.connections:
-                continue
-            conn = Connection(self.id, self.info_hash,
-                              self.files, Lock())
-            self.connections[peer['ip']] = conn
-            t = Thread(target=conn.initiate, args=(peer['ip'],
-                       peer['port']))
-            t.daemon = True
-            t.start()
-        self.peers_updated = time.time()
-
-    def request_peers(self):
-        def get_query():
-            def get_event():
-                return 'started' if not self.started else ''
-
-            params = {'info_hash': parse.quote(self.info_hash),
-                      'peer_id': self.id,
-                      'port': PORT,
-                      'uploaded': self.uploaded,
-                      'downloaded': self.downloaded,
-                      'left': self.get_left()}
-            event = get_event()
-            if event:
-                params['event'] = event
-            return '?{}'.format('&'.join(['{}={}'.format(k, v)
-                                          for k, v in params.items()]))
-
-        return self.tracker.announce(get_query())
+        conn = Connection(self)
+        self.peer_manager.add_connection(peername, conn)
+        conn.task = asyncio.current_task()
+        await conn.accept(reader, writer, handshake)
+
+    def get_announce_params(self):
+        return {'info_hash': self.info_hash,
+                'peer_id': self.id,
+                'port': self.port,
+                'uploaded': self.uploaded,
+                'downloaded': self.downloaded,
+                'left': self.get_left()}
 
     def get_left(self):
         return self.files.total_length - self.downloaded
 
     def distribute_requests(self):
-        def should_request(index, piece):
-            return (not self.files.piece_skip(index) and
-                    not piece['have'] and (not piece['requested'] or
-                    time.time() - piece['requested'] > REQUEST_TIMEOUT))
-
-        def get_max_requests_num():
-            return max(2, 2 * self.speed / self.files.piece_length)
-
-        requested = 0
-        conn_list = list(self.connections.values())
-        for index, piece in enumerate(self.files.pieces):
-            if should_request(index, piece):
-                random.shuffle(conn_list)
-                for conn in conn_list:
-                    if index in conn.has_pieces and not conn.broken:
-                        conn.request_piece(index)
-                        piece['requested'] = time.time()
-                        requested += 1
-                        break
-            if requested == get_max_requests_num():
-                break
-
-    def collect_pieces(self):
-        data_length = 0
+        for conn in list(self.connections.values()):
+            if not conn.broken and conn.peer_id:
+                conn.fill_pipeline()
+
+    async def collect_pieces(self):
+        for index, data, peers in self.picker.pop_completed():
+            await self.verifier.put(index, data, peers)
+
+    def on_verified(self, index, length, valid, peers):
+        if valid:
+            self.downloaded += length
+            self.send_have(index)
+        else:
+            self.picker.set_wanted(index, True)
+            for conn in peers:
+                self.peer_manager.add_hashfail(conn, len(peers))
+
+    def send_have(self, index):
         for conn in self.connections.values():
-            with conn.lock:
-                taken_pieces = []
-                for index, data in conn.completed_pieces.items():
-                    hash_ = sha1(data).digest()
-                    if self.files.hash_is_correct(index, hash_):
-                        with self.lock:
-                            self.files.write_piece(index, data)
-                        data_length += len(data)
-                        taken_pieces.append(index)
-                for index in taken_pieces:
-                    conn.completed_pieces.pop(index)
-        self.downloaded += data_length
-        self.speed = data_length / LOOP_TIME
+            if not conn.broken and conn.peer_id:
+                conn.send_have(index)
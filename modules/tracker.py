@@ -1,8 +1,257 @@
-from urllib import request
+import asyncio
+import random
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib import parse, request
 
 from modules import bencode
 
 
+HTTP_TIMEOUT = 30
+ANNOUNCE_TIMEOUT = 30
+ANNOUNCE_RETRY_INTERVAL = 60
+STOPPED_TIMEOUT = 5
+NUMWANT = 50
+SCRAPE_TTL = 900
+HTTP_MAX_SCRAPE = 50
+DHT_INTERVAL = 15 * 60
+SCRAPE_WORKERS = 4
+
+UDP_PROTOCOL_ID = 0x41727101980
+UDP_CONNECT = 0
+UDP_ANNOUNCE = 1
+UDP_SCRAPE = 2
+UDP_ERROR = 3
+UDP_EVENTS = {'': 0, 'completed': 1, 'started': 2, 'stopped': 3}
+UDP_TIMEOUT = 15
+UDP_RETRIES = 4
+UDP_CONNECTION_ID_TTL = 60
+UDP_MAX_SCRAPE = 74
+
+
+class TrackerError(Exception):
+    pass
+
+
+def get_tracker(url):
+    if parse.urlparse(url).scheme == 'udp':
+        return UDPTracker(url)
+    return Tracker(url)
+
+
+def get_timeout(timeout, deadline):
+    # Blocking calls are cut short at the deadline of the announce, so a
+    # dead tracker does not hold its thread long after nobody waits.
+    if deadline is None:
+        return timeout
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise TrackerError('Deadline passed.')
+    return min(timeout, left)
+
+
+class TrackerTiers:
+    def __init__(self, tiers, timeout=ANNOUNCE_TIMEOUT):
+        # Trackers of a tier are tried in random order, and the one that
+        # answers is moved to the front for the next announces.
+        self.tiers = [random.sample([get_tracker(url) for url in tier],
+                                    len(tier)) for tier in tiers if tier]
+        self.timeout = timeout
+        self.interval = None
+        self.reached = False
+        self.running = {}
+        self.announced = [0] * len(self.tiers)
+        self.intervals = [0] * len(self.tiers)
+        self.executor = ThreadPoolExecutor(max(1, len(self.tiers)))
+
+    async def announce(self, params, timeout=None):
+        # Tiers are announced to at the same time, so a dead tracker only
+        # delays the peers of its own tier. Each tier keeps its own
+        # interval and is only announced to when due, or for an event. A
+        # tier still busy with an earlier announce is waited for instead
+        # of started again, so each tier holds one thread of its own
+        # executor at most.
+        if not self.tiers:
+            return []
+        timeout = timeout or self.timeout
+        now = time.monotonic()
+        deadline = now + timeout
+        futures = {}
+        for index, tier in enumerate(self.tiers):
+            future = self.running.get(index)
+            if future is None:
+                if (now - self.announced[index] < self.intervals[index] and
+                        not params.get('event')):
+                    continue
+                future = self.executor.submit(self.announce_tier, tier,
+                                              params, deadline)
+                self.running[index] = future
+                self.announced[index] = now
+                self.intervals[index] = ANNOUNCE_RETRY_INTERVAL
+            futures[asyncio.wrap_future(future)] = index
+        done = set()
+        if futures:
+            done, pending = await asyncio.wait(list(futures),
+                                               timeout=timeout)
+        peers = {}
+        self.reached = False
+        for future in done:
+            index = futures[future]
+            del self.running[index]
+            tracker, tier_peers = future.result()
+            if tracker is None:
+                continue
+            self.reached = True
+            self.intervals[index] = max(
+                tracker.interval or ANNOUNCE_RETRY_INTERVAL,
+                tracker.min_interval or 0)
+            for peer in tier_peers:
+                peers.setdefault((peer['ip'], peer['port']), peer)
+        self.interval = max(0, min(
+            announced - now + interval
+            for announced, interval in zip(self.announced, self.intervals)))
+        return list(peers.values())
+
+    def get_tracker(self):
+        return self.tiers[0][0] if self.tiers else None
+
+    def announce_tier(self, tier, params, deadline=None):
+        # Whatever goes wrong with one tracker, e.g. a cut off or malformed
+        # response, only means that tracker failed.
+        for tracker in list(tier):
+            try:
+                peers = tracker.announce(params, deadline)
+            except Exception:
+                continue
+            tier.remove(tracker)
+            tier.insert(0, tracker)
+            return tracker, peers
+        return None, []
+
+
+class Scraper:
+    def __init__(self, ttl=SCRAPE_TTL):
+        self.ttl = ttl
+        self.stats = {}
+        self.executor = ThreadPoolExecutor(SCRAPE_WORKERS)
+
+    def get(self, info_hash):
+        return self.stats.get(info_hash, (0, None))[1]
+
+    async def scrape(self, torrents):
+        # Torrents sharing a tracker are scraped in one request, and only
+        # once their cached stats have expired.
+        now = time.time()
+        groups = {}
+        for tracker, info_hash in torrents:
+            if (tracker is None or
+                    self.stats.get(info_hash, (0, None))[0] > now):
+                continue
+            groups.setdefault(tracker.url, (tracker, []))[1].append(info_hash)
+        if not groups:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + ANNOUNCE_TIMEOUT
+        futures = {loop.run_in_executor(self.executor, tracker.scrape,
+                                        info_hashes, deadline): info_hashes
+                   for tracker, info_hashes in groups.values()}
+        done, pending = await asyncio.wait(futures, timeout=ANNOUNCE_TIMEOUT)
+        for future, info_hashes in futures.items():
+            try:
+                stats = future.result() if future in done else {}
+            except Exception:
+                stats = {}
+            for info_hash in info_hashes:
+                if info_hash in stats:
+                    self.stats[info_hash] = (now + self.ttl,
+                                             stats[info_hash])
+                else:
+                    self.stats[info_hash] = (now + ANNOUNCE_RETRY_INTERVAL,
+                                             self.get(info_hash))
+
+
+class Announcer:
+    def __init__(self, trackers, get_params, dht=None):
+        self.trackers = trackers
+        self.get_params = get_params
+        self.dht = dht
+        self.peers = asyncio.Queue()
+        self.event = 'started'
+        self.due = asyncio.Event()
+        self.task = None
+        self.dht_task = None
+
+    def start(self):
+        self.event = 'started'
+        loop = asyncio.get_running_loop()
+        self.task = loop.create_task(self.run())
+        if self.dht is not None:
+            self.dht_task = loop.create_task(self.run_dht())
+
+    def complete(self):
+        if self.event != 'started':
+            self.event = 'completed'
+        self.due.set()
+
+    async def run(self):
+        while True:
+            event = self.event
+            try:
+                peers = await self.trackers.announce(
+                    self.get_event_params(event))
+            except Exception:
+                # A failed round must not end the announces for good; it
+                # is retried like one where no tracker answered.
+                peers = []
+            if self.trackers.reached and self.event == event:
+                self.event = ''
+            for peer in peers:
+                self.peers.put_nowait(peer)
+            try:
+                await asyncio.wait_for(self.due.wait(),
+                                       self.trackers.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.due.clear()
+
+    async def run_dht(self):
+        # Lookups that found nothing, e.g. while the node is still
+        # bootstrapping, are retried sooner.
+        while True:
+            params = self.get_params()
+            peers = await self.dht.get_peers(params['info_hash'],
+                                             params['port'])
+            for peer in peers:
+                self.peers.put_nowait(peer)
+            await asyncio.sleep(DHT_INTERVAL if peers
+                                else ANNOUNCE_RETRY_INTERVAL)
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        self.task = None
+        if self.dht_task is not None:
+            self.dht_task.cancel()
+            self.dht_task = None
+        # Trackers that never saw the started event do not know the peer.
+        if self.event != 'started':
+            try:
+                await self.trackers.announce(
+                    self.get_event_params('stopped'), STOPPED_TIMEOUT)
+            except Exception:
+                pass
+
+    def get_event_params(self, event):
+        params = dict(self.get_params(), compact=1, numwant=NUMWANT)
+        if event:
+            params['event'] = event
+        return params
+
+
 class Tracker:
     def __init__(self, url):
         self.url = url
@@ -12,20 +261,67 @@ class Tracker:
         self.complete = 0
         self.incomplete = 0
 
-    def announce(self, query):
+    def announce(self, params, deadline=None):
         if self.tracker_id:
-            query += '?trackerid={}'.format(self.tracker_id)
-        response = self.send_request(query)
+            params = dict(params, trackerid=self.tracker_id)
+        response = self.send_request(self.get_query(params),
+                                     deadline=deadline)
         return self.handle_response(response)
 
-    def send_request(self, query):
-        return request.urlopen(self.url + query).read()
+    def get_query(self, params):
+        separator = '&' if '?' in self.url else '?'
+        return separator + parse.urlencode(params, quote_via=parse.quote)
+
+    def send_request(self, query, url=None, deadline=None):
+        return request.urlopen((url or self.url) + query,
+                               timeout=get_timeout(HTTP_TIMEOUT,
+                                                   deadline)).read()
+
+    def scrape(self, info_hashes, deadline=None):
+        url = self.get_scrape_url()
+        result = {}
+        for i in range(0, len(info_hashes), HTTP_MAX_SCRAPE):
+            params = [('info_hash', info_hash)
+                      for info_hash in info_hashes[i:i + HTTP_MAX_SCRAPE]]
+            data = self.decode_response(self.send_request(
+                self.get_query(params), url, deadline))
+            for info_hash, stats in data[b'files'].items():
+                result[info_hash] = {
+                    'complete': stats.get(b'complete', 0),
+                    'downloaded': stats.get(b'downloaded', 0),
+                    'incomplete': stats.get(b'incomplete', 0)}
+        return result
+
+    def get_scrape_url(self):
+        # By convention the scrape URL replaces the last 'announce' path
+        # part; trackers with other URLs do not support scraping.
+        parsed = parse.urlparse(self.url)
+        head, name = parsed.path.rsplit('/', 1)
+        if not name.startswith('announce'):
+            raise TrackerError('Tracker {} does not support scrape.'.format(
+                self.url))
+        path = '{}/scrape{}'.format(head, name[len('announce'):])
+        return parse.urlunparse(parsed._replace(path=path))
 
     def handle_response(self, response):
-        data = bencode.decode(response)[0]
+        data = self.decode_response(response)
         self.update_state(data)
         return self.get_peers(data[b'peers'])
 
+    def decode_response(self, response):
+        try:
+            data = bencode.decode(response)[0]
+        except (ValueError, IndexError, TypeError):
+            raise TrackerError('Tracker {} sent invalid bencode.'.format(
+                self.url))
+        if not isinstance(data, dict):
+            raise TrackerError('Tracker {} sent no dictionary.'.format(
+                self.url))
+        if b'failure reason' in data:
+            raise TrackerError(data[b'failure reason'].decode(
+                errors='replace'))
+        return data
+
     def update_state(self, data):
         def set_attr(key, attr, update=True):
             if key in data and (update or not getattr(self, attr)):
@@ -57,3 +353,103 @@ class Tracker:
             return peers_binary_model()
         else:
             raise ValueError('Unsupported peer model.')
+
+
+class UDPTracker(Tracker):
+    # Connection IDs are valid for a minute and may be shared by every
+    # torrent announcing to the same tracker.
+    connection_ids = {}
+    connection_ids_lock = threading.Lock()
+
+    def __init__(self, url, timeout=UDP_TIMEOUT, retries=UDP_RETRIES):
+        super().__init__(url)
+        parsed = parse.urlparse(url)
+        self.address = (parsed.hostname, parsed.port)
+        self.timeout = timeout
+        self.retries = retries
+
+    def announce(self, params, deadline=None):
+        payload = struct.pack('>20s20sQQQIIIiH', params['info_hash'],
+                              params['peer_id'].encode(),
+                              params['downloaded'], params['left'],
+                              params['uploaded'],
+                              UDP_EVENTS[params.get('event', '')], 0,
+                              random.getrandbits(32),
+                              params.get('numwant', -1), params['port'])
+        response = self.send_action(UDP_ANNOUNCE, payload, deadline)
+        if len(response) < 12:
+            raise TrackerError('Announce response is too short.')
+        interval, incomplete, complete = struct.unpack('>III',
+                                                       response[:12])
+        self.update_state({b'interval': interval, b'complete': complete,
+                           b'incomplete': incomplete})
+        peers = response[12:]
+        return self.get_peers(peers[:len(peers) - len(peers) % 6])
+
+    def scrape(self, info_hashes, deadline=None):
+        result = {}
+        for i in range(0, len(info_hashes), UDP_MAX_SCRAPE):
+            chunk = info_hashes[i:i + UDP_MAX_SCRAPE]
+            response = self.send_action(UDP_SCRAPE, b''.join(chunk),
+                                        deadline)
+            for j, info_hash in enumerate(chunk):
+                stats = response[j * 12:j * 12 + 12]
+                if len(stats) < 12:
+                    break
+                complete, downloaded, incomplete = struct.unpack('>III',
+                                                                 stats)
+                result[info_hash] = {'complete': complete,
+                                     'downloaded': downloaded,
+                                     'incomplete': incomplete}
+        return result
+
+    def send_action(self, action, payload, deadline=None):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for attempt in range(self.retries):
+                # BEP 15 backoff: the timeout doubles with every retry.
+                sock.settimeout(get_timeout(self.timeout * 2**attempt,
+                                            deadline))
+                try:
+                    connection_id = self.get_connection_id(sock)
+                    return self.exchange(sock, connection_id, action,
+                                         payload)
+                except socket.timeout:
+                    self.forget_connection_id()
+        raise TrackerError('Tracker {} did not respond.'.format(self.url))
+
+    def get_connection_id(self, sock):
+        with self.connection_ids_lock:
+            cached = self.connection_ids.get(self.address)
+        if cached and time.time() < cached[1]:
+            return cached[0]
+        response = self.exchange(sock, UDP_PROTOCOL_ID, UDP_CONNECT, b'')
+        if len(response) < 8:
+            raise TrackerError('Connect response is too short.')
+        connection_id = struct.unpack('>Q', response[:8])[0]
+        with self.connection_ids_lock:
+            self.connection_ids[self.address] = (
+                connection_id, time.time() + UDP_CONNECTION_ID_TTL)
+        return connection_id
+
+    def forget_connection_id(self):
+        with self.connection_ids_lock:
+            self.connection_ids.pop(self.address, None)
+
+    def exchange(self, sock, connection_id, action, payload):
+        transaction_id = random.getrandbits(32)
+        sock.sendto(struct.pack('>QII', connection_id, action,
+                                transaction_id) + payload, self.address)
+        while True:
+            data = sock.recv(65536)
+            if len(data) < 8:
+                continue
+            response_action, response_id = struct.unpack('>II', data[:8])
+            if response_id != transaction_id:
+                continue
+            if response_action == UDP_ERROR:
+                if connection_id != UDP_PROTOCOL_ID:
+                    self.forget_connection_id()
+                raise TrackerError(data[8:].decode(errors='replace'))
+            if response_action != action:
+                raise TrackerError('Unexpected action in response.')
+            return data[8:]
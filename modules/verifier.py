@@ -0,0 +1,114 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+
+
+WORKERS = 2
+QUEUE_SIZE = 8
+RECHECK_WORKERS = 4
+RECHECK_READ_SIZE = 2**23
+
+
+def recheck(files, workers=RECHECK_WORKERS, read_size=RECHECK_READ_SIZE,
+            progress=None):
+    def check_pieces(first, count):
+        data = memoryview(files.read_pieces(first, count))
+        valid = []
+        pos = 0
+        for index in range(first, first + count):
+            length = files.get_piece_length(index)
+            hash_ = sha1(data[pos:pos + length]).digest()
+            valid.append(files.hash_is_correct(index, hash_))
+            pos += length
+        return valid, pos
+
+    step = max(1, read_size // files.piece_length)
+    valid = []
+    checked = 0
+    started = time.time()
+    with ThreadPoolExecutor(workers) as executor:
+        # Every worker reads and hashes its own run of pieces; a couple of
+        # runs per worker stay queued so the disk never waits for hashing.
+        pending = deque()
+        for first in range(0, files.piece_num, step):
+            if len(pending) >= 2 * workers:
+                checked += collect(pending.popleft(), valid)
+                if progress:
+                    progress(checked, time.time() - started)
+            pending.append(executor.submit(
+                check_pieces, first, min(step, files.piece_num - first)))
+        while pending:
+            checked += collect(pending.popleft(), valid)
+            if progress:
+                progress(checked, time.time() - started)
+    return valid
+
+
+def collect(future, valid):
+    pieces_valid, length = future.result()
+    valid.extend(pieces_valid)
+    return length
+
+
+class Verifier:
+    def __init__(self, files, on_verified, workers=WORKERS,
+                 queue_size=QUEUE_SIZE):
+        self.files = files
+        self.on_verified = on_verified
+        self.workers = workers
+        self.queue = asyncio.Queue(queue_size)
+        self.executor = None
+        self.tasks = []
+
+    def start(self):
+        # sha1 and os.pwrite release the GIL, so pieces are hashed and
+        # written in parallel while the event loop keeps serving peers.
+        self.executor = ThreadPoolExecutor(self.workers)
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self.work())
+                      for i in range(self.workers)]
+
+    async def join(self):
+        await self.queue.join()
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        if self.executor:
+            executor, self.executor = self.executor, None
+            # Pieces still being hashed and written are waited for in
+            # another thread, so the loop keeps serving other torrents.
+            await asyncio.get_running_loop().run_in_executor(
+                None, executor.shutdown)
+
+    async def put(self, index, data, peers):
+        await self.queue.put((index, data, peers))
+
+    async def check(self, index):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          self.files.check_piece, index)
+
+    async def work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            index, data, peers = await self.queue.get()
+            try:
+                valid = await loop.run_in_executor(self.executor,
+                                                   self.verify, index, data)
+                if valid is not None:
+                    self.on_verified(index, len(data), valid, peers)
+            finally:
+                self.queue.task_done()
+
+    def verify(self, index, data):
+        # None means the piece is fine but was already had, so it is
+        # neither counted nor blamed on anyone.
+        if not self.files.hash_is_correct(index, sha1(data).digest()):
+            return False
+        if not self.files.write_piece(index, data):
+            return None
+        return True
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import io
 import unittest
 import sys
 import os
@@ -37,6 +38,41 @@ class TestDecoding(unittest.TestCase):
         self.base_test(b'd4:dictd4:smthi5eee',
                        [{b'dict': {b'smth': 5}}])
 
+    def test_negative_integer(self):
+        self.base_test(b'i-3e', [-3])
+
+    def test_deep_nesting(self):
+        depth = 100000
+        result = bencode.decode(b'l' * depth + b'e' * depth)[0]
+        for i in range(depth - 1):
+            result = result[0]
+        self.assertListEqual([], result)
+
+    def test_memoryview(self):
+        self.base_test(memoryview(b'xl3:fooe')[1:], [[b'foo']])
+
+    def test_invalid(self):
+        for data in (b'x', b'i12', b'5:abc', b'di1e3:fooe', b'd3:fooe'):
+            with self.assertRaises(ValueError):
+                bencode.decode(data)
+
+    def test_metainfo_info_span(self):
+        info = b'd6:lengthi5e4:name1:ae'
+        data = b'd8:announce3:url4:info' + info + b'5:zzzzzi0ee'
+        meta, raw_info = bencode.decode_metainfo(data)
+        self.assertEqual(info, raw_info)
+        self.assertEqual({b'length': 5, b'name': b'a'}, meta[b'info'])
+
+    def test_metainfo_keeps_key_order(self):
+        info = b'd4:name1:a6:lengthi5ee'
+        meta, raw_info = bencode.decode_metainfo(b'd4:info' + info + b'e')
+        self.assertEqual(info, raw_info)
+        self.assertNotEqual(info, bencode.encode(meta[b'info']))
+
+    def test_metainfo_without_info(self):
+        with self.assertRaises(ValueError):
+            bencode.decode_metainfo(b'd8:announce3:urle')
+
 
 class TestEncoding(unittest.TestCase):
     def base_test(self, data, expected):
@@ -67,5 +103,23 @@ class TestEncoding(unittest.TestCase):
         self.base_test({b'key1': b'val1', b'key2': [12, []]},
                        b'd4:key14:val14:key2li12eleee')
 
+    def test_dict_keys_are_sorted(self):
+        self.base_test({b'b': 1, b'a': {b'd': 2, b'c': 3}},
+                       b'd1:ad1:ci3e1:di2ee1:bi1ee')
+
+    def test_non_bytes_key(self):
+        with self.assertRaises(TypeError):
+            bencode.encode({'key': 1})
+
+    def test_buffers(self):
+        self.base_test([bytearray(b'ab'), memoryview(b'cd')],
+                       b'l2:ab2:cde')
+
+    def test_dump(self):
+        data = {b'pieces': b'\x01' * 100, b'files': [{b'length': 5}] * 10}
+        file = io.BytesIO()
+        bencode.dump(data, file, flush_size=16)
+        self.assertEqual(bencode.encode(data), file.getvalue())
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
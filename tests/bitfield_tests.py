@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from modules.bitfield import Bitfield
+
+
+class BitfieldTest(unittest.TestCase):
+    def test_spare_bits_are_cleared(self):
+        bitfield = Bitfield(10, b'\xff\xff\xff')
+        self.assertEqual(b'\xff\xc0', bitfield.to_bytes())
+        self.assertEqual(10, bitfield.count())
+        self.assertTrue(bitfield.all())
+        self.assertNotIn(10, bitfield)
+
+    def test_add_and_discard(self):
+        bitfield = Bitfield(20)
+        self.assertFalse(bitfield)
+        bitfield.update([0, 9, 19])
+        bitfield.discard(9)
+        self.assertEqual([0, 19], list(bitfield))
+        self.assertIn(19, bitfield)
+        self.assertNotIn(9, bitfield)
+        self.assertEqual(2, bitfield.count())
+
+    def test_difference(self):
+        peer = Bitfield(12, b'\xf0\xf0')
+        have = Bitfield(12, b'\xc0\x10')
+        self.assertEqual([2, 3, 8, 9, 10], list(peer.difference(have)))
+
+    def test_from_int(self):
+        bitfield = Bitfield.from_int(20, 1 << 23 | 1 << 4)
+        self.assertEqual([0, 19], list(bitfield))
+        self.assertEqual(3, len(bitfield.to_bytes()))
+
+    def test_union(self):
+        bitfield = Bitfield(12, b'\x80\x00')
+        bitfield.update(Bitfield(12, b'\x01\x10'))
+        self.assertEqual([0, 7, 11], list(bitfield))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from modules.choker import OPTIMISTIC_ROUNDS, Choker
+
+
+class FakeConn:
+    def __init__(self, rate, interested=True, connected=0):
+        self.rate = rate
+        self.interested = interested
+        self.connected = connected
+        self.broken = False
+        self.peer_id = b'peer'
+        self.am_choking = True
+        self.downloaded = 0
+        self.uploaded = 0
+
+    def send_choke(self):
+        self.am_choking = True
+
+    def send_unchoke(self):
+        self.am_choking = False
+
+
+class ChokerTest(unittest.TestCase):
+    def setUp(self):
+        self.choker = Choker(slots=2)
+
+    def make_swarm(self, rates):
+        return [FakeConn(rate) for rate in rates]
+
+    def run_round(self, conns, seeding=False):
+        # Unchoked peers reciprocate: they send us data at their rate, or
+        # take it at their rate when we are seeding.
+        for conn in conns:
+            if not conn.am_choking and seeding:
+                conn.uploaded += conn.rate
+            elif not conn.am_choking:
+                conn.downloaded += conn.rate
+        self.choker.choke(conns, seeding)
+        return {conn for conn in conns if not conn.am_choking}
+
+    def settle(self, conns, seeding=False):
+        for i in range(OPTIMISTIC_ROUNDS * 30):
+            self.run_round(conns, seeding)
+
+    def test_fastest_unchoked(self):
+        conns = self.make_swarm([10, 50, 30, 20, 40])
+        self.settle(conns)
+        for i in range(OPTIMISTIC_ROUNDS * 2):
+            unchoked = self.run_round(conns)
+            self.assertIn(conns[1], unchoked)
+            self.assertIn(conns[4], unchoked)
+            self.assertNotIn(self.choker.optimistic, (conns[1], conns[4]))
+            self.assertEqual(3, len(unchoked))
+
+    def test_uninterested_choked(self):
+        conns = self.make_swarm([50, 40, 30])
+        self.run_round(conns)
+        conns[0].interested = False
+        unchoked = self.run_round(conns)
+        self.assertNotIn(conns[0], unchoked)
+        self.assertEqual({conns[1], conns[2]}, unchoked)
+
+    def test_optimistic_rotates(self):
+        conns = self.make_swarm([100, 90] + [1] * 6)
+        self.settle(conns)
+        optimistic = set()
+        for i in range(OPTIMISTIC_ROUNDS * 30):
+            self.run_round(conns)
+            optimistic.add(self.choker.optimistic)
+        self.assertNotIn(conns[0], optimistic)
+        self.assertNotIn(conns[1], optimistic)
+        self.assertGreater(len(optimistic), 2)
+
+    def test_optimistic_kept_between_rotations(self):
+        conns = self.make_swarm([100, 90] + [1] * 6)
+        self.settle(conns)
+        while self.choker.rounds % OPTIMISTIC_ROUNDS:
+            self.run_round(conns)
+        self.run_round(conns)
+        optimistic = self.choker.optimistic
+        for i in range(OPTIMISTIC_ROUNDS - 1):
+            self.run_round(conns)
+            self.assertIs(optimistic, self.choker.optimistic)
+
+    def test_late_fast_peer_promoted(self):
+        # A choked peer can not show its rate; the optimistic slot finds
+        # it and it then keeps a regular slot.
+        conns = self.make_swarm([20, 10, 1, 1])
+        self.settle(conns)
+        fast = FakeConn(100)
+        conns.append(fast)
+        self.settle(conns)
+        self.assertIn(fast, self.run_round(conns))
+        self.assertIsNot(fast, self.choker.optimistic)
+
+    def test_seeding_ranks_by_upload(self):
+        conns = self.make_swarm([10, 50, 30, 20])
+        for conn in conns:
+            conn.downloaded = 10**6 // conn.rate
+        self.settle(conns, seeding=True)
+        unchoked = self.run_round(conns, seeding=True)
+        self.assertIn(conns[1], unchoked)
+        self.assertIn(conns[2], unchoked)
+
+    def test_new_peers_preferred(self):
+        now = time.time()
+        old = [FakeConn(0) for i in range(20)]
+        new = FakeConn(0, connected=now)
+        picks = [self.choker.pick_optimistic(old + [new])
+                 for i in range(2000)]
+        self.assertGreater(picks.count(new), 2000 * 2 / 23)
+
+    def test_fill_slots(self):
+        conns = self.make_swarm([10, 20, 30, 40])
+        self.choker.fill_slots(conns)
+        self.assertEqual(3, sum(not conn.am_choking for conn in conns))
+        conns[0].interested = False
+        self.choker.fill_slots(conns)
+        self.assertFalse(conns[3].am_choking)
+
+    def test_update_waits_for_interval(self):
+        conns = self.make_swarm([10, 20, 30, 40])
+        self.choker.update(conns, False)
+        unchoked = {conn for conn in conns if not conn.am_choking}
+        conns[0].downloaded += 1000
+        self.choker.update(conns, False)
+        self.assertEqual(unchoked,
+                         {conn for conn in conns if not conn.am_choking})
+
+
+if __name__ == '__main__':
+    unittest.main()
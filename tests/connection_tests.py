@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+import tempfile
+import unittest
+
+import helpers
+from modules import bencode
+from modules.pwp import messages
+from modules.pwp.connection import BLOCK_TIMEOUT, PEX_MAX_PEERS, Connection
+
+BLOCK = 2**14
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = helpers.make_data(2**16)
+        info = helpers.make_info('test', self.data, 2 * BLOCK)
+        self.torrent = helpers.make_torrent_stub(info, self.tmp.name)
+        self.picker = self.torrent.picker
+        for index in range(2):
+            self.picker.set_wanted(index, True)
+        # Piece 1 is more common, so piece 0 is picked first.
+        self.picker.add_peer_pieces([1])
+        self.conn = self.make_connection()
+
+    def tearDown(self):
+        self.torrent.files.close_files()
+        self.tmp.cleanup()
+
+    def make_connection(self, pipeline_size=3):
+        conn = Connection(self.torrent, pipeline_size=pipeline_size,
+                          adaptive_pipeline=False)
+        conn.writer = helpers.FakeWriter()
+        conn.handle_message({'type': 'bitfield', 'bitfield': b'\xc0'})
+        return conn
+
+    def get_sent_requests(self, conn=None):
+        conn = conn or self.conn
+        return [(m['index'], m['begin'])
+                for m in conn.writer.pop_messages()
+                if m['type'] == 'request']
+
+    def send_block(self, index, begin):
+        start = index * 2 * BLOCK + begin
+        self.conn.handle_message({'type': 'piece', 'index': index,
+                                  'begin': begin,
+                                  'block': self.data[start:start + BLOCK]})
+
+    def test_interested_while_choked(self):
+        sent = self.conn.writer.pop_messages()
+        self.assertListEqual([{'type': 'interested'}], sent)
+        self.assertEqual(0, len(self.conn.requests))
+
+    def test_pipeline_size(self):
+        self.conn.handle_message({'type': 'unchoke'})
+        self.assertListEqual([(0, 0), (0, BLOCK), (1, 0)],
+                             self.get_sent_requests())
+        self.assertEqual(3, len(self.conn.in_flight))
+
+    def test_piece_frees_slot(self):
+        self.conn.handle_message({'type': 'unchoke'})
+        self.get_sent_requests()
+        self.send_block(0, 0)
+        self.conn.fill_pipeline()
+        self.assertListEqual([(1, BLOCK)], self.get_sent_requests())
+
+    def test_piece_completed(self):
+        self.conn.handle_message({'type': 'unchoke'})
+        self.send_block(0, 0)
+        self.send_block(0, BLOCK)
+        self.assertListEqual([(0, self.data[:2 * BLOCK], {self.conn})],
+                             self.picker.pop_completed())
+
+    def test_meters(self):
+        self.conn.handle_message({'type': 'unchoke'})
+        self.send_block(0, 0)
+        self.assertEqual(BLOCK, self.conn.meter.download.total)
+        self.assertEqual(BLOCK, self.torrent.meter.download.total)
+        self.assertEqual(self.conn.meter.overhead.total,
+                         len(messages.build_interested()) +
+                         3 * len(messages.build_request(0, 0, BLOCK)))
+
+    def test_hashfails(self):
+        self.conn.add_hashfail()
+        self.assertFalse(self.conn.broken)
+        self.conn.add_hashfail()
+        self.assertTrue(self.conn.broken)
+
+    def test_choke_releases_blocks(self):
+        self.conn.handle_message({'type': 'unchoke'})
+        self.get_sent_requests()
+        self.conn.handle_message({'type': 'choke'})
+        self.assertEqual({}, self.conn.in_flight)
+        self.assertEqual(2, self.picker.downloading[0].unrequested)
+        other = self.make_connection()
+        other.handle_message({'type': 'unchoke'})
+        self.assertListEqual([(0, 0), (0, BLOCK), (1, 0)],
+                             self.get_sent_requests(other))
+
+    def test_blocks_shared_between_peers(self):
+        self.conn.pipeline_size = 1
+        self.conn.handle_message({'type': 'unchoke'})
+        other = self.make_connection(pipeline_size=1)
+        other.handle_message({'type': 'unchoke'})
+        self.assertListEqual([(0, 0)], self.get_sent_requests())
+        self.assertListEqual([(0, BLOCK)], self.get_sent_requests(other))
+
+    def test_expired_blocks_go_to_other_peer(self):
+        self.conn.handle_message({'type': 'unchoke'})
+        self.get_sent_requests()
+        for sent in self.conn.in_flight.values():
+            sent['time'] -= BLOCK_TIMEOUT + 1
+        self.conn.drop_expired_requests()
+        self.conn.fill_pipeline()
+        self.assertListEqual([(1, BLOCK)], self.get_sent_requests())
+        other = self.make_connection()
+        other.handle_message({'type': 'unchoke'})
+        self.assertListEqual([(0, 0), (0, BLOCK), (1, 0)],
+                             self.get_sent_requests(other))
+
+    def test_reject(self):
+        self.conn.handle_message({'type': 'unchoke'})
+        self.conn.handle_message({'type': 'reject', 'index': 0,
+                                  'begin': 0, 'length': BLOCK})
+        self.assertListEqual([(0, BLOCK), (1, 0)],
+                             list(self.conn.in_flight))
+        self.assertEqual(1, self.picker.downloading[0].unrequested)
+
+    def test_close_releases_blocks(self):
+        self.conn.handle_message({'type': 'unchoke'})
+        self.conn.close()
+        self.assertEqual(2, self.picker.downloading[0].unrequested)
+        self.assertEqual([0, 1], self.picker.availability)
+
+    def test_duplicate_cancelled(self):
+        self.conn.handle_message({'type': 'unchoke'})
+        other = self.make_connection(pipeline_size=4)
+        other.handle_message({'type': 'unchoke'})
+        self.assertEqual(4, len(self.get_sent_requests(other)))
+        self.get_sent_requests()
+        self.send_block(0, 0)
+        self.assertSetEqual({(0, BLOCK), (1, 0), (1, BLOCK)},
+                            set(other.in_flight))
+        self.assertListEqual([{'type': 'cancel', 'index': 0, 'begin': 0,
+                               'length': BLOCK}],
+                             other.writer.pop_messages())
+
+    def test_cancel(self):
+        self.conn.handle_message({'type': 'unchoke'})
+        self.get_sent_requests()
+        self.conn.cancel_request(0, 0, BLOCK)
+        sent = self.conn.writer.pop_messages()
+        self.assertListEqual([{'type': 'cancel', 'index': 0, 'begin': 0,
+                               'length': BLOCK}], sent)
+        self.assertEqual(2, len(self.conn.in_flight))
+
+
+class PexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        info = helpers.make_info('test', helpers.make_data(BLOCK), BLOCK)
+        self.torrent = helpers.make_torrent_stub(info, self.tmp.name)
+        self.conn = Connection(self.torrent)
+        self.conn.writer = helpers.FakeWriter()
+        self.conn.address = ('10.0.0.9', 9)
+
+    def tearDown(self):
+        self.torrent.files.close_files()
+        self.tmp.cleanup()
+
+    def receive(self, extended_id, data):
+        self.conn.handle_message({'type': 'extended',
+                                  'extended_id': extended_id,
+                                  'data': bencode.encode(data)})
+
+    def get_sent(self):
+        return [bencode.decode(m['data'])[0]
+                for m in self.conn.writer.pop_messages()
+                if m['type'] == 'extended']
+
+    def test_extended_handshake(self):
+        self.conn.supports_extensions = True
+        self.conn.send_extended_handshake()
+        self.assertEqual([{b'm': {b'ut_pex': messages.UT_PEX_ID},
+                           b'p': 6881}], self.get_sent())
+        self.receive(0, {b'm': {b'ut_pex': 5, b'other': 2}})
+        self.receive(0, {b'm': {b'other': 0}})
+        self.assertEqual({b'ut_pex': 5}, self.conn.extensions)
+
+    def test_listen_port(self):
+        self.conn.address = ('10.0.0.9', None)
+        self.receive(0, {b'p': 7000})
+        self.assertEqual(('10.0.0.9', 7000), self.conn.address)
+        self.receive(0, {b'p': 7001})
+        self.assertEqual(('10.0.0.9', 7000), self.conn.address)
+
+    def test_receive_pex(self):
+        added = messages.encode_peers([('10.0.0.{}'.format(i), i + 1)
+                                       for i in range(PEX_MAX_PEERS + 5)])
+        self.receive(messages.UT_PEX_ID, {b'added': added})
+        self.assertEqual(PEX_MAX_PEERS, len(self.torrent.peers))
+        self.assertEqual({'ip': '10.0.0.0', 'port': 1}, self.torrent.peers[0])
+        self.receive(messages.UT_PEX_ID, {b'added': added})
+        self.assertEqual(PEX_MAX_PEERS, len(self.torrent.peers))
+
+    def test_send_pex(self):
+        peers = {('10.0.0.1', 1), ('10.0.0.2', 2), ('10.0.0.9', 9)}
+        self.torrent.get_peer_addresses = lambda: set(peers)
+        self.conn.send_pex()
+        self.assertEqual([], self.get_sent())
+        self.receive(0, {b'm': {b'ut_pex': 5}})
+        self.conn.send_pex()
+        sent = self.get_sent()
+        self.assertCountEqual([('10.0.0.1', 1), ('10.0.0.2', 2)],
+                              messages.decode_peers(sent[0][b'added']))
+        self.assertEqual(b'', sent[0][b'dropped'])
+        self.conn.send_pex()
+        self.assertEqual([], self.get_sent())
+        peers.remove(('10.0.0.1', 1))
+        self.conn.pex_sent = 0
+        self.conn.send_pex()
+        sent = self.get_sent()
+        self.assertEqual(b'', sent[0][b'added'])
+        self.assertEqual([('10.0.0.1', 1)],
+                         messages.decode_peers(sent[0][b'dropped']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+import helpers
+from modules import bencode
+from modules.dht import (ERROR_METHOD, ERROR_PROTOCOL, K, NODE_TIMEOUT,
+                         DHTNode, KRPCError, RoutingTable, make_node)
+
+
+def make_id(value):
+    return value.to_bytes(20, 'big')
+
+
+class RoutingTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = RoutingTable(make_id(0))
+
+    def add(self, value, seen=None):
+        return self.table.add(make_node(make_id(value), ('127.0.0.1', value),
+                                        time.time() if seen is None
+                                        else seen))
+
+    def test_split_own_bucket(self):
+        for i in range(K):
+            self.assertTrue(self.add(2**159 + i))
+        self.assertFalse(self.add(2**159 + K))
+        self.assertEqual(2, len(self.table.buckets))
+        for i in range(K):
+            self.assertTrue(self.add(i + 1))
+        self.assertEqual(2 * K, len(self.table.get_nodes()))
+
+    def test_replace_stale(self):
+        for i in range(K):
+            self.add(2**159 + i, time.time() - NODE_TIMEOUT - 1)
+        self.add(1)
+        self.assertTrue(self.add(2**159 + K))
+        self.assertIsNone(self.table.get(make_id(2**159)))
+
+    def test_update_known(self):
+        self.add(5, 0)
+        self.add(5)
+        self.assertEqual(1, len(self.table.get_nodes()))
+        self.assertGreater(self.table.get(make_id(5))['seen'], 0)
+
+    def test_closest(self):
+        for value in (1, 2, 3, 8, 2**100):
+            self.add(value)
+        self.assertEqual([make_id(3), make_id(2), make_id(1)],
+                         [node['id'] for node in
+                          self.table.closest(make_id(3), 3)])
+
+    def test_fail(self):
+        self.add(5)
+        self.table.fail(make_id(5))
+        self.assertIsNotNone(self.table.get(make_id(5)))
+        self.table.fail(make_id(5))
+        self.assertIsNone(self.table.get(make_id(5)))
+
+    def test_ignore_own_id(self):
+        self.assertFalse(self.add(0))
+
+
+class DHTNodeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.tmp.cleanup()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    async def start_nodes(self, count):
+        nodes = []
+        for i in range(count):
+            node = DHTNode(0, '{}/{}.dat'.format(self.tmp.name, i),
+                           bootstrap=[])
+            await node.start('127.0.0.1')
+            nodes.append(node)
+        for node in nodes[1:]:
+            node.bootstrap_nodes = [('127.0.0.1', nodes[0].port)]
+            await node.bootstrap()
+        return nodes
+
+    def stop_nodes(self, nodes):
+        for node in nodes:
+            node.stop()
+
+    def test_get_peers_and_announce(self):
+        async def run():
+            nodes = await self.start_nodes(12)
+            try:
+                info_hash = os.urandom(20)
+                self.assertEqual([], await nodes[3].get_peers(info_hash,
+                                                              6881))
+                return await nodes[9].get_peers(info_hash)
+            finally:
+                self.stop_nodes(nodes)
+
+        self.assertEqual([{'ip': '127.0.0.1', 'port': 6881}],
+                         self.run_async(run()))
+
+    def test_bootstrap_fills_tables(self):
+        async def run():
+            nodes = await self.start_nodes(6)
+            self.stop_nodes(nodes)
+            return [len(node.table.get_nodes()) for node in nodes]
+
+        self.assertEqual([5] * 6, self.run_async(run()))
+
+    def test_bad_token(self):
+        async def run():
+            nodes = await self.start_nodes(2)
+            try:
+                with self.assertRaises(KRPCError) as error:
+                    await nodes[1].query(
+                        ('127.0.0.1', nodes[0].port), 'announce_peer',
+                        {b'info_hash': b'\x01' * 20, b'port': 1,
+                         b'token': b'bad'})
+                self.assertEqual(ERROR_PROTOCOL, error.exception.args[0])
+                with self.assertRaises(KRPCError) as error:
+                    await nodes[1].query(('127.0.0.1', nodes[0].port),
+                                         'vote', {})
+                self.assertEqual(ERROR_METHOD, error.exception.args[0])
+            finally:
+                self.stop_nodes(nodes)
+
+        self.run_async(run())
+
+    def test_malformed_packets(self):
+        def receive(message):
+            node.datagram_received(bencode.encode(message), address)
+
+        node = DHTNode(0, self.tmp.name + '/0.dat', bootstrap=[])
+        sent = []
+        node.transport = SimpleNamespace(
+            sendto=lambda data, address: sent.append(bencode.decode(data)[0]))
+        address = ('127.0.0.1', 1)
+        args = {b'id': make_id(1)}
+        future = self.loop.create_future()
+        node.transactions[b'aa'] = (future, address)
+        receive({b't': [1], b'y': b'r', b'r': args})
+        receive({b't': {b'a': 1}, b'y': b'e', b'e': [201, b'x']})
+        self.assertFalse(future.done())
+        receive({b't': b'aa', b'y': b'e', b'e': 1})
+        self.assertEqual(ERROR_PROTOCOL, future.exception().args[0])
+        receive({b't': b'bb', b'y': b'q', b'q': [b'ping'], b'a': args})
+        receive({b't': [1], b'y': b'q', b'q': b'ping', b'a': args})
+        self.assertEqual([{b't': b'bb', b'y': b'e',
+                           b'e': [ERROR_PROTOCOL, b'Invalid query.']},
+                          {b't': b'', b'y': b'e',
+                           b'e': [ERROR_PROTOCOL, b'Invalid query.']}],
+                         sent)
+
+    def test_implied_port(self):
+        async def run():
+            nodes = await self.start_nodes(2)
+            try:
+                address = ('127.0.0.1', nodes[0].port)
+                response = await nodes[1].query(
+                    address, 'get_peers', {b'info_hash': b'\x01' * 20})
+                await nodes[1].query(
+                    address, 'announce_peer',
+                    {b'info_hash': b'\x01' * 20, b'port': 1,
+                     b'implied_port': 1, b'token': response[b'token']})
+                return list(nodes[0].peers[b'\x01' * 20]), nodes[1].port
+            finally:
+                self.stop_nodes(nodes)
+
+        peers, port = self.run_async(run())
+        self.assertEqual([('127.0.0.1', port)], peers)
+
+    def test_persisted_nodes(self):
+        async def run():
+            nodes = await self.start_nodes(3)
+            self.stop_nodes(nodes)
+            return nodes[2]
+
+        node = self.run_async(run())
+        restored = DHTNode(0, node.path, bootstrap=[])
+        self.assertEqual(node.node_id, restored.node_id)
+        self.assertCountEqual(
+            [(n['id'], n['address']) for n in node.table.get_nodes()],
+            [(n['id'], n['address']) for n in restored.table.get_nodes()])
+
+    def test_no_response(self):
+        async def run():
+            nodes = await self.start_nodes(1)
+            silent = ('127.0.0.1', helpers.get_free_port())
+            nodes[0].table.add(make_node(b'\x01' * 20, silent))
+            nodes[0].timeout = 0.1
+            peers = await nodes[0].get_peers(b'\x02' * 20)
+            await nodes[0].get_peers(b'\x02' * 20)
+            self.stop_nodes(nodes)
+            return peers, nodes[0].table.get_nodes()
+
+        self.assertEqual(([], []), self.run_async(run()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import os
+import pickle
+import tempfile
+import unittest
+
+import helpers
+from modules.bitfield import Bitfield
+from modules.files import Files, MmapFiles
+
+BLOCK = 2**14
+
+
+class FilesTest(unittest.TestCase):
+    storage = Files
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = helpers.make_data(3 * BLOCK + 100)
+        self.info = helpers.make_multi_info('test', self.data, BLOCK,
+                                            [100, 0, 2 * BLOCK, BLOCK])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_all(self, files):
+        for index in range(files.piece_num):
+            files.write_piece(index, self.data[index * BLOCK:
+                                               (index + 1) * BLOCK])
+
+    def test_files_are_preallocated(self):
+        files = self.storage(self.info, self.tmp.name)
+        files.close_files()
+        self.assertEqual([100, 0, 2 * BLOCK, BLOCK],
+                         [os.path.getsize('{}/{}'.format(self.tmp.name, i))
+                          for i in range(4)])
+
+    def test_write_across_files(self):
+        files = self.storage(self.info, self.tmp.name)
+        self.write_all(files)
+        self.assertEqual(self.data[BLOCK - 10:BLOCK + 20],
+                         bytes(files.read_block(0, BLOCK - 10, 10)) +
+                         bytes(files.read_block(1, 0, 20)))
+        self.assertEqual(self.data[90:110], files.read_block(0, 90, 20))
+        files.close_files()
+        data = b''
+        for i in range(4):
+            with open('{}/{}'.format(self.tmp.name, i), 'rb') as f:
+                data += f.read()
+        self.assertEqual(self.data, data)
+
+    def test_reopen_keeps_data(self):
+        files = self.storage(self.info, self.tmp.name)
+        self.write_all(files)
+        files.save_resume()
+        files.close_files()
+        files = self.storage(self.info, self.tmp.name)
+        self.assertTrue(files.have.all())
+        self.assertEqual(self.data[:BLOCK], files.read_block(0, 0, BLOCK))
+        files.close_files()
+
+    def test_sync_is_batched(self):
+        files = self.storage(self.info, self.tmp.name)
+        files.write_piece(0, self.data[:BLOCK])
+        self.assertEqual(BLOCK, files.unsynced_bytes)
+        self.assertEqual(2, len(files.unsynced))
+        files.sync()
+        self.assertEqual(0, files.unsynced_bytes)
+        self.assertFalse(files.unsynced)
+        files.close_files()
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = helpers.make_data(4 * BLOCK)
+        self.info = helpers.make_multi_info('test', self.data, 2 * BLOCK,
+                                            [3 * BLOCK, BLOCK])
+        self.files = Files(self.info, self.tmp.name)
+
+    def tearDown(self):
+        self.files.close_files()
+        self.tmp.cleanup()
+
+    def reopen(self, info=None, info_hash=None):
+        self.files.close_files()
+        self.files = Files(info or self.info, self.tmp.name,
+                           info_hash=info_hash)
+
+    def test_partial_blocks(self):
+        self.files.save_resume([(1, self.data[2 * BLOCK:] + b'\x00' * 4,
+                                 Bitfield(2, b'\x80'))])
+        self.reopen()
+        self.assertEqual([1], list(self.files.partial))
+        self.assertEqual([0], list(self.files.partial[1]))
+        self.assertEqual(self.data[2 * BLOCK:3 * BLOCK],
+                         self.files.read_block(1, 0, BLOCK))
+        self.assertFalse(self.files.unverified)
+
+    def test_changed_file_is_unverified(self):
+        self.files.write_piece(0, self.data[:2 * BLOCK])
+        self.files.write_piece(1, self.data[2 * BLOCK:])
+        self.files.save_resume()
+        with open(self.tmp.name + '/1', 'r+b') as f:
+            f.write(b'\x00')
+        self.reopen()
+        self.assertIn(0, self.files.have)
+        self.assertNotIn(1, self.files.have)
+        self.assertEqual({1}, self.files.unverified)
+        self.assertFalse(self.files.check_piece(1))
+        self.assertFalse(self.files.unverified)
+
+    def test_unverified_piece_is_checked(self):
+        self.files.write_piece(1, self.data[2 * BLOCK:])
+        self.files.save_resume()
+        os.utime(self.tmp.name + '/1', ns=(0, 0))
+        self.reopen()
+        self.assertEqual({1}, self.files.unverified)
+        self.files.save_resume()
+        self.reopen()
+        self.assertEqual({1}, self.files.unverified)
+        self.assertTrue(self.files.check_piece(1))
+        self.assertIn(1, self.files.have)
+
+    def test_piece_counted_once(self):
+        self.files.write_piece(1, self.data[2 * BLOCK:])
+        self.files.save_resume()
+        os.utime(self.tmp.name + '/1', ns=(0, 0))
+        self.reopen()
+        self.assertTrue(self.files.check_piece(1))
+        self.assertFalse(self.files.write_piece(1, self.data[2 * BLOCK:]))
+        self.assertTrue(self.files.write_piece(0, self.data[:2 * BLOCK]))
+        self.assertFalse(self.files.check_piece(0))
+
+    def test_other_torrent(self):
+        self.files.write_piece(0, self.data[:2 * BLOCK])
+        self.files.save_resume()
+        info = dict(self.info)
+        info[b'name'] = b'other'
+        self.reopen(info)
+        self.assertNotIn(0, self.files.have)
+
+    def test_given_info_hash(self):
+        self.reopen(info_hash=b'\x02' * 20)
+        self.files.write_piece(0, self.data[:2 * BLOCK])
+        self.files.save_resume()
+        self.reopen(info_hash=b'\x02' * 20)
+        self.assertIn(0, self.files.have)
+        self.reopen()
+        self.assertNotIn(0, self.files.have)
+
+    def test_legacy_bitfield_is_unverified(self):
+        with open(self.tmp.name + '/bitfield.pickle', 'wb') as f:
+            pickle.dump('11', f)
+        self.reopen()
+        self.assertEqual({0, 1}, self.files.unverified)
+        self.assertFalse(self.files.have)
+
+
+class MmapFilesTest(FilesTest):
+    storage = MmapFiles
+
+    def test_read_is_zero_copy(self):
+        files = self.storage(self.info, self.tmp.name)
+        self.write_all(files)
+        block = files.read_block(1, 0, 100)
+        self.assertIsInstance(block, memoryview)
+        self.assertEqual(self.data[BLOCK:BLOCK + 100], block)
+        block.release()
+        files.close_files()
+
+
+if __name__ == '__main__':
+    unittest.main()
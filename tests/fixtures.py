@@ -0,0 +1,33 @@
+import os
+import random
+from hashlib import sha1
+
+from modules import bencode
+
+
+def make_data(length, seed=0):
+    return random.Random(seed).randbytes(length)
+
+
+def make_info(name, data, piece_length):
+    pieces = b''.join(sha1(data[i:i + piece_length]).digest()
+                      for i in range(0, len(data), piece_length))
+    return {b'name': name.encode(), b'length': len(data),
+            b'piece length': piece_length, b'pieces': pieces}
+
+
+def make_multi_info(name, data, piece_length, file_lengths):
+    info = make_info(name, data, piece_length)
+    del info[b'length']
+    info[b'files'] = [{b'length': length, b'path': [b'%d' % i]}
+                      for i, length in enumerate(file_lengths)]
+    return info
+
+
+def write_torrent(torrent_dir, name, info,
+                  announce='http://127.0.0.1:1/announce'):
+    os.makedirs(torrent_dir, exist_ok=True)
+    with open('{}/{}.torrent'.format(torrent_dir, name), 'wb') as f:
+        f.write(bencode.encode({b'announce': announce.encode(),
+                                b'info': info}))
+    return name + '.torrent'
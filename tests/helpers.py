@@ -0,0 +1,170 @@
+import os
+import socket
+import struct
+import sys
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import BaseRequestHandler, UDPServer
+from threading import Thread
+from types import SimpleNamespace
+from urllib import parse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from modules import bencode
+from modules.files import Files
+from modules.meter import TrafficMeter
+from modules.picker import PiecePicker
+from modules.ratelimit import TokenBucket
+from modules.pwp import messages
+from fixtures import make_data, make_info, make_multi_info, write_torrent
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class MockTracker:
+    def __init__(self):
+        tracker = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = parse.urlparse(self.path)
+                params = parse.parse_qs(url.query, encoding='latin-1')
+                if url.path == '/scrape':
+                    response = tracker.scrape(
+                        [info_hash.encode('latin-1')
+                         for info_hash in params['info_hash']])
+                else:
+                    response = tracker.announce(
+                        params['info_hash'][0].encode('latin-1'),
+                        self.client_address[0], int(params['port'][0]))
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        self.swarms = {}
+        self.scrapes = []
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/announce'.format(
+            self.server.server_port)
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def announce(self, info_hash, ip, port):
+        swarm = self.swarms.setdefault(info_hash, set())
+        swarm.add((ip, port))
+        peers = b''.join(socket.inet_aton(peer_ip) +
+                         peer_port.to_bytes(2, byteorder='big')
+                         for peer_ip, peer_port in swarm
+                         if (peer_ip, peer_port) != (ip, port))
+        return bencode.encode({b'interval': 1800, b'peers': peers})
+
+    def scrape(self, info_hashes):
+        self.scrapes.append(info_hashes)
+        return bencode.encode({b'files': {
+            info_hash: {b'complete': len(self.swarms.get(info_hash, ())),
+                        b'downloaded': 0, b'incomplete': 0}
+            for info_hash in info_hashes}})
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MockUDPTracker:
+    def __init__(self):
+        tracker = self
+
+        class Handler(BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                response = tracker.handle(data, self.client_address)
+                if response is not None:
+                    sock.sendto(response, self.client_address)
+
+        self.swarms = {}
+        self.connection_id = 0x1234
+        self.connects = 0
+        self.drop = 0
+        self.requests = []
+        self.server = UDPServer(('127.0.0.1', 0), Handler)
+        self.url = 'udp://127.0.0.1:{}/announce'.format(
+            self.server.server_address[1])
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle(self, data, address):
+        if self.drop:
+            self.drop -= 1
+            return None
+        connection_id, action, transaction_id = struct.unpack('>QII',
+                                                              data[:16])
+        self.requests.append(action)
+        if action == 0:
+            self.connects += 1
+            return struct.pack('>IIQ', 0, transaction_id, self.connection_id)
+        if connection_id != self.connection_id:
+            return struct.pack('>II', 3, transaction_id) + b'bad connection'
+        if action == 1:
+            info_hash = data[16:36]
+            port = struct.unpack('>H', data[96:98])[0]
+            swarm = self.swarms.setdefault(info_hash, set())
+            swarm.add((address[0], port))
+            peers = b''.join(socket.inet_aton(peer_ip) +
+                             peer_port.to_bytes(2, byteorder='big')
+                             for peer_ip, peer_port in swarm
+                             if (peer_ip, peer_port) != (address[0], port))
+            return struct.pack('>IIIII', 1, transaction_id, 1800, 0,
+                               len(swarm)) + peers
+        if action == 2:
+            stats = b''.join(
+                struct.pack('>III', len(self.swarms.get(data[i:i + 20], ())),
+                            0, 0)
+                for i in range(16, len(data), 20))
+            return struct.pack('>II', 2, transaction_id) + stats
+        return None
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_torrent_stub(info, root_dir):
+    files = Files(info, root_dir)
+    peers = []
+    return SimpleNamespace(id='-VT1001-000000000000',
+                           info_hash=b'\x01' * 20, files=files,
+                           picker=PiecePicker(files), active=True,
+                           uploaded=0, port=6881, peers=peers,
+                           add_peers=peers.extend,
+                           get_peer_addresses=set,
+                           upload_bucket=TokenBucket(),
+                           download_bucket=TokenBucket(),
+                           meter=TrafficMeter())
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+    def pop_messages(self):
+        result = messages.get_messages(self.data)
+        self.data = b''
+        return result
@@ -5,6 +5,7 @@ import os
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                              os.path.pardir))
+from modules.bitfield import Bitfield
 from modules.pwp import messages
 
 class MessageBuildingTest(unittest.TestCase):
@@ -26,6 +27,15 @@ class MessageBuildingTest(unittest.TestCase):
         result = messages.build_handshake(info_hash, peer_id)
         self.assertEqual(expected, result)
 
+    def test_extension_bit(self):
+        handshake = messages.build_handshake(
+            b'\x01' * 20, b'\x02' * 20,
+            messages.get_extension_reserved_bytes())
+        self.assertEqual(b'\x00\x00\x00\x00\x00\x10\x00\x00',
+                         handshake[20:28])
+        self.assertTrue(messages.supports_extensions(handshake[20:28]))
+        self.assertFalse(messages.supports_extensions(b'\x00' * 8))
+
     def test_choke(self):
         self.assertEqual(b'\x00\x00\x00\x01\x00', messages.build_choke())
 
@@ -82,8 +92,8 @@ class MessageParsingTest(unittest.TestCase):
         peer_id = self.get_bytes_sequence(20)
         reserved = self.get_bytes_sequence(8)
         bytes_ = (b'\x13BitTorrent protocol' + reserved + info_hash + peer_id)
-        expected = {'type': 'handshake', 'info_hash': info_hash,
-                     'peer_id': peer_id}
+        expected = {'type': 'handshake', 'reserved': reserved,
+                    'info_hash': info_hash, 'peer_id': peer_id}
         return expected, bytes_
 
     def test_chocke(self):
@@ -112,11 +122,16 @@ class MessageParsingTest(unittest.TestCase):
     def get_bitfield_test(self):
         bitfield = self.get_bytes_sequence(10)
         bytes_ = messages.build_bitfield(bitfield)
-        pieces_indices = [i for i in range(2, 10*8 + 1, 2)]
-        expected = {'type': 'bitfield',
-                    'pieces_indices': pieces_indices}
+        expected = {'type': 'bitfield', 'bitfield': bitfield}
         return expected, bytes_
 
+    def test_bitfield_leading_zeros(self):
+        bytes_ = messages.build_bitfield(b'\x00\x01')
+        self.base_test([{'type': 'bitfield', 'bitfield': b'\x00\x01'}],
+                       bytes_)
+        bitfield = messages.get_messages(bytes_)[0]['bitfield']
+        self.assertEqual([15], list(Bitfield(16, bitfield)))
+
     def test_request(self):
         index = 4
         begin = 4
@@ -144,17 +159,113 @@ class MessageParsingTest(unittest.TestCase):
                      'begin': begin, 'length': length}]
         self.base_test(expected, bytes_)
 
+    def test_reject(self):
+        index = 4
+        begin = 4
+        length = 4096
+        bytes_ = messages.build_reject(index, begin, length)
+        expected = [{'type': 'reject', 'index': index,
+                     'begin': begin, 'length': length}]
+        self.base_test(expected, bytes_)
+
     def test_port(self):
         port = 56622
         bytes_ = messages.build_port(port)
         expected = [{'type': 'port', 'port': port}]
         self.base_test(expected, bytes_)
 
+    def test_extended(self):
+        bytes_ = messages.build_extended(3, {b'a': 1})
+        expected = [{'type': 'extended', 'extended_id': 3,
+                     'data': b'd1:ai1ee'}]
+        self.base_test(expected, bytes_)
+
+    def test_pex(self):
+        message = messages.get_messages(messages.build_pex(
+            7, [('10.0.0.1', 6881)], [('10.0.0.2', 1)]))[0]
+        self.assertEqual(7, message['extended_id'])
+        self.assertEqual(b'd5:added6:\n\x00\x00\x01\x1a\xe1'
+                         b'7:added.f1:\x00'
+                         b'7:dropped6:\n\x00\x00\x02\x00\x01e',
+                         message['data'])
+        self.assertEqual([('10.0.0.1', 6881), ('10.0.0.2', 1)],
+                         messages.decode_peers(b'\n\x00\x00\x01\x1a\xe1'
+                                               b'\n\x00\x00\x02\x00\x01'
+                                               b'\x00'))
+
     def test_sequence(self):
         h_expected, h_bytes = self.get_handshake_test()
         b_expected, b_bytes = self.get_bitfield_test()
         self.base_test([h_expected, b_expected], h_bytes + b_bytes)
 
 
+class FramerTest(unittest.TestCase):
+    def get_handshake(self):
+        return messages.build_handshake(b'\x01' * 20, b'\x02' * 20)
+
+    def test_handshake_first(self):
+        framer = messages.Framer()
+        framer.feed(self.get_handshake() + messages.build_unchoke())
+        self.assertListEqual(['handshake', 'unchoke'],
+                             [m['type'] for m in framer])
+
+    def test_invalid_handshake(self):
+        framer = messages.Framer()
+        framer.feed(b'\x00' * messages.get_handshake_length())
+        with self.assertRaises(ValueError):
+            list(framer)
+
+    def test_bare_payload_message_skipped(self):
+        framer = messages.Framer(handshake=False)
+        framer.feed(messages.build_message(1, messages.EXTENDED_ID) +
+                    messages.build_message(1, messages.HAVE_ID) +
+                    messages.build_choke())
+        self.assertListEqual([{'type': 'choke'}], list(framer))
+
+    def test_partial_frames(self):
+        block = b'\xaa' * 2**14
+        bytes_ = (messages.build_piece(3, 0, block) +
+                  messages.build_have(7))
+        framer = messages.Framer(handshake=False)
+        result = []
+        for i in range(0, len(bytes_), 1000):
+            framer.feed(bytes_[i:i + 1000])
+            result.extend(framer)
+        self.assertListEqual([{'type': 'piece', 'index': 3, 'begin': 0,
+                               'block': block},
+                              {'type': 'have', 'piece_index': 7}], result)
+        self.assertEqual(b'', framer.get_not_used_data())
+
+    def test_piece_block_is_view(self):
+        framer = messages.Framer(handshake=False)
+        framer.feed(messages.build_piece(0, 0, b'\xaa' * 16))
+        message = next(framer)
+        self.assertIsInstance(message['block'], memoryview)
+        framer.feed(messages.build_have(1))
+        self.assertEqual(b'\xaa' * 16, message['block'])
+
+    def test_unknown_message_skipped(self):
+        framer = messages.Framer(handshake=False)
+        framer.feed(messages.build_message(2, 99, b'\x00') +
+                    messages.build_choke())
+        self.assertListEqual([{'type': 'choke'}], list(framer))
+
+    def test_overhead(self):
+        framer = messages.Framer()
+        framer.feed(self.get_handshake() +
+                    messages.build_piece(0, 0, b'\xaa' * 100) +
+                    messages.build_message(2, 99, b'\x00') +
+                    messages.build_have(1))
+        list(framer)
+        self.assertEqual(messages.get_handshake_length() + 13 + 6 + 9,
+                         framer.overhead)
+
+    def test_too_long_message(self):
+        framer = messages.Framer(handshake=False)
+        framer.feed(messages.int_to_bytes(2**30, messages.LEN_LEN))
+        with self.assertRaises(ValueError):
+            list(framer)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from modules.meter import RATE_PERIOD, RATE_TICK, RateMeter, TrafficMeter
+
+
+class RateMeterTest(unittest.TestCase):
+    def setUp(self):
+        self.meter = RateMeter()
+        self.start = self.meter.tick
+
+    def get_rate(self, at):
+        average, weight, ticks = self.meter.get_average(self.start + at)
+        return average / weight if weight else 0
+
+    def test_empty(self):
+        self.assertEqual(0, self.meter.get_rate())
+        self.assertEqual(0, self.get_rate(10))
+
+    def test_first_tick(self):
+        self.meter.add(1000)
+        self.assertEqual(0, self.get_rate(RATE_TICK / 2))
+        self.assertAlmostEqual(1000 / RATE_TICK, self.get_rate(RATE_TICK))
+
+    def age(self, seconds):
+        self.meter.tick -= seconds
+        self.meter.added -= seconds
+
+    def test_steady_rate(self):
+        for i in range(10 * RATE_PERIOD):
+            self.meter.add(500)
+            self.age(RATE_TICK)
+        self.meter.add(0)
+        self.assertAlmostEqual(500 / RATE_TICK, self.meter.get_rate())
+
+    def test_rate_change(self):
+        for rate in (1000, 0, 3000):
+            for i in range(10 * RATE_PERIOD):
+                self.meter.add(rate * RATE_TICK)
+                self.age(RATE_TICK)
+            self.assertAlmostEqual(rate, self.meter.get_rate(), delta=1)
+
+    def test_gap_spread_over_ticks(self):
+        self.meter.add(2000)
+        self.meter.added = self.start + 2.5 * RATE_TICK
+        self.meter.pending = 3000
+        self.assertAlmostEqual(1000 / RATE_TICK,
+                               self.get_rate(3 * RATE_TICK))
+
+    def test_decays_when_idle(self):
+        self.meter.add(1000)
+        rates = [self.get_rate(RATE_TICK * n) for n in (1, 5, 20, 100)]
+        self.assertEqual(sorted(rates, reverse=True), rates)
+        self.assertLess(rates[-1], 1)
+
+    def test_read_does_not_change_meter(self):
+        self.meter.add(1000)
+        self.get_rate(10)
+        self.assertEqual(1000, self.meter.pending)
+        self.assertEqual(0, self.meter.weight)
+
+    def test_hierarchy(self):
+        client = TrafficMeter()
+        torrents = [TrafficMeter(client), TrafficMeter(client)]
+        torrents[0].download.add(100)
+        torrents[1].download.add(50)
+        TrafficMeter(torrents[1]).upload.add(10)
+        self.assertEqual(150, client.download.total)
+        self.assertEqual(10, client.upload.total)
+        self.assertEqual(10, torrents[1].upload.total)
+        self.assertEqual(0, client.overhead.total)
+
+
+if __name__ == '__main__':
+    unittest.main()
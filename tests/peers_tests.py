@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import sys
+import time
+import unittest
+from types import SimpleNamespace
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from modules.peers import (BAN_HASHFAILS, MAX_CONNECTING, MAX_FAILURES,
+                           RECONNECT_DELAY, PeerLimit, PeerManager)
+
+
+class FakeConn:
+    def __init__(self, address, peer_id=None):
+        self.address = address
+        self.peer_id = peer_id
+        self.broken = False
+        self.task = None
+        self.downloaded = 0
+        self.uploaded = 0
+        self.connected = time.time()
+        self.hashfails = 0
+
+    def add_hashfail(self):
+        self.hashfails += 1
+
+
+class FakeManager(PeerManager):
+    def open_connection(self, address):
+        self.add_connection(address, FakeConn(address))
+
+
+class PeerManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.torrent = SimpleNamespace(connections={})
+        self.limit = PeerLimit(100)
+        self.manager = FakeManager(self.torrent, 20, self.limit)
+
+    def add_peers(self, count, first_port=6881):
+        for port in range(first_port, first_port + count):
+            self.manager.add('10.0.0.1', port)
+
+    def finish(self, address, peer_id=None, downloaded=0):
+        conn = self.torrent.connections[address]
+        conn.peer_id = peer_id
+        conn.downloaded = downloaded
+        conn.connected -= 1
+        conn.broken = True
+
+    def test_connect_concurrency(self):
+        self.add_peers(30)
+        self.manager.update()
+        self.assertEqual(MAX_CONNECTING, len(self.torrent.connections))
+        self.manager.update()
+        self.assertEqual(MAX_CONNECTING, len(self.torrent.connections))
+        for conn in self.torrent.connections.values():
+            conn.peer_id = b'peer' + bytes([conn.address[1] % 256])
+        self.manager.update()
+        self.assertEqual(2 * MAX_CONNECTING, len(self.torrent.connections))
+
+    def test_max_peers(self):
+        self.add_peers(30)
+        for i in range(5):
+            for conn in self.torrent.connections.values():
+                conn.peer_id = b'peer' + bytes([conn.address[1] % 256])
+            self.manager.update()
+        self.assertEqual(20, len(self.torrent.connections))
+        self.assertEqual(20, self.limit.connected)
+        self.assertFalse(self.manager.can_accept('10.0.0.2'))
+
+    def test_global_limit(self):
+        other = FakeManager(SimpleNamespace(connections={}), 20, self.limit)
+        self.limit.max_peers = 7
+        self.add_peers(6)
+        other.add('10.0.0.2', 6881)
+        other.add('10.0.0.2', 6882)
+        self.manager.update()
+        other.update()
+        self.assertEqual(6, len(self.torrent.connections))
+        self.assertEqual(1, len(other.torrent.connections))
+        self.assertFalse(other.can_accept('10.0.0.3'))
+
+    def test_same_ip_different_ports(self):
+        self.add_peers(2)
+        self.manager.update()
+        self.assertEqual({('10.0.0.1', 6881), ('10.0.0.1', 6882)},
+                         set(self.torrent.connections))
+
+    def test_cleanup_and_backoff(self):
+        address = ('10.0.0.1', 6881)
+        self.add_peers(1)
+        self.manager.update()
+        self.finish(address)
+        self.manager.update()
+        self.assertNotIn(address, self.torrent.connections)
+        self.assertEqual(0, self.limit.connected)
+        peer = self.manager.peers[address]
+        self.assertEqual(1, peer['failures'])
+        first_retry = peer['retry'] - time.time()
+        self.assertAlmostEqual(RECONNECT_DELAY, first_retry, delta=1)
+        peer['retry'] = 0
+        self.manager.update()
+        self.finish(address)
+        self.manager.cleanup()
+        self.assertAlmostEqual(2 * RECONNECT_DELAY,
+                               peer['retry'] - time.time(), delta=1)
+
+    def test_unreachable_forgotten(self):
+        address = ('10.0.0.1', 6881)
+        self.add_peers(1)
+        for i in range(MAX_FAILURES + 1):
+            self.manager.peers[address]['retry'] = 0
+            self.manager.update()
+            self.finish(address)
+            self.manager.cleanup()
+        self.assertNotIn(address, self.manager.peers)
+
+    def test_running_task_keeps_slot(self):
+        async def run():
+            self.add_peers(1)
+            self.manager.update()
+            conn = self.torrent.connections[('10.0.0.1', 6881)]
+            conn.task = asyncio.get_running_loop().create_task(
+                asyncio.sleep(10))
+            conn.broken = True
+            self.manager.cleanup()
+            self.assertIn(conn, self.torrent.connections.values())
+            await self.manager.close()
+            self.assertEqual({}, self.torrent.connections)
+            self.assertEqual(0, self.limit.connected)
+
+        asyncio.run(run())
+
+    def test_fastest_peers_dialed_first(self):
+        self.add_peers(MAX_CONNECTING + 2)
+        self.manager.update()
+        for port, downloaded in ((6881, 10), (6882, 1000)):
+            self.finish(('10.0.0.1', port), b'peer%d' % port, downloaded)
+        for conn in list(self.torrent.connections.values()):
+            conn.broken = True
+        self.manager.cleanup()
+        for peer in self.manager.peers.values():
+            peer['retry'] = 0
+        self.manager.connect()
+        dialed = list(self.torrent.connections)
+        self.assertEqual([('10.0.0.1', 6882), ('10.0.0.1', 6881)],
+                         dialed[:2])
+
+    def test_duplicate_peer_id_dropped(self):
+        self.add_peers(2)
+        self.manager.update()
+        first, second = self.torrent.connections.values()
+        first.peer_id = second.peer_id = b'peer'
+        self.manager.drop_duplicates()
+        self.assertFalse(first.broken)
+        self.assertTrue(second.broken)
+
+    def test_ban(self):
+        self.add_peers(2)
+        self.manager.update()
+        conns = list(self.torrent.connections.values())
+        for i in range(BAN_HASHFAILS - 1):
+            self.manager.add_hashfail(conns[0])
+        self.assertFalse(conns[1].broken)
+        self.manager.add_hashfail(conns[0])
+        self.assertTrue(all(conn.broken for conn in conns))
+        self.assertFalse(self.manager.can_accept('10.0.0.1'))
+        self.assertTrue(self.manager.can_accept('10.0.0.2'))
+        for peer in self.manager.peers.values():
+            peer['retry'] = 0
+        self.manager.cleanup()
+        self.manager.connect()
+        self.assertEqual({}, self.torrent.connections)
+        self.manager.banned['10.0.0.1'] = time.time()
+        self.assertTrue(self.manager.can_accept('10.0.0.1'))
+
+    def test_shared_piece_not_counted(self):
+        self.add_peers(2)
+        self.manager.update()
+        conns = list(self.torrent.connections.values())
+        for i in range(2 * BAN_HASHFAILS):
+            for conn in conns:
+                self.manager.add_hashfail(conn, len(conns))
+        self.assertFalse(any(conn.broken or conn.hashfails
+                             for conn in conns))
+        self.assertTrue(self.manager.can_accept('10.0.0.1'))
+        self.assertEqual(2 * BAN_HASHFAILS, self.manager.penalties['10.0.0.1'])
+
+    def test_hashfails_lower_score(self):
+        peer = {'address': ('10.0.0.1', 6881), 'transferred': 1000,
+                'time': 10}
+        self.assertEqual(100, self.manager.get_score(peer))
+        self.manager.penalties['10.0.0.1'] = 1
+        self.assertEqual(50, self.manager.get_score(peer))
+
+
+if __name__ == '__main__':
+    unittest.main()
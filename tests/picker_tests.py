@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import tempfile
+import unittest
+
+import helpers
+from modules.bitfield import Bitfield
+from modules.picker import PiecePicker
+
+BLOCK = 2**14
+
+
+def has(indices, length=7):
+    pieces = Bitfield(length)
+    pieces.update(indices)
+    return pieces
+
+
+class PiecePickerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        info = helpers.make_info('test', helpers.make_data(6 * BLOCK + 100),
+                                 BLOCK)
+        self.torrent = helpers.make_torrent_stub(info, self.tmp.name)
+        self.picker = PiecePicker(self.torrent.files)
+        for index in range(7):
+            self.picker.set_wanted(index, True)
+
+    def tearDown(self):
+        self.torrent.files.close_files()
+        self.tmp.cleanup()
+
+    def start(self, index):
+        self.picker.start_piece(index)
+
+    def test_rarest_first(self):
+        self.picker.add_peer_pieces([0, 1, 2, 3])
+        self.picker.add_peer_pieces([0, 1, 2])
+        self.picker.add_peer_pieces([0, 1])
+        self.assertEqual(3, self.picker.pick(has([0, 1, 2, 3])))
+        self.start(3)
+        self.assertEqual(2, self.picker.pick(has([0, 1, 2, 3])))
+        self.start(2)
+        self.assertIn(self.picker.pick(has([0, 1, 2, 3])), (0, 1))
+
+    def test_only_peer_pieces(self):
+        self.picker.add_peer_pieces([4])
+        self.picker.add_peer_pieces([0, 1, 2, 3, 4])
+        self.assertIn(self.picker.pick(has([0, 1])), (0, 1))
+
+    def test_nothing_to_pick(self):
+        self.picker.add_peer_pieces([0])
+        self.assertEqual(0, self.picker.pick(has([0])))
+        self.start(0)
+        self.assertIsNone(self.picker.pick(has([0])))
+        self.assertIsNone(self.picker.pick(has([5])))
+
+    def test_only_wanted_pieces(self):
+        self.picker.add_peer_pieces(range(7))
+        for index in range(6):
+            self.picker.set_wanted(index, False)
+        self.assertEqual(6, self.picker.pick(has(range(7))))
+        self.assertIsNone(self.picker.pick(has(range(6))))
+        self.start(6)
+        self.assertFalse(self.picker.wanted)
+        self.assertIsNone(self.picker.pick(has(range(7))))
+
+    def test_have_updates_availability(self):
+        self.picker.add_peer_pieces([0, 1])
+        self.picker.add_peer_pieces([1])
+        self.picker.add_peer_pieces([0])
+        self.picker.add_peer_pieces([0])
+        self.assertEqual(1, self.picker.pick(has([0, 1])))
+
+    def test_remove_peer(self):
+        self.picker.add_peer_pieces([0, 1])
+        self.picker.add_peer_pieces([0])
+        self.picker.remove_peer_pieces([0, 1])
+        self.assertEqual([1, 0, 0, 0, 0, 0, 0], self.picker.availability)
+        self.assertEqual(0, self.picker.pick(has([0, 1])))
+
+    def test_not_wanted(self):
+        self.picker.add_peer_pieces([0, 1])
+        self.picker.set_wanted(0, False)
+        self.picker.complete(1)
+        self.assertIsNone(self.picker.pick(has([0, 1])))
+
+    def test_random_tie_breaking(self):
+        self.picker.add_peer_pieces(range(7))
+        picked = {self.picker.pick(has(range(7))) for i in range(100)}
+        self.assertGreater(len(picked), 1)
+
+    def test_partial_first(self):
+        self.picker.add_peer_pieces([0, 1])
+        self.picker.add_peer_pieces([0])
+        self.picker.add_peer_pieces([0])
+        self.start(0)
+        self.assertListEqual([(0, 0, BLOCK)],
+                             self.picker.pick_blocks('peer', has([0, 1]), 1))
+
+    def test_blocks_of_last_piece(self):
+        self.picker.add_peer_pieces([6])
+        self.assertListEqual([(6, 0, 100)],
+                             self.picker.pick_blocks('peer', has([6]), 2))
+
+    def test_release_and_complete(self):
+        self.picker.endgame = False
+        self.picker.add_peer_pieces([6])
+        self.picker.pick_blocks('peer', has([6]), 1)
+        self.picker.release_blocks('other', [(6, 0)])
+        self.assertEqual([], self.picker.pick_blocks('other', has([6]), 1))
+        self.picker.release_blocks('peer', [(6, 0)])
+        self.assertEqual([(6, 0, 100)],
+                         self.picker.pick_blocks('other', has([6]), 1))
+        self.assertIsNone(self.picker.add_block('other', 6, 0,
+                                                b'\x00' * 99))
+        self.assertEqual({'other'},
+                         self.picker.add_block('other', 6, 0, b'\x00' * 100))
+        self.assertIsNone(self.picker.add_block('peer', 6, 0,
+                                                b'\x00' * 100))
+        self.assertEqual([(6, b'\x00' * 100, {'other'})],
+                         self.picker.pop_completed())
+        self.assertNotIn(6, self.picker.downloading)
+
+    def test_resume_piece(self):
+        self.picker.add_peer_pieces([0])
+        self.picker.resume_piece(0, b'\x01' * BLOCK, [0])
+        self.assertEqual([(0, b'\x01' * BLOCK, set())],
+                         self.picker.pop_completed())
+        self.picker.resume_piece(1, b'\x00' * BLOCK, [])
+        self.assertListEqual([(1, 0, BLOCK)],
+                             self.picker.pick_blocks('peer', has([1]), 2))
+
+
+class EndgameTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        info = helpers.make_info('test', helpers.make_data(4 * BLOCK),
+                                 2 * BLOCK)
+        self.torrent = helpers.make_torrent_stub(info, self.tmp.name)
+        self.picker = PiecePicker(self.torrent.files)
+        for index in range(2):
+            self.picker.set_wanted(index, True)
+        self.picker.add_peer_pieces([0, 1])
+        self.picker.add_peer_pieces([0, 1])
+
+    def tearDown(self):
+        self.torrent.files.close_files()
+        self.tmp.cleanup()
+
+    def test_no_duplicates_before_endgame(self):
+        self.picker.pick_blocks('slow', has([0, 1], 2), 3)
+        self.assertFalse(self.picker.in_endgame())
+        blocks = self.picker.pick_blocks('fast', has([0, 1], 2), 1)
+        self.assertEqual({'fast'}, self.picker.add_block('fast',
+                                                         *blocks[0][:2],
+                                                         b'\x00' * BLOCK))
+
+    def test_duplicates_in_endgame(self):
+        self.picker.pick_blocks('slow', has([0, 1], 2), 4)
+        self.assertTrue(self.picker.in_endgame())
+        blocks = self.picker.pick_blocks('fast', has([0], 2), 4)
+        self.assertListEqual([(0, 0, BLOCK), (0, BLOCK, BLOCK)], blocks)
+        self.assertEqual({'slow', 'fast'},
+                         self.picker.add_block('fast', 0, 0,
+                                               b'\x00' * BLOCK))
+        self.picker.release_blocks('slow', [(0, BLOCK)])
+        self.assertEqual({'fast'},
+                         self.picker.add_block('fast', 0, BLOCK,
+                                               b'\x00' * BLOCK))
+
+    def test_endgame_disabled(self):
+        self.picker.endgame = False
+        self.picker.pick_blocks('slow', has([0, 1], 2), 4)
+        self.assertListEqual([], self.picker.pick_blocks('fast',
+                                                         has([0], 2), 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
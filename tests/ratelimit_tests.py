@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.path.pardir))
+from modules.ratelimit import BURST_TIME, TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_unlimited(self):
+        bucket = TokenBucket(parent=TokenBucket())
+        self.assertEqual(0, bucket.consume(10**9))
+
+    def test_burst_then_debt(self):
+        bucket = TokenBucket(1000)
+        self.assertEqual(0, bucket.consume(1000 * BURST_TIME))
+        self.assertAlmostEqual(0.5, bucket.consume(500), places=2)
+        self.assertAlmostEqual(1.5, bucket.consume(1000), places=2)
+
+    def test_refill(self):
+        bucket = TokenBucket(1000)
+        bucket.consume(1500)
+        bucket.updated -= 1
+        self.assertAlmostEqual(0.5, bucket.consume(1000), places=2)
+        bucket.updated -= 100
+        bucket.refill(bucket.updated + 100)
+        self.assertEqual(1000 * BURST_TIME, bucket.tokens)
+
+    def test_hierarchy(self):
+        total = TokenBucket(1000)
+        torrent = TokenBucket(parent=total)
+        peers = [TokenBucket(parent=torrent), TokenBucket(2000, torrent)]
+        self.assertEqual(0, peers[0].consume(1000))
+        self.assertAlmostEqual(1, peers[1].consume(1000), places=2)
+        self.assertAlmostEqual(1000, peers[1].tokens, delta=5)
+        torrent.set_rate(100)
+        self.assertAlmostEqual(5, peers[0].consume(500), places=1)
+
+    def test_set_rate(self):
+        bucket = TokenBucket()
+        bucket.consume(10**6)
+        bucket.set_rate(1000)
+        self.assertAlmostEqual(0.1, bucket.consume(100), places=2)
+        bucket.set_rate(0)
+        self.assertEqual(0, bucket.consume(10**6))
+
+
+if __name__ == '__main__':
+    unittest.main()
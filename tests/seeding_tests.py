@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import tempfile
+import time
+import unittest
+
+import helpers
+from modules.client import Client
+
+PIECE_LENGTH = 2**15
+
+
+class SeedingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.tracker = helpers.MockTracker()
+        self.data = helpers.make_data(5 * PIECE_LENGTH + 1000)
+        info = helpers.make_info('shared', self.data, PIECE_LENGTH)
+        self.seeder = self.make_client('seeder', info)
+        self.leecher = self.make_client('leecher', info)
+
+    def tearDown(self):
+        self.seeder.exit()
+        self.leecher.exit()
+        self.tracker.close()
+        self.tmp.cleanup()
+
+    def make_client(self, name, info):
+        root = '{}/{}'.format(self.tmp.name, name)
+        helpers.write_torrent(root + '/torrents', 'shared', info,
+                              self.tracker.url)
+        return Client(root + '/torrents', root + '/downloads',
+                      helpers.get_free_port(), dht=False)
+
+    def wait_for(self, condition, timeout=30):
+        start = time.time()
+        while not condition():
+            if time.time() - start > timeout:
+                self.fail('Timed out.')
+            time.sleep(0.1)
+
+    def fill_seeder(self):
+        torrent = self.seeder.torrents[0]
+        for index in range(torrent.files.piece_num):
+            start = index * PIECE_LENGTH
+            torrent.files.write_piece(
+                index, self.data[start:start + PIECE_LENGTH])
+        torrent.downloaded = torrent.files.get_downloaded()
+
+    def test_transfer(self):
+        self.fill_seeder()
+        self.seeder.change_torrent_status(1)
+        self.wait_for(lambda: self.tracker.swarms)
+        self.leecher.change_torrent_status(1)
+        leecher_torrent = self.leecher.torrents[0]
+        self.wait_for(lambda: leecher_torrent.completed)
+        path = '{}/leecher/downloads/shared/shared'.format(self.tmp.name)
+        with open(path, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+        self.assertEqual(len(self.data), self.seeder.torrents[0].uploaded)
+        self.assertEqual(len(self.data), leecher_torrent.downloaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
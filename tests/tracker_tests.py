@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
+import asyncio
+import threading
+import time
 import unittest
 import sys
 import os
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                              os.path.pardir))
-from modules.tracker import Tracker
+import helpers
+from modules.tracker import (ANNOUNCE_RETRY_INTERVAL, NUMWANT, Announcer,
+                             Scraper, Tracker, TrackerError, TrackerTiers,
+                             UDPTracker, get_tracker)
+
+DEAD_URL = 'http://127.0.0.1:1/announce'
+PARAMS = {'info_hash': b'\x01' * 20, 'peer_id': '-VT1001-000000000000',
+          'port': 6881, 'uploaded': 0, 'downloaded': 0, 'left': 10}
 
 class TestTracker(unittest.TestCase):
     def setUp(self):
@@ -21,6 +31,350 @@ class TestTracker(unittest.TestCase):
         expected = [{'ip': '192.192.238.238', 'port': 40960}]
         self.assertListEqual(expected, self.tracker.get_peers(peers))
 
+    def test_query(self):
+        self.tracker.tracker_id = b'a b'
+        self.tracker.send_request = lambda query, deadline: query
+        self.tracker.handle_response = lambda response: response
+        self.assertEqual('?info_hash=%01%FF&port=1&trackerid=a%20b',
+                         self.tracker.announce({'info_hash': b'\x01\xff',
+                                                'port': 1}))
+        self.tracker.url = 'http://a/announce?passkey=1'
+        self.assertEqual('&port=1&trackerid=a%20b',
+                         self.tracker.announce({'port': 1}))
+
+    def test_failure_reason(self):
+        with self.assertRaises(TrackerError):
+            self.tracker.handle_response(b'd14:failure reason3:bade')
+
+    def test_malformed_response(self):
+        for response in (b'', b'le', b'i1e', b'x'):
+            with self.assertRaises(TrackerError):
+                self.tracker.handle_response(response)
+
+    def test_scrape_url(self):
+        self.assertEqual('http://a/x/scrape.php?k=1', Tracker(
+            'http://a/x/announce.php?k=1').get_scrape_url())
+        with self.assertRaises(TrackerError):
+            Tracker('http://a/x/a').get_scrape_url()
+
+    def test_get_tracker(self):
+        self.assertIs(Tracker, type(get_tracker('http://a/announce')))
+        self.assertIs(UDPTracker, type(get_tracker('udp://a:80/announce')))
+
+
+class TestUDPTracker(unittest.TestCase):
+    def setUp(self):
+        self.mock = helpers.MockUDPTracker()
+        UDPTracker.connection_ids.clear()
+        self.tracker = UDPTracker(self.mock.url, timeout=0.2, retries=3)
+
+    def tearDown(self):
+        self.mock.close()
+
+    def announce(self, info_hash=b'\x01' * 20, port=6881, tracker=None):
+        return (tracker or self.tracker).announce(
+            {'info_hash': info_hash, 'peer_id': '-VT1001-000000000000',
+             'port': port, 'uploaded': 0, 'downloaded': 0, 'left': 10,
+             'event': 'started'})
+
+    def test_announce(self):
+        self.assertListEqual([], self.announce(port=6881))
+        self.assertListEqual([{'ip': '127.0.0.1', 'port': 6881}],
+                             self.announce(port=6882))
+        self.assertEqual(1800, self.tracker.interval)
+        self.assertEqual(2, self.tracker.complete)
+
+    def test_connection_id_cached(self):
+        self.announce()
+        self.announce(tracker=UDPTracker(self.mock.url, timeout=0.2))
+        self.assertEqual(1, self.mock.connects)
+        self.assertListEqual([0, 1, 1], self.mock.requests)
+
+    def test_connection_id_expired(self):
+        self.announce()
+        address = self.tracker.address
+        connection_id, expires = UDPTracker.connection_ids[address]
+        UDPTracker.connection_ids[address] = (connection_id, 0)
+        self.announce()
+        self.assertEqual(2, self.mock.connects)
+
+    def test_retry(self):
+        self.mock.drop = 2
+        self.assertListEqual([], self.announce())
+        self.assertListEqual([0, 1], self.mock.requests)
+
+    def test_no_response(self):
+        self.mock.drop = 3
+        with self.assertRaises(TrackerError):
+            self.announce()
+
+    def test_deadline(self):
+        self.mock.drop = 10
+        start = time.monotonic()
+        with self.assertRaises(TrackerError):
+            self.tracker.announce(PARAMS, start + 0.3)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_error(self):
+        self.announce()
+        self.mock.connection_id = 0x5678
+        with self.assertRaises(TrackerError):
+            self.announce()
+        self.assertNotIn(self.tracker.address, UDPTracker.connection_ids)
+        self.announce()
+        self.assertEqual(2, self.mock.connects)
+
+    def test_scrape(self):
+        self.announce(b'\x01' * 20)
+        self.assertDictEqual(
+            {b'\x01' * 20: {'complete': 1, 'downloaded': 0,
+                            'incomplete': 0},
+             b'\x02' * 20: {'complete': 0, 'downloaded': 0,
+                            'incomplete': 0}},
+            self.tracker.scrape([b'\x01' * 20, b'\x02' * 20]))
+
+
+class TestTrackerTiers(unittest.TestCase):
+    def setUp(self):
+        self.mocks = [helpers.MockTracker(), helpers.MockTracker()]
+
+    def tearDown(self):
+        for mock in self.mocks:
+            mock.close()
+
+    def add_peer(self, mock, ip, port):
+        mock.swarms.setdefault(PARAMS['info_hash'], set()).add((ip, port))
+
+    def test_failover_and_promotion(self):
+        self.add_peer(self.mocks[0], '10.0.0.1', 1)
+        tiers = TrackerTiers([[DEAD_URL, self.mocks[0].url]])
+        peers = asyncio.run(tiers.announce(PARAMS))
+        self.assertListEqual([{'ip': '10.0.0.1', 'port': 1}], peers)
+        self.assertEqual(self.mocks[0].url, tiers.tiers[0][0].url)
+        self.assertEqual(1800, tiers.interval)
+
+    def test_merge_tiers(self):
+        self.add_peer(self.mocks[0], '10.0.0.1', 1)
+        self.add_peer(self.mocks[1], '10.0.0.1', 1)
+        self.add_peer(self.mocks[1], '10.0.0.2', 2)
+        tiers = TrackerTiers([[self.mocks[0].url], [self.mocks[1].url]])
+        peers = asyncio.run(tiers.announce(PARAMS))
+        self.assertCountEqual([{'ip': '10.0.0.1', 'port': 1},
+                               {'ip': '10.0.0.2', 'port': 2}], peers)
+
+    def test_slow_tier(self):
+        self.add_peer(self.mocks[0], '10.0.0.1', 1)
+        silent = 'udp://127.0.0.1:{}'.format(helpers.get_free_port())
+        tiers = TrackerTiers([[silent], [self.mocks[0].url]], timeout=0.3)
+        tiers.tiers[0][0].timeout = 1
+        tiers.tiers[0][0].retries = 1
+        peers = asyncio.run(tiers.announce(PARAMS))
+        self.assertListEqual([{'ip': '10.0.0.1', 'port': 1}], peers)
+
+    def test_busy_tier_not_restarted(self):
+        async def run():
+            first = await tiers.announce(PARAMS)
+            job = tiers.running[0]
+            second = await tiers.announce(PARAMS)
+            self.assertIs(job, tiers.running[0])
+            return first, second
+
+        def block(params, deadline):
+            calls.append(deadline)
+            release.wait(5)
+            raise TrackerError('timed out')
+
+        calls = []
+        release = threading.Event()
+        tiers = TrackerTiers([[DEAD_URL]], timeout=0.1)
+        tiers.tiers[0][0].announce = block
+        self.assertEqual(([], []), asyncio.run(run()))
+        release.set()
+        tiers.running[0].result(timeout=1)
+        self.assertEqual(1, len(calls))
+
+    def test_tier_intervals(self):
+        def answer(name):
+            def announce(params, deadline):
+                calls.append(name)
+                return []
+            return announce
+
+        calls = []
+        tiers = TrackerTiers([[DEAD_URL], [DEAD_URL + '?b']])
+        for name, tier in zip('ab', tiers.tiers):
+            tier[0].announce = answer(name)
+            tier[0].interval = 300
+        tiers.tiers[1][0].min_interval = 1800
+        asyncio.run(tiers.announce(dict(PARAMS, event='started')))
+        self.assertEqual(['a', 'b'], sorted(calls))
+        self.assertEqual(300, tiers.interval)
+        # Tier b asked for 1800 s, so only tier a is due after 300 s.
+        tiers.announced = [announced - 300 for announced in tiers.announced]
+        calls.clear()
+        asyncio.run(tiers.announce(PARAMS))
+        self.assertEqual(['a'], calls)
+        self.assertEqual(300, tiers.interval)
+        calls.clear()
+        asyncio.run(tiers.announce(dict(PARAMS, event='completed')))
+        self.assertEqual(['a', 'b'], sorted(calls))
+
+    def test_unexpected_error(self):
+        def fail(params, deadline):
+            raise RuntimeError('broken')
+
+        self.add_peer(self.mocks[0], '10.0.0.1', 1)
+        tiers = TrackerTiers([[self.mocks[0].url, DEAD_URL]])
+        tiers.tiers[0].sort(key=lambda tracker: tracker.url == DEAD_URL,
+                            reverse=True)
+        tiers.tiers[0][0].announce = fail
+        peers = asyncio.run(tiers.announce(PARAMS))
+        self.assertListEqual([{'ip': '10.0.0.1', 'port': 1}], peers)
+
+    def test_all_failed(self):
+        tiers = TrackerTiers([[DEAD_URL]])
+        self.assertListEqual([], asyncio.run(tiers.announce(PARAMS)))
+        self.assertEqual(ANNOUNCE_RETRY_INTERVAL, tiers.interval)
+
+
+class TestScraper(unittest.TestCase):
+    def setUp(self):
+        self.mock = helpers.MockTracker()
+        self.add_peer(b'\x01' * 20, 1)
+        self.add_peer(b'\x01' * 20, 2)
+        self.add_peer(b'\x02' * 20, 1)
+
+    def tearDown(self):
+        self.mock.close()
+
+    def add_peer(self, info_hash, port):
+        self.mock.swarms.setdefault(info_hash, set()).add(('10.0.0.1', port))
+
+    def test_http_scrape(self):
+        self.assertDictEqual(
+            {b'\x01' * 20: {'complete': 2, 'downloaded': 0,
+                            'incomplete': 0}},
+            Tracker(self.mock.url).scrape([b'\x01' * 20]))
+
+    def test_batched_and_cached(self):
+        scraper = Scraper()
+        torrents = [(Tracker(self.mock.url), b'\x01' * 20),
+                    (Tracker(self.mock.url), b'\x02' * 20),
+                    (None, b'\x03' * 20)]
+        asyncio.run(scraper.scrape(torrents))
+        asyncio.run(scraper.scrape(torrents))
+        self.assertEqual([[b'\x01' * 20, b'\x02' * 20]], self.mock.scrapes)
+        self.assertEqual(2, scraper.get(b'\x01' * 20)['complete'])
+        self.assertEqual(1, scraper.get(b'\x02' * 20)['complete'])
+        self.assertIsNone(scraper.get(b'\x03' * 20))
+
+    def test_expired(self):
+        scraper = Scraper(ttl=0)
+        torrents = [(Tracker(self.mock.url), b'\x01' * 20)]
+        asyncio.run(scraper.scrape(torrents))
+        self.add_peer(b'\x01' * 20, 3)
+        asyncio.run(scraper.scrape(torrents))
+        self.assertEqual(2, len(self.mock.scrapes))
+        self.assertEqual(3, scraper.get(b'\x01' * 20)['complete'])
+
+    def test_failed(self):
+        scraper = Scraper()
+        tracker = Tracker('http://127.0.0.1:1/announce')
+        asyncio.run(scraper.scrape([(tracker, b'\x01' * 20)]))
+        self.assertIsNone(scraper.get(b'\x01' * 20))
+
+
+class FakeTiers:
+    def __init__(self):
+        self.interval = 0.05
+        self.reached = True
+        self.events = []
+
+    async def announce(self, params, timeout=None):
+        self.events.append(params.get('event', ''))
+        self.params = params
+        return [{'ip': '10.0.0.1', 'port': 1}]
+
+
+class FailingTiers(FakeTiers):
+    async def announce(self, params, timeout=None):
+        await super().announce(params, timeout)
+        raise RuntimeError('broken')
+
+
+class FakeDHT:
+    def __init__(self):
+        self.lookups = []
+
+    async def get_peers(self, info_hash, announce_port=None):
+        self.lookups.append((info_hash, announce_port))
+        return [{'ip': '10.0.0.2', 'port': 2}]
+
+
+class TestAnnouncer(unittest.TestCase):
+    def test_events(self):
+        async def run():
+            tiers = FakeTiers()
+            announcer = Announcer(tiers, lambda: {'left': 0})
+            announcer.start()
+            await asyncio.sleep(0.12)
+            announcer.complete()
+            await asyncio.sleep(0.01)
+            await announcer.stop()
+            self.assertEqual({'left': 0, 'compact': 1, 'numwant': NUMWANT,
+                              'event': 'stopped'}, tiers.params)
+            return tiers.events, announcer.peers.qsize()
+
+        events, queued = asyncio.run(run())
+        self.assertEqual('started', events[0])
+        self.assertEqual({''}, set(events[1:-2]))
+        self.assertEqual(['completed', 'stopped'], events[-2:])
+        self.assertEqual(len(events) - 1, queued)
+
+    def test_started_until_reached(self):
+        async def run():
+            tiers = FakeTiers()
+            tiers.reached = False
+            announcer = Announcer(tiers, dict)
+            announcer.start()
+            await asyncio.sleep(0.07)
+            announcer.complete()
+            await announcer.stop()
+            return tiers.events
+
+        self.assertEqual({'started'}, set(asyncio.run(run())))
+
+    def test_failed_round(self):
+        async def run():
+            tiers = FailingTiers()
+            announcer = Announcer(tiers, dict)
+            announcer.start()
+            await asyncio.sleep(0.12)
+            announcer.complete()
+            await asyncio.sleep(0.01)
+            await announcer.stop()
+            return tiers.events
+
+        events = asyncio.run(run())
+        self.assertGreater(len(events), 2)
+        self.assertEqual('stopped', events[-1])
+
+    def test_dht_peers(self):
+        async def run():
+            dht = FakeDHT()
+            announcer = Announcer(FakeTiers(), lambda: {'info_hash': b'h',
+                                                        'port': 6881}, dht)
+            announcer.start()
+            await asyncio.sleep(0.01)
+            await announcer.stop()
+            peers = []
+            while not announcer.peers.empty():
+                peers.append(announcer.peers.get_nowait())
+            return dht.lookups, peers
+
+        lookups, peers = asyncio.run(run())
+        self.assertEqual([(b'h', 6881)], lookups)
+        self.assertIn({'ip': '10.0.0.2', 'port': 2}, peers)
+
 if __name__ == '__main__':
     unittest.main()
-
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import asyncio
+import tempfile
+import time
+import unittest
+
+import helpers
+from modules.files import Files
+from modules.verifier import Verifier, recheck
+
+BLOCK = 2**14
+
+
+class VerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = helpers.make_data(4 * BLOCK)
+        self.files = Files(helpers.make_info('test', self.data, BLOCK),
+                           self.tmp.name)
+        self.verified = []
+
+    def tearDown(self):
+        self.files.close_files()
+        self.tmp.cleanup()
+
+    def on_verified(self, index, length, valid, peers):
+        self.verified.append((index, length, valid, peers))
+
+    def verify(self, pieces, workers):
+        async def run():
+            verifier = Verifier(self.files, self.on_verified, workers, 1)
+            verifier.start()
+            for piece in pieces:
+                await verifier.put(*piece)
+            await verifier.join()
+            await verifier.stop()
+
+        asyncio.run(run())
+
+    def test_pieces_are_written(self):
+        self.verify([(i, self.data[i * BLOCK:(i + 1) * BLOCK], {'peer'})
+                     for i in range(4)], 2)
+        self.assertEqual([(i, BLOCK, True, {'peer'}) for i in range(4)],
+                         sorted(self.verified))
+        self.assertTrue(self.files.have.all())
+        self.assertEqual(self.data[BLOCK:2 * BLOCK],
+                         self.files.read_block(1, 0, BLOCK))
+
+    def test_bad_piece(self):
+        self.verify([(0, b'\x00' * BLOCK, {'bad'})], 1)
+        self.assertEqual([(0, BLOCK, False, {'bad'})], self.verified)
+        self.assertNotIn(0, self.files.have)
+
+    def test_stop_keeps_loop_running(self):
+        async def tick():
+            while True:
+                ticks.append(time.time())
+                await asyncio.sleep(0.01)
+
+        async def run():
+            verifier = Verifier(self.files, self.on_verified, 1, 1)
+            verifier.start()
+            verifier.executor.submit(time.sleep, 0.2)
+            ticker = asyncio.get_running_loop().create_task(tick())
+            await verifier.stop()
+            ticker.cancel()
+
+        ticks = []
+        asyncio.run(run())
+        self.assertGreater(len(ticks), 5)
+
+    def test_piece_already_had(self):
+        self.files.write_piece(0, self.data[:BLOCK])
+        self.verify([(0, self.data[:BLOCK], {'peer'})], 1)
+        self.assertEqual([], self.verified)
+
+
+class RecheckTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = helpers.make_data(9 * BLOCK + 100)
+        info = helpers.make_multi_info(
+            'test', self.data, BLOCK,
+            [BLOCK + 50, 0, 5 * BLOCK, 3 * BLOCK + 50])
+        self.files = Files(info, self.tmp.name)
+        for index in range(self.files.piece_num):
+            self.files.write_piece(
+                index, self.data[index * BLOCK:(index + 1) * BLOCK])
+
+    def tearDown(self):
+        self.files.close_files()
+        self.tmp.cleanup()
+
+    def test_read_pieces(self):
+        self.assertEqual(self.data[BLOCK:9 * BLOCK + 100],
+                         self.files.read_pieces(1, 9))
+
+    def test_recheck(self):
+        self.files.write_data(self.files.files[2]['fd'], 10, b'\x00')
+        progress = []
+        valid = recheck(self.files, 2, 3 * BLOCK,
+                        lambda checked, elapsed: progress.append(checked))
+        self.assertEqual([True, False] + [True] * 8, valid)
+        self.assertEqual(len(self.data), progress[-1])
+        self.assertEqual(4, len(progress))
+
+
+if __name__ == '__main__':
+    unittest.main()